@@ -0,0 +1,113 @@
+import hashlib
+import hmac
+import os
+from base64 import b64encode
+from io import BytesIO
+from threading import Thread
+
+import pytest
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import padding
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from six.moves.BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from six.moves.socketserver import ThreadingMixIn
+
+from webwhatsapi.media import MediaDecryptor, MediaFetchError, MediaFetcher, MediaIntegrityError, \
+    derive_media_keys, write_decrypted
+
+MEDIA_KEY = b64encode(b'k' * 32).decode()
+
+
+def encrypt(data, media_type='image'):
+    iv, cipher_key, mac_key = derive_media_keys(MEDIA_KEY, media_type)
+    padder = padding.PKCS7(algorithms.AES.block_size).padder()
+    encryptor = Cipher(algorithms.AES(cipher_key), modes.CBC(iv), backend=default_backend()).encryptor()
+    encrypted = encryptor.update(padder.update(data) + padder.finalize()) + encryptor.finalize()
+    return encrypted + hmac.new(mac_key, iv + encrypted, hashlib.sha256).digest()[:MediaDecryptor.MAC_LENGTH]
+
+
+def sha256(data):
+    return b64encode(hashlib.sha256(data).digest()).decode()
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class MediaHandler(BaseHTTPRequestHandler):
+    files = {}
+
+    def do_GET(self):
+        content = self.files.get(self.path)
+        if content is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(scope='module')
+def server():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), MediaHandler)
+    thread = Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield 'http://127.0.0.1:{0}'.format(httpd.server_address[1])
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture
+def fetcher():
+    fetcher = MediaFetcher(max_connections=2, timeout=5, retries=0)
+    yield fetcher
+    fetcher.close()
+
+
+def test_fetch(server, fetcher):
+    content = os.urandom(100000)
+    MediaHandler.files['/plain'] = content
+
+    assert fetcher.fetch(server + '/plain') == content
+    chunks = list(fetcher.iter_chunks(server + '/plain', 30000))
+    assert len(chunks) > 1
+    assert b''.join(chunks) == content
+
+
+def test_fetch_missing_file(server, fetcher):
+    with pytest.raises(MediaFetchError):
+        fetcher.fetch(server + '/missing')
+
+
+def test_fetch_unreachable_server(fetcher):
+    with pytest.raises(MediaFetchError):
+        fetcher.fetch('http://127.0.0.1:1/file')
+
+
+def test_download_and_decrypt(server, fetcher):
+    content = os.urandom(250000)
+    encrypted = encrypt(content)
+    MediaHandler.files['/encrypted'] = encrypted
+
+    output = BytesIO()
+    decryptor = MediaDecryptor(MEDIA_KEY, 'image', sha256(content), sha256(encrypted))
+    written = write_decrypted(fetcher.iter_chunks(server + '/encrypted', 65536), decryptor, output)
+
+    assert written == len(content)
+    assert output.getvalue() == content
+
+
+def test_download_corrupted(server, fetcher, tmpdir):
+    content = os.urandom(5000)
+    encrypted = bytearray(encrypt(content))
+    encrypted[100] ^= 1
+    MediaHandler.files['/corrupted'] = bytes(encrypted)
+
+    path = str(tmpdir.join('media'))
+    with pytest.raises(MediaIntegrityError):
+        write_decrypted(fetcher.iter_chunks(server + '/corrupted'), MediaDecryptor(MEDIA_KEY, 'image'), path)
+    assert not os.path.exists(path)
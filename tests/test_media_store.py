@@ -0,0 +1,51 @@
+import os
+from base64 import b64encode
+
+from webwhatsapi.media_store import MediaStore
+
+FILEHASH = b64encode(b'h' * 32).decode()
+
+
+def write(content):
+    return lambda f: f.write(content)
+
+
+def test_open(tmpdir):
+    store = MediaStore(str(tmpdir.join('store')))
+    store.put(FILEHASH, 'image', write(b'content'))
+
+    media = store.open(FILEHASH, 'image')
+    assert media[:] == b'content'
+    media.close()
+
+
+def test_open_empty_file(tmpdir):
+    store = MediaStore(str(tmpdir.join('store')))
+    store.put(FILEHASH, 'image', write(b''))
+
+    assert store.open(FILEHASH, 'image') == b''
+
+
+def test_file_evicted_before_open(tmpdir):
+    store = MediaStore(str(tmpdir.join('store')))
+    path = store.put(FILEHASH, 'image', write(b'content'))
+
+    # Removed between the lookup and the open, as an eviction by another thread would
+    os.remove(path)
+    store.get = lambda filehash, media_type: path
+
+    assert store.open(FILEHASH, 'image') is None
+    assert store.copy(FILEHASH, 'image', str(tmpdir.join('copy'))) is None
+    assert not tmpdir.join('copy').exists()
+
+
+def test_copy_is_not_linked(tmpdir):
+    store = MediaStore(str(tmpdir.join('store')))
+    path = store.put(FILEHASH, 'image', write(b'content'))
+    destination = str(tmpdir.join('copy'))
+
+    assert store.copy(FILEHASH, 'image', destination) == destination
+    with open(destination, 'wb') as f:
+        f.write(b'changed')
+    with open(path, 'rb') as f:
+        assert f.read() == b'content'
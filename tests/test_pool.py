@@ -0,0 +1,104 @@
+from webwhatsapi.pool import DriverPool, SessionState
+
+
+class FakeDriver(object):
+
+    def __init__(self, account):
+        self.account = account
+        self.logged_in = True
+        self.connection_status = 'RUNNING'
+        self.quit_calls = 0
+
+    def is_logged_in(self):
+        return self.logged_in
+
+    def get_connection_status(self):
+        return self.connection_status
+
+    def quit(self):
+        self.quit_calls += 1
+
+
+def make_pool(**kwargs):
+    drivers = []
+
+    def factory(account):
+        driver = FakeDriver(account)
+        drivers.append(driver)
+        return driver
+
+    return DriverPool(factory, **kwargs), drivers
+
+
+def test_healthy_session_is_running():
+    pool, drivers = make_pool()
+    pool.add('shop-1')
+
+    assert pool.check('shop-1') == SessionState.Running
+    assert pool.get_session('shop-1').failures == 0
+    pool.close()
+
+
+def test_not_logged_in_is_not_a_failure():
+    pool, drivers = make_pool(max_failures=1)
+    pool.add('shop-1')
+    drivers[0].logged_in = False
+
+    assert pool.check('shop-1') == SessionState.NotLoggedIn
+    assert len(drivers) == 1
+    pool.close()
+
+
+def test_restart_after_consecutive_failures():
+    pool, drivers = make_pool(max_failures=3)
+    pool.add('shop-1')
+    session = pool.get_session('shop-1')
+    drivers[0].connection_status = 'ERROR'
+
+    assert pool.check('shop-1') == SessionState.Unhealthy
+    assert pool.check('shop-1') == SessionState.Unhealthy
+    assert session.failures == 2
+    assert len(drivers) == 1
+
+    assert pool.check('shop-1') == SessionState.NotLoggedIn
+    assert drivers[0].quit_calls == 1
+    assert len(drivers) == 2
+    assert session.driver is drivers[1]
+    assert session.restarts == 1
+    assert session.failures == 0
+
+    assert pool.check('shop-1') == SessionState.Running
+    pool.close()
+
+
+def test_healthy_check_resets_failures():
+    pool, drivers = make_pool(max_failures=2)
+    pool.add('shop-1')
+    drivers[0].connection_status = 'ERROR'
+    pool.check('shop-1')
+
+    drivers[0].connection_status = 'RUNNING'
+    assert pool.check('shop-1') == SessionState.Running
+
+    drivers[0].connection_status = 'ERROR'
+    assert pool.check('shop-1') == SessionState.Unhealthy
+    assert len(drivers) == 1
+    pool.close()
+
+
+def test_failed_start_is_retried_by_check():
+    attempts = []
+
+    def factory(account):
+        attempts.append(account)
+        if len(attempts) == 1:
+            raise RuntimeError("Browser crashed")
+        return FakeDriver(account)
+
+    pool = DriverPool(factory)
+    pool.add('shop-1')
+    assert pool.get_session('shop-1').state == SessionState.Failed
+
+    assert pool.check('shop-1') == SessionState.NotLoggedIn
+    assert len(attempts) == 2
+    pool.close()
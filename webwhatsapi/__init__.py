@@ -5,18 +5,16 @@ WebWhatsAPI module
 
 """
 
-import binascii
 import logging
+import time
 from datetime import datetime, timedelta
 from json import dumps, loads
 
 import os
 import shutil
 import tempfile
-from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
-from cryptography.hazmat.backends import default_backend
-from axolotl.kdf.hkdfv3 import HKDFv3
-from axolotl.util.byteutil import ByteUtil
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from threading import Lock
 from base64 import b64decode
 from io import BytesIO
 from selenium import webdriver
@@ -24,12 +22,18 @@ from selenium.common.exceptions import NoSuchElementException
 from selenium.webdriver.common.by import By
 from selenium.webdriver.common.desired_capabilities import DesiredCapabilities
 from selenium.webdriver.firefox.options import Options
+from selenium.webdriver.remote.file_detector import LocalFileDetector
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.support.ui import WebDriverWait
+from six import string_types
 
+from .cache import ObjectCache
+from .media import CHUNK_SIZE, MediaDecryptor, MediaDownload, MediaFetchError, MediaFetcher, write_decrypted
 from .objects.chat import UserChat, factory_chat
 from .objects.contact import Contact
-from .objects.message import MessageGroup, factory_message
+from .objects.delta import Delta
+from .objects.message import MessageGroup, MessageStatus, MessageStatusChange, factory_message, factory_messages
+from .objects.outgoing import MediaFile, SendResult
 from .wapi_js_wrapper import WapiJsWrapper
 
 __version__ = '2.0.3'
@@ -43,6 +47,20 @@ class WhatsAPIDriverStatus(object):
     LoggedIn = 'LoggedIn'
 
 
+class SerializationProfile(object):
+    """
+    How much data the browser sends back for each message and chat
+
+    Minimal: only what the python objects are built from. Senders are sent as IDs and chats are not repeated
+    in every message
+    Standard: raw objects, with the sender reduced to its names and without the chat copy in every message
+    Full: raw objects with every related object (chat, contact, presence, group metadata, media data)
+    """
+    Minimal = 'minimal'
+    Standard = 'standard'
+    Full = 'full'
+
+
 class WhatsAPIException(Exception):
     pass
 
@@ -55,6 +73,10 @@ class ContactNotFoundError(WhatsAPIException):
     pass
 
 
+class MessageNotFoundError(WhatsAPIException):
+    pass
+
+
 class WhatsAPIDriver(object):
     """
     This is our main driver objects.
@@ -70,6 +92,9 @@ class WhatsAPIDriver(object):
 
     _LOCAL_STORAGE_FILE = 'localStorage.json'
 
+    # Longest wait of a single long poll call when calls hold the WebDriver session, so other threads get their turn
+    _POLL_SLICE = 1
+
     _SELECTORS = {
         'firstrun': "#wrapper",
         'qrCode': "img[alt=\"Scan me!\"]",
@@ -168,7 +193,9 @@ class WhatsAPIDriver(object):
         self.driver.close()
 
     def __init__(self, client="firefox", username="API", proxy=None, command_executor=None, loadstyles=False,
-                 profile=None, headless=False, autoconnect=True, logger=None, extra_params=None):
+                 profile=None, headless=False, autoconnect=True, logger=None, extra_params=None,
+                 object_cache_size=0, object_cache_ttl=300, media_fetcher=None, media_connections=8,
+                 media_store=None):
         "Initialises the webdriver"
 
         self.logger = logger or self.logger
@@ -232,11 +259,27 @@ class WhatsAPIDriver(object):
                 desired_capabilities=capabilities,
                 **extra_params
             )
+            # Files sent with chat_send_media_file are on this machine, not on the browser's
+            self.driver.file_detector = LocalFileDetector()
 
         else:
             self.logger.error("Invalid client: %s" % client)
         self.username = username
         self.wapi_functions = WapiJsWrapper(self.driver)
+        self._new_messages_subscription = None
+        self._ack_subscription = None
+
+        # Contact and Chat objects, keyed by ('contact', id) and ('chat', id). Disabled unless object_cache_size is
+        # set, cached objects can be up to object_cache_ttl seconds old unless sync_object_cache is called
+        self.object_cache = ObjectCache(object_cache_size, object_cache_ttl)
+        self._object_cache_cursors = {'chat': None, 'contact': None}
+
+        # Media is downloaded directly, the browser is only used when that fails. Created on first use
+        self._media_fetcher = media_fetcher
+        self._media_connections = media_connections
+        self._media_fetcher_lock = Lock()
+        # Decrypted media files by filehash, None disables it
+        self.media_store = media_store
 
         self.driver.set_script_timeout(500)
         self.driver.implicitly_wait(10)
@@ -311,7 +354,7 @@ class WhatsAPIDriver(object):
         :rtype: list[Contact]
         """
         all_contacts = self.wapi_functions.getAllContacts()
-        return [Contact(contact, self) for contact in all_contacts]
+        return [self._cache_object('contact', Contact(contact, self)) for contact in all_contacts]
 
     def get_my_contacts(self):
         """
@@ -323,6 +366,37 @@ class WhatsAPIDriver(object):
         my_contacts = self.wapi_functions.getMyContacts()
         return [Contact(contact, self) for contact in my_contacts]
 
+    def get_contacts_delta(self, cursor=None, my_contacts_only=False):
+        """
+        Fetches contacts added, changed or removed since cursor
+
+        Usage::
+
+            delta = driver.get_contacts_delta()
+            # ... later
+            delta = driver.get_contacts_delta(delta.cursor)
+
+        :param cursor: Cursor of a previous delta. None fetches every contact
+        :type cursor: str or None
+        :param my_contacts_only: Only consider contacts from the address book.
+            Contacts that leave the address book are reported as removed
+        :type my_contacts_only: bool
+        :return: Changes since cursor
+        :rtype: Delta
+        """
+        delta = self.wapi_functions.getContactsDelta(cursor, True)
+
+        changed = []
+        removed_ids = list(delta['removed'])
+        for contact in delta['changed']:
+            if my_contacts_only and not contact.get('isMyContact'):
+                if not delta['full']:
+                    removed_ids.append(Contact(contact, self).get_id())
+                continue
+            changed.append(Contact(contact, self))
+
+        return Delta(delta['cursor'], changed, removed_ids, delta['full'])
+
     def get_all_chats(self):
         """
         Fetches all chats
@@ -330,7 +404,49 @@ class WhatsAPIDriver(object):
         :return: List of chats
         :rtype: list[Chat]
         """
-        return [factory_chat(chat, self) for chat in self.wapi_functions.getAllChats()]
+        return [self._cache_object('chat', factory_chat(chat, self)) for chat in self.wapi_functions.getAllChats()]
+
+    def get_chats_delta(self, cursor=None):
+        """
+        Fetches chats added, changed or removed since cursor
+
+        :param cursor: Cursor of a previous delta. None fetches every chat
+        :type cursor: str or None
+        :return: Changes since cursor
+        :rtype: Delta
+        """
+        delta = self.wapi_functions.getChatsDelta(cursor, True)
+
+        return Delta(
+            delta['cursor'],
+            [factory_chat(chat, self) for chat in delta['changed']],
+            delta['removed'],
+            delta['full']
+        )
+
+    def _iter_chat_pages(self, page_size):
+        # IDs are read first, so chats moving in the list while iterating are neither skipped nor repeated
+        chat_ids = self.get_all_chat_ids()
+
+        for start in range(0, len(chat_ids), page_size):
+            page = []
+            for chat in self.wapi_functions.getChatsByIds(chat_ids[start:start + page_size]):
+                # Chats removed since the IDs were read are skipped
+                if chat is not None:
+                    page.append(self._cache_object('chat', factory_chat(chat, self)))
+            yield page
+
+    def iter_chats(self, page_size=500):
+        """
+        Iterates over all chats, fetching them page by page
+
+        :param page_size: Number of chats fetched in each browser round trip
+        :type page_size: int
+        :rtype: Iterator[Chat]
+        """
+        for page in self._iter_chat_pages(page_size):
+            for chat in page:
+                yield chat
 
     def get_all_chat_ids(self):
         """
@@ -343,7 +459,8 @@ class WhatsAPIDriver(object):
 
     def get_unread(
             self, include_me=False, include_notifications=False,
-            filter_week=True, specific_chat=None
+            filter_week=True, specific_chat=None, mark_seen=False,
+            profile=SerializationProfile.Full
     ):
         """
         Fetches unread messages
@@ -356,6 +473,10 @@ class WhatsAPIDriver(object):
         :type filter_week: bool
         :param specific_chat: Specific chat from where get messages.
         :type specific_chat: string
+        :param mark_seen: Send seen to every chat with unread messages, in a single browser round trip
+        :type mark_seen: bool
+        :param profile: Serialization profile, see SerializationProfile
+        :type profile: str
         :return: List of unread messages grouped by chats
         :rtype: list[MessageGroup]
         """
@@ -363,41 +484,199 @@ class WhatsAPIDriver(object):
         seven_days_ago = int((datetime.now() - timedelta(days=7)).timestamp())
         if specific_chat is None:
             raw_message_groups = self.wapi_functions.getUnreadMessages(
-                include_me, include_notifications
+                include_me, include_notifications, profile
             )
         else:
             raw_message_groups = self.wapi_functions.getUnreadMessagesUsingChatId(
-                specific_chat, include_me, include_notifications
+                specific_chat, include_me, include_notifications, profile
             )
 
-        unread_messages = []
-        for raw_message_group in raw_message_groups:
-            chat = factory_chat(raw_message_group, self)
-
-            if filter_week:
-                messages = sorted(
-                    map(
-                        lambda message: factory_message(message, self),
-                        filter(
-                            lambda msg: msg["timestamp"] >= seven_days_ago,
-                            raw_message_group['messages']
-                        )
-                    ),
-                    key=lambda message: message.timestamp
-                )
-            else:
-                messages = list(
-                    map(
-                        lambda message: factory_message(message, self),
-                        raw_message_group['messages']
-                    )
-                )
+        unread_messages = self._message_groups(raw_message_groups, seven_days_ago if filter_week else None)
 
-            unread_messages.append(MessageGroup(chat, messages))
+        if mark_seen:
+            self.chats_send_seen([message_group.chat.get_id() for message_group in unread_messages])
 
         return unread_messages
 
-    def get_all_messages_in_chat(self, chat, include_me=False, include_notifications=False):
+    def _message_groups(self, raw_message_groups, min_timestamp=None):
+        """
+        Creates the message groups of chats, fetching the recipients of all their notifications in a single browser
+        round trip
+
+        :param min_timestamp: If given, older messages are left out and the rest are sorted by date
+        :rtype: list[MessageGroup]
+        """
+        raw_messages = [[message for message in raw_message_group['messages']
+                         if min_timestamp is None or message["timestamp"] >= min_timestamp]
+                        for raw_message_group in raw_message_groups]
+        messages = iter(factory_messages([message for group in raw_messages for message in group], self))
+
+        message_groups = []
+        for raw_message_group, group in zip(raw_message_groups, raw_messages):
+            group_messages = [next(messages) for _ in group]
+            if min_timestamp is not None:
+                group_messages.sort(key=lambda message: message.timestamp)
+            message_groups.append(MessageGroup(factory_chat(raw_message_group, self), group_messages))
+
+        return message_groups
+
+    def _long_poll(self, function, timeout, has_result, *args):
+        """
+        Calls a WAPI function waiting up to timeout seconds for events in the page
+
+        Without the concurrent channel each call holds the WebDriver session, so the wait is split in calls of at most
+        _POLL_SLICE seconds.
+
+        :param function: WAPI function, receiving the wait in milliseconds followed by args
+        :param has_result: Function telling whether a result ends the wait
+        """
+        if self.wapi_functions.channel is not None:
+            return function(int(timeout * 1000), *args)
+
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = max(deadline - time.monotonic(), 0)
+            result = function(int(min(remaining, self._POLL_SLICE) * 1000), *args)
+            if remaining <= self._POLL_SLICE or has_result(result):
+                return result
+
+    def subscribe_new_messages(self, include_me=False, include_notifications=False, max_queue_size=1000):
+        """
+        Starts buffering new incoming messages in the page, to be fetched with get_new_messages
+
+        :param include_me: Include user's messages
+        :type include_me: bool or None
+        :param include_notifications: Include events happening on chat
+        :type include_notifications: bool or None
+        :param max_queue_size: Maximum number of messages buffered in the page. Older ones are dropped when reached
+        :type max_queue_size: int
+        """
+        self._new_messages_subscription = (include_me, include_notifications, max_queue_size)
+        self.wapi_functions.startNewMessagesListener(include_me, include_notifications, max_queue_size)
+
+    def unsubscribe_new_messages(self):
+        """
+        Stops buffering new incoming messages in the page
+        """
+        self._new_messages_subscription = None
+        self.wapi_functions.stopNewMessagesListener()
+
+    def get_new_messages(self, timeout=25, max_count=100, profile=SerializationProfile.Full):
+        """
+        Waits for new incoming messages and returns them
+
+        Returns as soon as there is at least one message buffered in the page, or after timeout seconds.
+        Subscribes with default options if subscribe_new_messages was not called, and subscribes again after
+        a page reload.
+
+        :param timeout: Maximum time to wait in seconds
+        :type timeout: float
+        :param max_count: Maximum number of messages to return
+        :type max_count: int
+        :param profile: Serialization profile, see SerializationProfile
+        :type profile: str
+        :return: List of new messages, in arrival order
+        :rtype: list[Message]
+        """
+        if self._new_messages_subscription is None:
+            self.subscribe_new_messages()
+
+        result = self._long_poll(self.wapi_functions.waitNewMessages, timeout,
+                                 lambda r: r['messages'] or r['dropped'] or not r['subscribed'], max_count, profile)
+
+        if not result['subscribed']:
+            self.subscribe_new_messages(*self._new_messages_subscription)
+            return []
+
+        if result['dropped']:
+            self.logger.warning("%d new messages were dropped from the page queue" % result['dropped'])
+
+        return factory_messages(result['messages'], self)
+
+    def iter_new_messages(self, timeout=25, max_count=100, profile=SerializationProfile.Full):
+        """
+        Blocking iterator over new incoming messages
+
+        :param timeout: Maximum time to wait in each long poll, in seconds
+        :type timeout: float
+        :param max_count: Maximum number of messages fetched in each long poll
+        :type max_count: int
+        :param profile: Serialization profile, see SerializationProfile
+        :type profile: str
+        :return: New messages, in arrival order
+        :rtype: Iterator[Message]
+        """
+        while True:
+            for message in self.get_new_messages(timeout, max_count, profile):
+                yield message
+
+    def subscribe_acks(self, only_mine=True, max_queue_size=10000):
+        """
+        Starts queueing status (ack) changes of messages in the page, to be fetched with get_ack_changes
+
+        Changes of the same message are merged while they wait in the queue, so only its latest status is returned
+
+        :param only_mine: Only track messages sent by the user
+        :type only_mine: bool
+        :param max_queue_size: Maximum number of changes queued in the page. Older ones are dropped when reached
+        :type max_queue_size: int
+        """
+        self._ack_subscription = (only_mine, max_queue_size)
+        self.wapi_functions.startAckListener(only_mine, max_queue_size)
+
+    def unsubscribe_acks(self):
+        """
+        Stops queueing status changes of messages in the page
+        """
+        self._ack_subscription = None
+        self.wapi_functions.stopAckListener()
+
+    def get_ack_changes(self, timeout=25, max_count=1000):
+        """
+        Waits for status changes of messages and returns them
+
+        Returns as soon as there is at least one change queued in the page, or after timeout seconds.
+        Subscribes with default options if subscribe_acks was not called, and subscribes again after a page reload.
+
+        :param timeout: Maximum time to wait in seconds
+        :type timeout: float
+        :param max_count: Maximum number of changes to return
+        :type max_count: int
+        :return: Status changes, in arrival order
+        :rtype: list[MessageStatusChange]
+        """
+        if self._ack_subscription is None:
+            self.subscribe_acks()
+
+        result = self._long_poll(self.wapi_functions.waitAckChanges, timeout,
+                                 lambda r: r['changes'] or r['dropped'] or not r['subscribed'], max_count)
+
+        if not result['subscribed']:
+            self.subscribe_acks(*self._ack_subscription)
+            return []
+
+        if result['dropped']:
+            self.logger.warning("%d status changes were dropped from the page queue" % result['dropped'])
+
+        return [MessageStatusChange(change) for change in result['changes']]
+
+    def iter_ack_changes(self, timeout=25, max_count=1000):
+        """
+        Blocking iterator over status changes of messages
+
+        :param timeout: Maximum time to wait in each long poll, in seconds
+        :type timeout: float
+        :param max_count: Maximum number of changes fetched in each long poll
+        :type max_count: int
+        :return: Status changes, in arrival order
+        :rtype: Iterator[MessageStatusChange]
+        """
+        while True:
+            for change in self.get_ack_changes(timeout, max_count):
+                yield change
+
+    def get_all_messages_in_chat(self, chat, include_me=False, include_notifications=False,
+                                 profile=SerializationProfile.Full):
         """
         Fetches messages in chat
 
@@ -405,18 +684,16 @@ class WhatsAPIDriver(object):
         :type include_me: bool or None
         :param include_notifications: Include events happening on chat
         :type include_notifications: bool or None
+        :param profile: Serialization profile, see SerializationProfile
+        :type profile: str
         :return: List of messages in chat
         :rtype: list[Message]
         """
         message_objs = self.wapi_functions.getAllMessagesInChat(
-            chat.get_id(), include_me, include_notifications
+            chat.get_id(), include_me, include_notifications, profile
         )
 
-        messages = []
-        for message in message_objs:
-            messages.append(factory_message(message, self))
-
-        return messages
+        return factory_messages(message_objs, self)
 
     def get_all_message_ids_in_chat(self, chat, include_me=False, include_notifications=False):
         """
@@ -447,18 +724,68 @@ class WhatsAPIDriver(object):
 
         return result
 
+    def _cache_object(self, kind, obj):
+        self.object_cache.set((kind, obj.get_id()), obj)
+        return obj
+
+    def invalidate_object_cache(self, object_id=None):
+        """
+        Drops cached Contact and Chat objects
+
+        :param object_id: ID of the contact or chat to drop. None drops everything
+        :type object_id: str or None
+        """
+        if object_id is None:
+            self.object_cache.clear()
+        else:
+            self.object_cache.invalidate(('contact', object_id))
+            self.object_cache.invalidate(('chat', object_id))
+
+    def sync_object_cache(self):
+        """
+        Refreshes cached Contact and Chat objects that changed in the page since the previous sync
+
+        Only objects already in the cache are updated. The first call (and the first one after a page reload)
+        only records the current position, without transferring any chat or contact.
+        """
+        for kind, fetch_delta in (('chat', self.wapi_functions.getChatsDelta),
+                                  ('contact', self.wapi_functions.getContactsDelta)):
+            delta = fetch_delta(self._object_cache_cursors[kind], False)
+
+            if delta['full'] and self._object_cache_cursors[kind] is not None:
+                # Page was reloaded, changes since the previous sync are unknown
+                self.object_cache.clear()
+
+            for obj_id in delta['removed']:
+                self.object_cache.invalidate((kind, obj_id))
+
+            for js_obj in delta['changed']:
+                obj = factory_chat(js_obj, self) if kind == 'chat' else Contact(js_obj, self)
+                if (kind, obj.get_id()) in self.object_cache:
+                    self._cache_object(kind, obj)
+
+            self._object_cache_cursors[kind] = delta['cursor']
+
     def get_contact_from_id(self, contact_id):
+        contact = self.object_cache.get(('contact', contact_id))
+        if contact is not None:
+            return contact
+
         contact = self.wapi_functions.getContact(contact_id)
 
         if contact is None:
             raise ContactNotFoundError("Contact {0} not found".format(contact_id))
 
-        return Contact(contact, self)
+        return self._cache_object('contact', Contact(contact, self))
 
     def get_chat_from_id(self, chat_id):
+        chat = self.object_cache.get(('chat', chat_id))
+        if chat is not None:
+            return chat
+
         chat = self.wapi_functions.getChatById(chat_id)
         if chat:
-            return factory_chat(chat, self)
+            return self._cache_object('chat', factory_chat(chat, self))
 
         raise ChatNotFoundError("Chat {0} not found".format(chat_id))
 
@@ -507,23 +834,59 @@ class WhatsAPIDriver(object):
         for group in self.wapi_functions.getCommonGroups(contact_id):
             yield factory_chat(group, self)
 
+    def contacts_get_common_groups(self, contact_ids):
+        """
+        Fetches the groups in common with several contacts in a single browser round trip
+
+        :param contact_ids: IDs of the contacts
+        :type contact_ids: list[str]
+        :return: Common groups by contact ID. Groups shared by several contacts are the same object
+        :rtype: dict[str, list[GroupChat]]
+        """
+        result = self.wapi_functions.getCommonGroupsMany(list(contact_ids))
+        groups = {group_id: factory_chat(group, self) for group_id, group in result['groups'].items()}
+
+        return {contact_id: [groups[group_id] for group_id in group_ids]
+                for contact_id, group_ids in result['members'].items()}
+
     def chat_exists(self, chat_id):
         result = self.wapi_functions.existsChatId(chat_id)
         return result
 
-    def chat_send_message_to_new(self, chat_id, message):
-        result = self.wapi_functions.sendMessageToID(chat_id, message)
+    def chat_send_message_to_new(self, chat_id, message, wait_ack=None, ack_timeout=30):
+        """
+        Sends a text message to a chat, creating the chat if needed
 
-        if not isinstance(result, bool):
-            return factory_message(result, self)
-        return result
+        See chat_send_message
+        """
+        return self._sent_message(self.wapi_functions.sendMessageToID(chat_id, message), wait_ack, ack_timeout)
 
-    def chat_send_message(self, chat_id, message):
-        result = self.wapi_functions.sendMessage(chat_id, message)
+    def chat_send_message(self, chat_id, message, wait_ack=None, ack_timeout=30):
+        """
+        Sends a text message to a chat
+
+        :param chat_id: ID of the chat
+        :type chat_id: str
+        :param message: Text of the message
+        :type message: str
+        :param wait_ack: Optional status to wait for, e.g. MessageStatus.RECEIVED
+        :type wait_ack: MessageStatus
+        :param ack_timeout: Maximum time to wait for wait_ack, in seconds. The message is returned with its
+            current status when it runs out
+        :type ack_timeout: float
+        :return: Sent message. True if it was sent but could not be found, False if it was not sent
+        :rtype: Message or bool
+        """
+        return self._sent_message(self.wapi_functions.sendMessage(chat_id, message), wait_ack, ack_timeout)
 
-        if not isinstance(result, bool):
-            return factory_message(result, self)
-        return result
+    def _sent_message(self, result, wait_ack, ack_timeout):
+        if isinstance(result, bool):
+            return result
+
+        if wait_ack is not None and (result.get('ack') or 0) < wait_ack.value:
+            result = self.wapi_functions.waitForAck(result['id'], wait_ack.value, int(ack_timeout * 1000)) or result
+
+        return factory_message(result, self)
 
     def chat_send_message_async(self, chat_id, message):
         result = self.wapi_functions.sendMessageAsync(chat_id, message)
@@ -532,12 +895,138 @@ class WhatsAPIDriver(object):
     def chat_send_seen(self, chat_id):
         return self.wapi_functions.sendSeen(chat_id)
 
+    def chats_send_seen(self, chat_ids):
+        """
+        Sends seen to several chats in a single browser round trip
+
+        :param chat_ids: IDs of the chats
+        :return: Result of sendSeen for each chat, in order
+        :rtype: list
+        """
+        with self.wapi_functions.batch() as batch:
+            calls = [batch.sendSeen(chat_id) for chat_id in chat_ids]
+
+        return [call.result() for call in calls]
+
     def chat_send_media(self, chat_id, media_base_64, filename, caption):
         result = self.wapi_functions.sendMedia(
             media_base_64, chat_id, filename, caption
         )
         return result
 
+    def chat_send_media_file(self, chat_id, path, caption=None):
+        """
+        Sends a file to a chat
+
+        The browser reads the file from its path through a file input, so it is not loaded in memory nor
+        base64 encoded. With remote drivers, WebDriver uploads it to the browser machine first.
+
+        :param chat_id: ID of the chat, created if it doesn't exist
+        :type chat_id: str
+        :param path: Path of the file
+        :type path: str
+        :param caption: Caption of the media
+        :type caption: str
+        :return: True if the file was sent
+        :rtype: bool
+        """
+        return self.wapi_functions.sendMediaFromInput(self._upload_file(path), chat_id, caption)
+
+    def _upload_file(self, path):
+        """
+        Sets a file in a new file input of the page
+
+        :return: ID of the input
+        :rtype: str
+        """
+        path = os.path.abspath(path)
+        if not os.path.isfile(path):
+            raise WhatsAPIException("File {0} not found".format(path))
+
+        input_id = self.wapi_functions.createFileInput()
+        # WAPI calls may be running in the page from other threads
+        with self.wapi_functions.exclusive():
+            self.driver.find_element_by_id(input_id).send_keys(path)
+        return input_id
+
+    def send_bulk(self, jobs, rate=1, concurrency=1, timeout=25, max_count=100):
+        """
+        Sends messages to several chats through a queue in the page
+
+        All the messages are submitted in one call, and the page sends them respecting the rate and concurrency
+        limits. Chats that don't exist yet are created, as with chat_send_message_to_new. Each file is uploaded to the
+        page once, however many chats it is sent to.
+
+        Usage::
+
+            jobs = [(chat_id, "Hello"), (other_chat_id, MediaFile("photo.jpg", caption="Hi"))]
+            for result in driver.send_bulk(jobs, rate=2):
+                if not result.ok:
+                    print(result.chat_id, result.error)
+
+        :param jobs: (chat_id, message) pairs, message being a text or a MediaFile
+        :type jobs: list[tuple]
+        :param rate: Maximum number of messages started per second, None for no limit
+        :type rate: float or None
+        :param concurrency: Maximum number of messages being sent at the same time
+        :type concurrency: int
+        :param timeout: Maximum time to wait for results in each long poll, in seconds
+        :type timeout: float
+        :param max_count: Maximum number of results fetched in each long poll
+        :type max_count: int
+        :return: Result of each message, in completion order
+        :rtype: Iterator[SendResult]
+        :raises ValueError: If rate is not positive or concurrency is lower than 1
+        """
+        # Nothing would ever be sent, and the results would be waited for forever
+        if rate is not None and not rate > 0:
+            raise ValueError("rate must be positive or None, got {0}".format(rate))
+        if concurrency < 1:
+            raise ValueError("concurrency must be at least 1, got {0}".format(concurrency))
+
+        jobs = list(jobs)
+        file_ids = {}
+        bulk_id = None
+        remaining = 0
+
+        try:
+            js_jobs = []
+            for chat_id, message in jobs:
+                if isinstance(message, MediaFile):
+                    if message.path not in file_ids:
+                        file_id = self.wapi_functions.registerFileInput(self._upload_file(message.path))
+                        if not file_id:
+                            raise WhatsAPIException("Could not upload {0}".format(message.path))
+                        file_ids[message.path] = file_id
+                    js_jobs.append({'chatId': chat_id, 'fileId': file_ids[message.path], 'caption': message.caption})
+                else:
+                    js_jobs.append({'chatId': chat_id, 'text': message})
+
+            bulk_id = self.wapi_functions.submitSendJobs(js_jobs, rate, concurrency)
+            remaining = len(js_jobs)
+
+            while remaining:
+                result = self._long_poll(
+                    lambda wait, count: self.wapi_functions.waitSendResults(bulk_id, wait, count), timeout,
+                    lambda r: r['results'] or not r['found'], max_count)
+                if not result['found']:
+                    raise WhatsAPIException("Send queue lost, {0} messages were not reported".format(remaining))
+
+                remaining = result['remaining']
+                for sent in result['results']:
+                    try:
+                        ack = MessageStatus(sent['ack'])
+                    except ValueError:
+                        # Missing, or a status this version doesn't know, the message was sent anyway
+                        ack = None
+                    yield SendResult(sent['index'], jobs[sent['index']][0], sent['id'], ack, sent['error'])
+        finally:
+            if remaining:
+                # The caller stopped iterating, or the page failed
+                self.wapi_functions.cancelSendJobs(bulk_id)
+            if file_ids:
+                self.wapi_functions.releaseUploadedFiles(list(file_ids.values()))
+
     def chat_send_media_async(
             self, chat_id, media_base_64, filename, caption, url_fallback
     ):
@@ -546,10 +1035,112 @@ class WhatsAPIDriver(object):
         )
         return result
 
-    def chat_get_messages(self, chat_id, include_me=False, include_notifications=False):
-        message_objs = self.wapi_functions.getAllMessagesInChat(chat_id, include_me, include_notifications)
-        for message in message_objs:
-            yield factory_message(message, self)
+    def chat_get_messages(self, chat_id, include_me=False, include_notifications=False,
+                          profile=SerializationProfile.Full):
+        message_objs = self.wapi_functions.getAllMessagesInChat(chat_id, include_me, include_notifications, profile)
+        for message in factory_messages(message_objs, self):
+            yield message
+
+    def _iter_message_pages(self, chat_id, page_size, after_id, after_timestamp, include_me,
+                            include_notifications, profile):
+        if isinstance(after_timestamp, datetime):
+            after_timestamp = after_timestamp.timestamp()
+
+        cursor = None
+        if after_id is not None or after_timestamp is not None:
+            cursor = {'id': after_id, 't': after_timestamp}
+
+        while True:
+            page = self.wapi_functions.getMessagesPage(
+                chat_id, cursor, page_size, include_me, include_notifications, profile
+            )
+            if page is False:
+                raise ChatNotFoundError("Chat {0} not found".format(chat_id))
+            if cursor is not None and page['cursor'] is None:
+                raise MessageNotFoundError("Message {0} not loaded in chat {1}".format(after_id, chat_id))
+
+            if page['messages']:
+                yield page['messages']
+
+            if not page['hasMore']:
+                return
+            cursor = page['cursor']
+
+    def _iter_message_object_pages(self, chat_id, page_size, after_id, after_timestamp, include_me,
+                                   include_notifications, profile):
+        for page in self._iter_message_pages(chat_id, page_size, after_id, after_timestamp, include_me,
+                                             include_notifications, profile):
+            yield factory_messages(page, self)
+
+    def iter_chat_messages(self, chat_id, page_size=500, after_id=None, after_timestamp=None,
+                           include_me=False, include_notifications=False, profile=SerializationProfile.Full):
+        """
+        Iterates over the loaded messages of a chat, oldest first, fetching them page by page
+
+        Only one page of messages is held in memory at a time, on both the browser and the python side.
+
+        :param chat_id: ID of the chat
+        :param page_size: Number of messages fetched in each browser round trip
+        :type page_size: int
+        :param after_id: Resume after the message with this ID
+        :type after_id: str or None
+        :param after_timestamp: Resume after this date, used when after_id is not given or not loaded
+        :type after_timestamp: datetime or int or None
+        :param include_me: Include user's messages
+        :type include_me: bool or None
+        :param include_notifications: Include events happening on chat
+        :type include_notifications: bool or None
+        :param profile: Serialization profile, see SerializationProfile
+        :type profile: str
+        :return: Messages of the chat
+        :rtype: Iterator[Message]
+        :raises MessageNotFoundError: If after_id is not loaded and after_timestamp is not given
+        """
+        for page in self._iter_message_object_pages(chat_id, page_size, after_id, after_timestamp, include_me,
+                                                    include_notifications, profile):
+            for message in page:
+                yield message
+
+    def export_chat_messages(self, chat_id, output, page_size=500, after_id=None, after_timestamp=None,
+                             include_me=True, include_notifications=False, profile=SerializationProfile.Standard):
+        """
+        Writes the loaded messages of a chat as JSON lines, oldest first, fetching them page by page
+
+        Use chat_load_all_earlier_messages first to export the whole history.
+        An interrupted export can be resumed passing the last exported ID as after_id.
+
+        :param chat_id: ID of the chat
+        :param output: Path of the file, or file-like object opened in text mode
+        :param page_size: Number of messages fetched in each browser round trip
+        :type page_size: int
+        :param after_id: Resume after the message with this ID
+        :type after_id: str or None
+        :param after_timestamp: Resume after this date, used when after_id is not given or not loaded
+        :type after_timestamp: datetime or int or None
+        :param include_me: Include user's messages
+        :type include_me: bool or None
+        :param include_notifications: Include events happening on chat
+        :type include_notifications: bool or None
+        :param profile: Serialization profile, see SerializationProfile
+        :type profile: str
+        :return: Number of exported messages and ID of the last one
+        :rtype: tuple[int, str]
+        :raises MessageNotFoundError: If after_id is not loaded and after_timestamp is not given
+        """
+        if isinstance(output, str):
+            with open(output, 'a') as f:
+                return self.export_chat_messages(chat_id, f, page_size, after_id, after_timestamp,
+                                                 include_me, include_notifications, profile)
+
+        count = 0
+        last_id = after_id
+        for page in self._iter_message_pages(chat_id, page_size, after_id, after_timestamp, include_me,
+                                             include_notifications, profile):
+            output.write(''.join(dumps(message) + '\n' for message in page))
+            count += len(page)
+            last_id = page[-1]['id']
+
+        return count, last_id
 
     def chat_load_earlier_messages(self, chat_id):
         self.wapi_functions.loadEarlierMessages(chat_id)
@@ -566,11 +1157,54 @@ class WhatsAPIDriver(object):
     def group_get_participants_ids(self, group_id):
         return self.wapi_functions.getGroupParticipantIDs(group_id)
 
+    def get_contacts_by_ids(self, contact_ids):
+        """
+        Fetches several contacts in a single browser round trip
+
+        Contacts in the object cache are not fetched again.
+
+        :param contact_ids: IDs of the contacts
+        :type contact_ids: list[str]
+        :return: Contacts, in the same order as the IDs, with None for the contacts not found
+        :rtype: list[Contact or None]
+        """
+        contacts = [self.object_cache.get(('contact', contact_id)) for contact_id in contact_ids]
+        missing = [index for index, contact in enumerate(contacts) if contact is None]
+
+        if missing:
+            found = self.wapi_functions.getContactsByIds([contact_ids[index] for index in missing])
+            for index, contact in zip(missing, found):
+                if contact is not None:
+                    contacts[index] = self._cache_object('contact', Contact(contact, self))
+
+        return contacts
+
+    def _get_contacts_from_ids(self, contact_ids):
+        """
+        Fetches several contacts in a single browser round trip
+
+        :param contact_ids: IDs of the contacts
+        :return: Contacts, in the same order as the IDs
+        :rtype: list[Contact]
+        :raises ContactNotFoundError: If a contact is not found
+        """
+        contacts = self.get_contacts_by_ids(contact_ids)
+
+        for contact_id, contact in zip(contact_ids, contacts):
+            if contact is None:
+                raise ContactNotFoundError("Contact {0} not found".format(contact_id))
+
+        return contacts
+
+    def _iter_contact_pages(self, contact_ids, page_size):
+        for start in range(0, len(contact_ids), page_size):
+            yield self._get_contacts_from_ids(contact_ids[start:start + page_size])
+
     def group_get_participants(self, group_id):
         participant_ids = self.group_get_participants_ids(group_id)
 
-        for participant_id in participant_ids:
-            yield self.get_contact_from_id(participant_id)
+        for contact in self._get_contacts_from_ids(participant_ids):
+            yield contact
 
     def group_get_admin_ids(self, group_id):
         return self.wapi_functions.getGroupAdmins(group_id)
@@ -578,34 +1212,206 @@ class WhatsAPIDriver(object):
     def group_get_admins(self, group_id):
         admin_ids = self.group_get_admin_ids(group_id)
 
-        for admin_id in admin_ids:
-            yield self.get_contact_from_id(admin_id)
+        for contact in self._get_contacts_from_ids(admin_ids):
+            yield contact
 
     def download_file(self, url):
-        return b64decode(self.wapi_functions.downloadFile(url))
+        try:
+            return self.media_fetcher.fetch(url)
+        except MediaFetchError as e:
+            self.logger.warning("%s, downloading through the browser", e)
+            return b64decode(self.wapi_functions.downloadFile(url))
 
-    def download_media(self, media_msg, download_preview=False):
+    def iter_media_chunks(self, url, chunk_size=CHUNK_SIZE):
+        """
+        Downloads a media file and yields it in chunks
+
+        The file is fetched directly from its URL. If that fails before any data is received, it is downloaded
+        through the browser instead.
+
+        :param url: URL of the file
+        :param chunk_size: Size of the chunks
+        :type chunk_size: int
+        :return: Chunks of the file
+        :rtype: Iterator[bytes]
+        """
+        received = False
+        try:
+            for chunk in self.media_fetcher.iter_chunks(url, chunk_size):
+                received = True
+                yield chunk
+            return
+        except MediaFetchError as e:
+            if received:
+                raise
+            self.logger.warning("%s, downloading through the browser", e)
+
+        for chunk in self.iter_download_file(url, chunk_size):
+            yield chunk
+
+    def iter_download_file(self, url, chunk_size=CHUNK_SIZE):
+        """
+        Downloads a file through the browser and yields it in chunks
+
+        The browser keeps the file as binary data and sends one chunk per round trip
+
+        :param url: URL of the file
+        :param chunk_size: Size of the chunks
+        :type chunk_size: int
+        :return: Chunks of the file
+        :rtype: Iterator[bytes]
+        """
+        download = self.wapi_functions.startDownload(url)
+        if not download:
+            raise WhatsAPIException("Could not download {0}".format(url))
+
+        try:
+            for offset in range(0, download['size'], chunk_size):
+                yield b64decode(self.wapi_functions.readDownloadChunk(download['handle'], offset, chunk_size))
+        finally:
+            self.wapi_functions.releaseDownload(download['handle'])
+
+    def download_media(self, media_msg, download_preview=False, sink=None, chunk_size=CHUNK_SIZE):
+        """
+        Downloads and decrypts the media of a message
+
+        The file is downloaded and decrypted in chunks, so only one chunk is held in memory when a sink is given.
+        Its MAC and hashes are checked on the same pass.
+
+        :param media_msg: Media message
+        :type media_msg: MediaMessage
+        :param download_preview: Return the preview sent with the message instead of downloading the file
+        :type download_preview: bool
+        :param sink: Path of the output file, or file-like object opened in binary mode.
+            None returns the decrypted file in a BytesIO
+        :param chunk_size: Size of the downloaded chunks
+        :type chunk_size: int
+        :return: sink, or a BytesIO with the decrypted file if no sink was given
+        :raises MediaIntegrityError: If the file is corrupted or truncated
+        """
         try:
             if media_msg.content and download_preview:
                 return BytesIO(b64decode(media_msg.content))
         except AttributeError:
             pass
 
-        file_data = self.download_file(media_msg.client_url)
+        if self._can_store_media(media_msg):
+            return self._copy_stored_media(self.get_media_path(media_msg, chunk_size), sink)
 
-        media_key = b64decode(media_msg.media_key)
-        derivative = HKDFv3().deriveSecrets(media_key,
-                                            binascii.unhexlify(media_msg.crypt_keys[media_msg.type]),
-                                            112)
+        output = BytesIO() if sink is None else sink
+        self._download_media(media_msg, output, chunk_size)
 
-        parts = ByteUtil.split(derivative, 16, 32)
-        iv = parts[0]
-        cipher_key = parts[1]
-        e_file = file_data[:-10]
+        if sink is None:
+            output.seek(0)
+        return output
 
-        cr_obj = Cipher(algorithms.AES(cipher_key), modes.CBC(iv), backend=default_backend())
-        decryptor = cr_obj.decryptor()
-        return BytesIO(decryptor.update(e_file) + decryptor.finalize())
+    def download_media_many(self, media_msgs, sink_for=None, workers=None, progress=None, chunk_size=CHUNK_SIZE):
+        """
+        Downloads and decrypts the media of several messages in parallel
+
+        Downloads run in a thread pool, decryption included, and are yielded as they complete.
+
+        :param media_msgs: Media messages
+        :type media_msgs: list[MediaMessage]
+        :param sink_for: Optional callable receiving a message and returning its sink, see download_media
+        :type sink_for: callable
+        :param workers: Number of threads. Defaults to the number of CPUs
+        :type workers: int
+        :param progress: Optional callable receiving the number of downloads done, the total number of downloads and
+            the last MediaDownload
+        :type progress: callable
+        :param chunk_size: Size of the downloaded chunks
+        :type chunk_size: int
+        :return: Outcome of each download, with the error it raised if it failed
+        :rtype: Iterator[MediaDownload]
+        """
+        media_msgs = list(media_msgs)
+
+        def download(media_msg):
+            try:
+                sink = None if sink_for is None else sink_for(media_msg)
+                return MediaDownload(media_msg, self.download_media(media_msg, sink=sink, chunk_size=chunk_size))
+            except Exception as e:
+                return MediaDownload(media_msg, error=e)
+
+        executor = ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 4)
+        futures = [executor.submit(download, media_msg) for media_msg in media_msgs]
+        try:
+            for done, future in enumerate(as_completed(futures), 1):
+                result = future.result()
+                if progress is not None:
+                    progress(done, len(futures), result)
+                yield result
+        finally:
+            # The caller may stop iterating before every download is done
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+    def _download_media(self, media_msg, sink, chunk_size=CHUNK_SIZE):
+        write_decrypted(self.iter_media_chunks(media_msg.client_url, chunk_size),
+                        MediaDecryptor(media_msg.media_key, media_msg.type,
+                                       media_msg.filehash, media_msg.enc_filehash),
+                        sink)
+
+    def _can_store_media(self, media_msg):
+        return self.media_store is not None and media_msg.filehash is not None
+
+    @staticmethod
+    def _copy_stored_media(path, sink):
+        if sink is None:
+            with open(path, 'rb') as f:
+                return BytesIO(f.read())
+
+        if isinstance(sink, string_types):
+            shutil.copyfile(path, sink)
+        else:
+            with open(path, 'rb') as f:
+                shutil.copyfileobj(f, sink)
+        return sink
+
+    def get_media_path(self, media_msg, chunk_size=CHUNK_SIZE):
+        """
+        Returns the path of the decrypted media of a message in the media store, downloading it if it is not there
+
+        The file belongs to the store and must not be modified
+
+        :param media_msg: Media message
+        :type media_msg: MediaMessage
+        :param chunk_size: Size of the downloaded chunks
+        :type chunk_size: int
+        :return: Path of the decrypted file
+        :rtype: str
+        """
+        if self.media_store is None:
+            raise WhatsAPIException("No media store configured")
+        if media_msg.filehash is None:
+            raise WhatsAPIException("Message {0} has no filehash".format(media_msg.id))
+
+        path = self.media_store.get(media_msg.filehash, media_msg.type)
+        if path is None:
+            path = self.media_store.put(media_msg.filehash, media_msg.type,
+                                        lambda f: self._download_media(media_msg, f, chunk_size))
+        return path
+
+    def open_media(self, media_msg):
+        """
+        Maps the decrypted media of a message in memory, from the media store
+
+        :param media_msg: Media message
+        :type media_msg: MediaMessage
+        :return: Read only memory map of the file (bytes if the file is empty)
+        :rtype: mmap.mmap
+        """
+        # Other downloads can evict the file before it is opened, it is downloaded again once in that case
+        for _ in range(2):
+            self.get_media_path(media_msg)
+            media = self.media_store.open(media_msg.filehash, media_msg.type)
+            if media is not None:
+                return media
+
+        raise WhatsAPIException("Media of message {0} was evicted from the store before it could be opened".format(
+            media_msg.id))
 
     def mark_default_unread_messages(self):
         """
@@ -637,8 +1443,50 @@ class WhatsAPIDriver(object):
         """
         return self.wapi_functions.deleteConversation(chat_id)
 
+    def backfill_messages_until_date(self, date, chat_ids=None, concurrency=4, chunk_size=20, progress=None):
+        """
+        Loads earlier messages in chats until date is reached, or until a chat has no earlier messages
+
+        Chats are sent to the browser in chunks of chunk_size, and the browser loads at most concurrency chats at
+        the same time. Returns when every chat is done.
+
+        :param date: Date until the messages are loaded
+        :type date: datetime or int
+        :param chat_ids: IDs of the chats to load. None loads every chat
+        :type chat_ids: list[str] or None
+        :param concurrency: Maximum number of chats loading at the same time in the browser
+        :type concurrency: int
+        :param chunk_size: Number of chats per browser round trip. Progress is reported after each chunk
+        :type chunk_size: int
+        :param progress: Optional callable receiving the number of chats done, the total number of chats and
+            the results of the last chunk
+        :type progress: callable
+        :return: Result for each chat, keyed by chat ID. Status is one of "reached", "exhausted" (no earlier
+            messages), "empty", "stalled", "not_found" or "error"
+        :rtype: dict[str, dict]
+        """
+        if isinstance(date, datetime):
+            date = date.timestamp()
+
+        if chat_ids is None:
+            chat_ids = self.get_all_chat_ids()
+
+        results = {}
+        for start in range(0, len(chat_ids), chunk_size):
+            chunk_results = self.wapi_functions.loadEarlierMessagesTillDateChats(
+                chat_ids[start:start + chunk_size], date, concurrency
+            )
+            for result in chunk_results:
+                results[result['id']] = result
+
+            if progress is not None:
+                progress(len(results), len(chat_ids), chunk_results)
+
+        return results
+
     def get_all_messages_until_date(
-            self, date=None, include_me=True, include_notifications=False
+            self, date=None, include_me=True, include_notifications=False,
+            profile=SerializationProfile.Full, concurrency=4, progress=None
     ):
         """
         Get all the messages on whatsapp until a min(date, 7 days)
@@ -648,6 +1496,12 @@ class WhatsAPIDriver(object):
         :type include_me: bool or None
         :param include_notifications: Include events happening on chat
         :type include_notifications: bool or None
+        :param profile: Serialization profile, see SerializationProfile
+        :type profile: str
+        :param concurrency: Maximum number of chats loading at the same time in the browser
+        :type concurrency: int
+        :param progress: Optional progress callable, see backfill_messages_until_date
+        :type progress: callable
         :return: List of messages grouped by chats
         :rtype: list[MessageGroup]
         """
@@ -656,29 +1510,12 @@ class WhatsAPIDriver(object):
             date = seven_days_ago
         else:
             date = max(date, seven_days_ago)
-        self.wapi_functions.loadEarlierMessagesTillDateAllChats(
-            date
-        )
+        self.backfill_messages_until_date(date, concurrency=concurrency, progress=progress)
         raw_message_groups = self.wapi_functions.getAllLatestMessages(
-            include_me, include_notifications
+            include_me, include_notifications, profile
         )
 
-        unread_messages = []
-        for raw_message_group in raw_message_groups:
-            chat = factory_chat(raw_message_group, self)
-            messages = sorted(
-                map(
-                    lambda message:  factory_message(message, self),
-                    filter(
-                        lambda msg: msg["timestamp"] >= date,
-                        raw_message_group['messages']
-                    )
-                ),
-                key=lambda message: message.timestamp
-            )
-            unread_messages.append(MessageGroup(chat, messages))
-
-        return unread_messages
+        return self._message_groups(raw_message_groups, date)
 
     def get_connection_status(self):
         """
@@ -694,5 +1531,17 @@ class WhatsAPIDriver(object):
             status = 'ERROR'
         return status
 
+    @property
+    def media_fetcher(self):
+        if self._media_fetcher is None:
+            # Downloads running in parallel must share a single connection pool
+            with self._media_fetcher_lock:
+                if self._media_fetcher is None:
+                    self._media_fetcher = MediaFetcher(self._media_connections)
+        return self._media_fetcher
+
     def quit(self):
+        if self._media_fetcher is not None:
+            self._media_fetcher.close()
+        self.wapi_functions.close()
         self.driver.quit()
@@ -1,122 +1,364 @@
-import binascii
-from asyncio import CancelledError, get_event_loop, sleep
+import os
+from asyncio import CancelledError, Condition, Semaphore, TimeoutError, as_completed, get_event_loop, iscoroutine, \
+    run_coroutine_threadsafe, sleep, wait_for
 from concurrent.futures import ThreadPoolExecutor
 from logging import getLogger
 
-import aiohttp
-from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
-from cryptography.hazmat.backends import default_backend
-from axolotl.kdf.hkdfv3 import HKDFv3
-from axolotl.util.byteutil import ByteUtil
 from base64 import b64decode
 from functools import partial
 from io import BytesIO
 from selenium.common.exceptions import TimeoutException
+from six import string_types
 
-from . import WhatsAPIDriver
+from . import SerializationProfile, WhatsAPIDriver, WhatsAPIException
+from .async_media import AsyncMediaFetcher
+from .media import CHUNK_SIZE, MediaDecryptor, MediaDownload, MediaFetchError, write_decrypted
+from .wapi_js_wrapper import JsTimeoutError
 
 logger = getLogger(__name__)
 
 
+class _SharedExclusiveGate(object):
+    """
+    Lets WAPI calls run together while keeping them apart from commands that drive the browser directly
+
+    Exclusive holders (screenshots, QR code, local storage...) wait for the running calls to finish and block new ones
+    until they are done. Waiting exclusive holders go first, so a stream of calls can't starve them.
+    """
+
+    def __init__(self):
+        self._condition = Condition()
+        self._shared = 0
+        self._exclusive = False
+        self._waiting_exclusive = 0
+
+    async def acquire_shared(self):
+        async with self._condition:
+            await self._condition.wait_for(lambda: not self._exclusive and not self._waiting_exclusive)
+            self._shared += 1
+
+    async def release_shared(self):
+        async with self._condition:
+            self._shared -= 1
+            self._condition.notify_all()
+
+    async def acquire_exclusive(self):
+        async with self._condition:
+            self._waiting_exclusive += 1
+            try:
+                await self._condition.wait_for(lambda: not self._exclusive and not self._shared)
+            except CancelledError:
+                self._waiting_exclusive -= 1
+                # Calls held back by this holder can go on
+                self._condition.notify_all()
+                raise
+            self._waiting_exclusive -= 1
+            self._exclusive = True
+
+    async def release_exclusive(self):
+        async with self._condition:
+            self._exclusive = False
+            self._condition.notify_all()
+
+
 class WhatsAPIDriverAsync:
 
     def __init__(self, client="firefox", username="API", proxy=None, command_executor=None, loadstyles=False,
-                 profile=None, headless=False, logger=None, extra_params=None, loop=None):
+                 profile=None, headless=False, logger=None, extra_params=None, loop=None,
+                 object_cache_size=0, object_cache_ttl=300, media_fetcher=None, media_connections=8,
+                 media_store=None, workers=4, call_timeout=60):
+        """
+        Constructor
+
+        :param workers: Maximum number of WAPI calls running at the same time
+        :type workers: int
+        :param call_timeout: Default timeout of WAPI calls in seconds, None for no timeout. Calls that time out are
+                             discarded in the page and raise TimeoutException
+        :type call_timeout: float
+        """
 
         self._driver = WhatsAPIDriver(client=client, username=username, proxy=proxy, command_executor=command_executor,
                                       loadstyles=loadstyles, profile=profile, headless=headless, logger=logger,
-                                      autoconnect=False, extra_params=extra_params)
+                                      autoconnect=False, extra_params=extra_params,
+                                      object_cache_size=object_cache_size, object_cache_ttl=object_cache_ttl,
+                                      media_store=media_store)
 
         self.loop = loop or get_event_loop()
-        self._pool_executor = ThreadPoolExecutor(max_workers=1)
+        self.call_timeout = call_timeout
+        # Calls from the workers are multiplexed over the WebDriver session, so slow calls don't block the others
+        self._driver.wapi_functions.enable_channel()
+        self._pool_executor = ThreadPoolExecutor(max_workers=workers)
+        self._gate = _SharedExclusiveGate()
+        # Media is decrypted off the event loop
+        self._media_executor = ThreadPoolExecutor(max_workers=os.cpu_count() or 4)
+        self.media_fetcher = media_fetcher or AsyncMediaFetcher(media_connections)
+
+    def _poll_timeout(self, timeout):
+        # Calls that wait for events in the page get their own wait on top of the call timeout
+        return self.call_timeout + timeout if self.call_timeout is not None else None
+
+    def _call_with_timeout(self, method, timeout):
+        with self._driver.wapi_functions.call_timeout(timeout):
+            return method()
 
     async def _run_async(self, method, *args, **kwargs):
+        """
+        Runs a driver method in a worker thread, concurrently with other calls
+
+        The method itself has no deadline, methods making many round trips (exports, backfills...) run as long as
+        each of their WAPI calls finishes in time.
+
+        :param call_timeout: Timeout of each WAPI call made by the method in seconds, overrides the default of the
+                             driver
+        """
+        timeout = kwargs.pop('call_timeout', self.call_timeout)
+        logger.debug('Running async method {}'.format(getattr(method, '__name__', method)))
+
+        await self._gate.acquire_shared()
         try:
-            logger.debug('Running async method {}'.format(method.__name__))
-            fut = self.loop.run_in_executor(self._pool_executor, partial(method, *args, **kwargs))
-            return await fut
-        except CancelledError:
-            fut.cancel()
-            raise
+            fut = self.loop.run_in_executor(self._pool_executor,
+                                            partial(self._call_with_timeout, partial(method, *args, **kwargs),
+                                                    timeout))
+            try:
+                return await fut
+            except JsTimeoutError as e:
+                raise TimeoutException(str(e))
+        finally:
+            await self._gate.release_shared()
+
+    async def _run_exclusive(self, method, *args, **kwargs):
+        """
+        Runs a driver method that uses the browser directly, once running calls finish and with no other call running
+        """
+        await self._gate.acquire_exclusive()
+        try:
+            return await self.loop.run_in_executor(self._pool_executor, partial(self._call_exclusive, method, *args,
+                                                                                **kwargs))
+        finally:
+            await self._gate.release_exclusive()
+
+    def _call_exclusive(self, method, *args, **kwargs):
+        # The channel dispatcher can't send commands to the session until the method returns
+        with self._driver.wapi_functions.exclusive():
+            return method(*args, **kwargs)
 
     async def get_local_storage(self):
-        return await self._run_async(self._driver.get_local_storage)
+        return await self._run_exclusive(self._driver.get_local_storage)
 
     async def set_local_storage(self, data):
-        return await self._run_async(self._driver.set_local_storage, data)
+        return await self._run_exclusive(self._driver.set_local_storage, data)
 
     async def save_firefox_profile(self, remove_old=False):
-        return await self._run_async(self._driver.save_firefox_profile, remove_old=remove_old)
+        return await self._run_exclusive(self._driver.save_firefox_profile, remove_old=remove_old)
 
     async def connect(self):
-        return await self._run_async(self._driver.connect)
+        return await self._run_exclusive(self._driver.connect)
 
     async def wait_for_login(self, timeout=90):
         for _ in range(timeout // 2):
             try:
-                return await self._run_async(self._driver.wait_for_login, timeout=1)
+                return await self._run_exclusive(self._driver.wait_for_login, timeout=1)
             except TimeoutException:
                 await sleep(1)
         raise TimeoutException('Timeout: Not logged')
 
     async def get_qr(self):
-        return await self._run_async(self._driver.get_qr)
+        return await self._run_exclusive(self._driver.get_qr)
 
     async def screenshot(self, filename):
-        return await self._run_async(self._driver.screenshot, filename)
+        return await self._run_exclusive(self._driver.screenshot, filename)
 
     async def get_contacts(self):
         return await self._run_async(self._driver.get_contacts)
 
-    async def get_all_chats(self):
-        for chat_id in await self.get_all_chat_ids():
-            yield await self.get_chat_from_id(chat_id)
+    async def get_contacts_delta(self, cursor=None, my_contacts_only=False):
+        return await self._run_async(self._driver.get_contacts_delta, cursor=cursor,
+                                     my_contacts_only=my_contacts_only)
+
+    async def get_chats_delta(self, cursor=None):
+        return await self._run_async(self._driver.get_chats_delta, cursor=cursor)
+
+    async def _iter_pages(self, pages):
+        try:
+            while True:
+                page = await self._run_async(next, pages, None)
+                if page is None:
+                    return
+                for item in page:
+                    yield item
+        finally:
+            try:
+                pages.close()
+            except ValueError:
+                # Still running in a worker after a cancellation, it is dropped with the iterator
+                pass
+
+    async def get_all_chats(self, page_size=500):
+        """
+        Iterates over all chats, fetching page_size chats in each browser round trip
+        """
+        async for chat in self._iter_pages(self._driver._iter_chat_pages(page_size)):
+            yield chat
 
     async def get_all_chat_ids(self):
         return await self._run_async(self._driver.get_all_chat_ids)
 
-    async def get_unread(self, include_me=False, include_notifications=False):
+    async def get_unread(self, include_me=False, include_notifications=False, mark_seen=False,
+                         profile=SerializationProfile.Full):
         return await self._run_async(self._driver.get_unread,
                                      include_me=include_me,
-                                     include_notifications=include_notifications)
+                                     include_notifications=include_notifications,
+                                     mark_seen=mark_seen,
+                                     profile=profile)
 
-    async def get_all_messages_in_chat(self, chat, include_me=False, include_notifications=False):
+    async def subscribe_new_messages(self, include_me=False, include_notifications=False, max_queue_size=1000):
+        return await self._run_async(self._driver.subscribe_new_messages,
+                                     include_me=include_me,
+                                     include_notifications=include_notifications,
+                                     max_queue_size=max_queue_size)
+
+    async def unsubscribe_new_messages(self):
+        return await self._run_async(self._driver.unsubscribe_new_messages)
+
+    async def get_new_messages(self, timeout=5, max_count=100, profile=SerializationProfile.Full):
+        return await self._run_async(self._driver.get_new_messages, timeout=timeout, max_count=max_count,
+                                     profile=profile, call_timeout=self._poll_timeout(timeout))
+
+    async def iter_new_messages(self, timeout=5, max_count=100, profile=SerializationProfile.Full):
+        while True:
+            for message in await self.get_new_messages(timeout=timeout, max_count=max_count, profile=profile):
+                yield message
+
+    async def subscribe_acks(self, only_mine=True, max_queue_size=10000):
+        return await self._run_async(self._driver.subscribe_acks, only_mine=only_mine,
+                                     max_queue_size=max_queue_size)
+
+    async def unsubscribe_acks(self):
+        return await self._run_async(self._driver.unsubscribe_acks)
+
+    async def get_ack_changes(self, timeout=5, max_count=1000):
+        return await self._run_async(self._driver.get_ack_changes, timeout=timeout, max_count=max_count,
+                                     call_timeout=self._poll_timeout(timeout))
+
+    async def iter_ack_changes(self, timeout=5, max_count=1000):
+        while True:
+            for change in await self.get_ack_changes(timeout=timeout, max_count=max_count):
+                yield change
+
+    async def watch_ack_changes(self, callback, timeout=5, max_count=1000):
+        """
+        Calls callback with each status change of messages, until cancelled
+
+        :param callback: Function or coroutine function receiving a MessageStatusChange
+        """
+        async for change in self.iter_ack_changes(timeout=timeout, max_count=max_count):
+            result = callback(change)
+            if iscoroutine(result):
+                await result
+
+    async def get_all_messages_in_chat(self, chat, include_me=False, include_notifications=False,
+                                       profile=SerializationProfile.Full):
         return await self._run_async(self._driver.get_all_messages_in_chat,
                                      chat=chat, include_me=include_me,
-                                     include_notifications=include_notifications)
+                                     include_notifications=include_notifications,
+                                     profile=profile)
 
     async def get_contact_from_id(self, contact_id):
         return await self._run_async(self._driver.get_contact_from_id, contact_id)
 
+    async def get_contacts_by_ids(self, contact_ids):
+        return await self._run_async(self._driver.get_contacts_by_ids, contact_ids)
+
     async def get_chat_from_id(self, chat_id):
         return await self._run_async(self._driver.get_chat_from_id, chat_id)
 
+    @property
+    def object_cache(self):
+        return self._driver.object_cache
+
+    def invalidate_object_cache(self, object_id=None):
+        self._driver.invalidate_object_cache(object_id)
+
+    async def sync_object_cache(self):
+        return await self._run_async(self._driver.sync_object_cache)
+
     async def get_chat_from_phone_number(self, number):
         return await self._run_async(
             self._driver.get_chat_from_phone_number, number)
 
     async def reload_qr(self):
-        return await self._run_async(self._driver.reload_qr)
+        return await self._run_exclusive(self._driver.reload_qr)
+
+    async def get_status(self, timeout=5):
+        """
+        Returns the status of the driver without waiting for the running calls, so it can be used as a heartbeat
 
-    async def get_status(self):
-        return await self._run_async(self._driver.get_status)
+        :param timeout: Maximum time to wait for the browser, in seconds
+        :raises TimeoutException: If the browser doesn't answer in time
+        """
+        # Only holds the session for its own commands, between two round trips of the channel
+        try:
+            return await wait_for(self._run_async(self._call_exclusive, self._driver.get_status), timeout)
+        except TimeoutError:
+            raise TimeoutException("get_status timed out")
 
     async def contact_get_common_groups(self, contact_id):
-        groups = await self._run_async(
-            self._driver.contact_get_common_groups(contact_id),
-            contact_id)
+        groups = await self._run_async(list, self._driver.contact_get_common_groups(contact_id))
         for group in groups:
             yield group
 
-    async def chat_send_message(self, chat_id, message):
+    async def contacts_get_common_groups(self, contact_ids):
+        return await self._run_async(self._driver.contacts_get_common_groups, contact_ids)
+
+    async def chat_send_message(self, chat_id, message, wait_ack=None, ack_timeout=30):
         return await self._run_async(self._driver.chat_send_message,
-                                     chat_id=chat_id, message=message)
+                                     chat_id=chat_id, message=message, wait_ack=wait_ack, ack_timeout=ack_timeout,
+                                     call_timeout=self._poll_timeout(ack_timeout) if wait_ack else self.call_timeout)
 
-    async def chat_get_messages(self, chat, include_me=False, include_notifications=False):
-        async for msg_id in self.get_all_message_ids_in_chat(chat,
-                                                             include_me=include_me,
-                                                             include_notifications=include_notifications):
-            yield self.get_message_by_id(msg_id)
+    async def chat_send_media_file(self, chat_id, path, caption=None):
+        return await self._run_async(self._driver.chat_send_media_file, chat_id, path, caption)
+
+    async def send_bulk(self, jobs, rate=1, concurrency=1, timeout=25, max_count=100):
+        results = self._driver.send_bulk(jobs, rate=rate, concurrency=concurrency, timeout=timeout,
+                                         max_count=max_count)
+        try:
+            while True:
+                result = await self._run_async(next, results, None, call_timeout=self._poll_timeout(timeout))
+                if result is None:
+                    break
+                yield result
+        finally:
+            await self._run_async(results.close)
+
+    async def chats_send_seen(self, chat_ids):
+        return await self._run_async(self._driver.chats_send_seen, chat_ids)
+
+    async def chat_get_messages(self, chat, include_me=False, include_notifications=False, page_size=500):
+        """
+        Iterates over the loaded messages of a chat, oldest first, fetching page_size messages in each browser round
+        trip
+
+        :param chat: Chat, or its ID
+        """
+        chat_id = chat if isinstance(chat, string_types) else chat.get_id()
+        async for message in self.iter_chat_messages(chat_id, page_size=page_size, include_me=include_me,
+                                                     include_notifications=include_notifications):
+            yield message
+
+    async def iter_chat_messages(self, chat_id, page_size=500, after_id=None, after_timestamp=None,
+                                 include_me=False, include_notifications=False, profile=SerializationProfile.Full):
+        # Message objects may call the browser when they are created, so they are built in the workers
+        pages = self._driver._iter_message_object_pages(chat_id, page_size, after_id, after_timestamp, include_me,
+                                                        include_notifications, profile)
+        async for message in self._iter_pages(pages):
+            yield message
+
+    async def export_chat_messages(self, chat_id, output, page_size=500, after_id=None, after_timestamp=None,
+                                   include_me=True, include_notifications=False,
+                                   profile=SerializationProfile.Standard):
+        return await self._run_async(self._driver.export_chat_messages, chat_id, output, page_size=page_size,
+                                     after_id=after_id, after_timestamp=after_timestamp, include_me=include_me,
+                                     include_notifications=include_notifications, profile=profile)
 
     async def get_all_message_ids_in_chat(self, chat, include_me=False, include_notifications=False):
         message_ids = await self._run_async(self._driver.get_all_message_ids_in_chat,
@@ -140,6 +382,11 @@ class WhatsAPIDriverAsync:
         return await self._run_async(
             self._driver.async_chat_load_all_earlier_messages, chat_id)
 
+    async def backfill_messages_until_date(self, date, chat_ids=None, concurrency=4, chunk_size=20,
+                                           progress=None):
+        return await self._run_async(self._driver.backfill_messages_until_date, date, chat_ids=chat_ids,
+                                     concurrency=concurrency, chunk_size=chunk_size, progress=progress)
+
     async def are_all_messages_loaded(self, chat_id):
         return await self._run_async(
             self._driver.are_all_messages_loaded, chat_id)
@@ -148,49 +395,158 @@ class WhatsAPIDriverAsync:
         return await self._run_async(self._driver.group_get_participants_ids,
                                      group_id)
 
-    async def group_get_participants(self, group_id):
+    async def group_get_participants(self, group_id, page_size=500):
+        """
+        Iterates over the participants of a group, fetching page_size contacts in each browser round trip
+        """
         participant_ids = await self.group_get_participants_ids(group_id)
-
-        for participant_id in participant_ids:
-            yield await self.get_contact_from_id(participant_id)
+        async for participant in self._iter_pages(self._driver._iter_contact_pages(participant_ids, page_size)):
+            yield participant
 
     async def group_get_admin_ids(self, group_id):
         return await self._run_async(self._driver.group_get_admin_ids,
                                      group_id)
 
-    async def group_get_admins(self, group_id):
+    async def group_get_admins(self, group_id, page_size=500):
         admin_ids = await self.group_get_admin_ids(group_id)
-
-        for admin_id in admin_ids:
-            yield await self.get_contact_from_id(admin_id)
+        async for admin in self._iter_pages(self._driver._iter_contact_pages(admin_ids, page_size)):
+            yield admin
 
     async def download_file(self, url):
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as resp:
-                return await resp.read()
+        try:
+            return await self.media_fetcher.fetch(url)
+        except MediaFetchError as e:
+            logger.warning("%s, downloading through the browser", e)
+            return b64decode(await self._run_async(self._driver.wapi_functions.downloadFile, url))
 
-    async def download_media(self, media_msg):
+    async def download_media(self, media_msg, download_preview=False, sink=None, chunk_size=CHUNK_SIZE):
         try:
-            if media_msg.content:
-                return BytesIO(b64decode(self.content))
+            if media_msg.content and download_preview:
+                return BytesIO(b64decode(media_msg.content))
         except AttributeError:
             pass
 
-        file_data = await self.download_file(media_msg.client_url)
-
-        media_key = b64decode(media_msg.media_key)
-        derivative = HKDFv3().deriveSecrets(media_key,
-                                            binascii.unhexlify(media_msg.crypt_keys[media_msg.type]),
-                                            112)
-
-        parts = ByteUtil.split(derivative, 16, 32)
-        iv = parts[0]
-        cipher_key = parts[1]
-        e_file = file_data[:-10]
+        if self._driver._can_store_media(media_msg):
+            path = await self.get_media_path(media_msg, chunk_size)
+            return await self._run_media(self._driver._copy_stored_media, path, sink)
 
-        cr_obj = Cipher(algorithms.AES(cipher_key), modes.CBC(iv), backend=default_backend())
-        decryptor = cr_obj.decryptor()
-        return BytesIO(decryptor.update(e_file) + decryptor.finalize())
+        if isinstance(sink, string_types):
+            try:
+                with open(sink, 'wb') as f:
+                    await self.download_media(media_msg, sink=f, chunk_size=chunk_size)
+            except Exception:
+                os.remove(sink)
+                raise
+            return sink
+
+        output = BytesIO() if sink is None else sink
+        decryptor = MediaDecryptor(media_msg.media_key, media_msg.type, media_msg.filehash, media_msg.enc_filehash)
+        async for chunk in self.iter_media_chunks(media_msg.client_url, chunk_size):
+            output.write(await self._run_media(decryptor.update, chunk))
+        output.write(await self._run_media(decryptor.finalize))
+
+        if sink is None:
+            output.seek(0)
+        return output
+
+    async def _run_media(self, method, *args):
+        return await self.loop.run_in_executor(self._media_executor, partial(method, *args))
+
+    async def download_media_many(self, media_msgs, sink_for=None, workers=None, progress=None,
+                                  chunk_size=CHUNK_SIZE):
+        media_msgs = list(media_msgs)
+        semaphore = Semaphore(workers or os.cpu_count() or 4)
+
+        async def download(media_msg):
+            async with semaphore:
+                try:
+                    sink = None if sink_for is None else sink_for(media_msg)
+                    return MediaDownload(media_msg,
+                                         await self.download_media(media_msg, sink=sink, chunk_size=chunk_size))
+                except CancelledError:
+                    raise
+                except Exception as e:
+                    return MediaDownload(media_msg, error=e)
+
+        tasks = [self.loop.create_task(download(media_msg)) for media_msg in media_msgs]
+        try:
+            for done, task in enumerate(as_completed(tasks), 1):
+                result = await task
+                if progress is not None:
+                    progress(done, len(tasks), result)
+                yield result
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def _iter_chunks_threadsafe(self, url, chunk_size):
+        # Fetches the chunks on the event loop for a media thread
+        chunks = self.iter_media_chunks(url, chunk_size)
+        try:
+            while True:
+                try:
+                    yield run_coroutine_threadsafe(chunks.__anext__(), self.loop).result()
+                except StopAsyncIteration:
+                    return
+        finally:
+            run_coroutine_threadsafe(chunks.aclose(), self.loop).result()
+
+    def _get_media_path(self, media_msg, chunk_size):
+        # The store writes files synchronously, so it is filled from a media thread
+        media_store = self._driver.media_store
+        path = media_store.get(media_msg.filehash, media_msg.type)
+        if path is None:
+            decryptor = MediaDecryptor(media_msg.media_key, media_msg.type, media_msg.filehash,
+                                       media_msg.enc_filehash)
+            path = media_store.put(media_msg.filehash, media_msg.type, lambda f: write_decrypted(
+                self._iter_chunks_threadsafe(media_msg.client_url, chunk_size), decryptor, f))
+        return path
+
+    async def get_media_path(self, media_msg, chunk_size=CHUNK_SIZE):
+        if self._driver.media_store is None:
+            raise WhatsAPIException("No media store configured")
+        if media_msg.filehash is None:
+            raise WhatsAPIException("Message {0} has no filehash".format(media_msg.id))
+
+        return await self._run_media(self._get_media_path, media_msg, chunk_size)
+
+    async def open_media(self, media_msg):
+        # Downloaded again once if it is evicted before it is opened, as in WhatsAPIDriver.open_media
+        for _ in range(2):
+            await self.get_media_path(media_msg)
+            media = await self._run_media(self._driver.media_store.open, media_msg.filehash, media_msg.type)
+            if media is not None:
+                return media
+
+        raise WhatsAPIException("Media of message {0} was evicted from the store before it could be opened".format(
+            media_msg.id))
+
+    @property
+    def media_store(self):
+        return self._driver.media_store
+
+    async def iter_media_chunks(self, url, chunk_size=CHUNK_SIZE):
+        received = False
+        try:
+            async for chunk in self.media_fetcher.iter_chunks(url, chunk_size):
+                received = True
+                yield chunk
+            return
+        except MediaFetchError as e:
+            if received:
+                raise
+            logger.warning("%s, downloading through the browser", e)
+
+        chunks = self._driver.iter_download_file(url, chunk_size)
+        while True:
+            chunk = await self._run_async(next, chunks, None)
+            if chunk is None:
+                break
+            yield chunk
 
     async def quit(self):
-        return await self._run_async(self._driver.quit)
+        await self.media_fetcher.close()
+        self._media_executor.shutdown(wait=False)
+        # The dispatcher must not poll a session being torn down
+        await self.loop.run_in_executor(self._pool_executor, self._driver.wapi_functions.close)
+        return await self._run_exclusive(self._driver.quit)
@@ -0,0 +1,78 @@
+"""
+Asyncio helpers to download media files
+"""
+
+import asyncio
+
+import aiohttp
+
+from .media import CHUNK_SIZE, MediaFetchError
+
+
+class AsyncMediaFetcher(object):
+    """
+    Asyncio version of MediaFetcher, all downloads share one aiohttp session
+    """
+
+    def __init__(self, max_connections=8, timeout=60):
+        """
+        Constructor
+
+        :param max_connections: Maximum number of concurrent downloads
+        :type max_connections: int
+        :param timeout: Connect and read timeout, in seconds
+        """
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self._semaphore = None
+        self._session = None
+
+    def _get_session(self):
+        # The session has to be created from a coroutine, so it is done on first use
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.max_connections)
+            self._session = aiohttp.ClientSession(connector=connector,
+                                                  timeout=aiohttp.ClientTimeout(sock_connect=self.timeout,
+                                                                                sock_read=self.timeout))
+        return self._session
+
+    def _get_semaphore(self):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_connections)
+        return self._semaphore
+
+    async def iter_chunks(self, url, chunk_size=CHUNK_SIZE):
+        """
+        Downloads a file and yields it in chunks
+
+        :param url: URL of the file
+        :param chunk_size: Size of the chunks
+        :type chunk_size: int
+        :raises MediaFetchError: If the file could not be downloaded
+        """
+        async with self._get_semaphore():
+            try:
+                async with self._get_session().get(url) as resp:
+                    if resp.status >= 400:
+                        raise MediaFetchError("Could not download {0} (HTTP {1})".format(url, resp.status))
+
+                    async for chunk in resp.content.iter_chunked(chunk_size):
+                        yield chunk
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                raise MediaFetchError("Could not download {0} ({1})".format(url, e))
+
+    async def fetch(self, url):
+        """
+        Downloads a file
+
+        :param url: URL of the file
+        :return: Content of the file
+        :rtype: bytes
+        :raises MediaFetchError: If the file could not be downloaded
+        """
+        return b''.join([chunk async for chunk in self.iter_chunks(url)])
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
@@ -0,0 +1,93 @@
+import time
+from collections import OrderedDict
+from threading import Lock
+
+
+class ObjectCache(object):
+    """
+    Bounded in-process cache with LRU eviction and per entry TTL
+
+    Used by WhatsAPIDriver to keep Contact and Chat objects between calls
+    """
+
+    def __init__(self, max_size=1024, ttl=300):
+        """
+        Constructor
+
+        :param max_size: Maximum number of entries. 0 disables the cache
+        :type max_size: int
+        :param ttl: Seconds an entry is valid for. None keeps entries until they are evicted or invalidated
+        :type ttl: float or None
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        # Does not count as a hit or a miss, nor refresh the entry
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry is not None and (entry[1] is None or entry[1] >= time.monotonic())
+
+    def get(self, key, default=None):
+        """
+        Returns the cached value for key, or default if it is missing or expired
+        """
+        with self._lock:
+            try:
+                value, expires_at = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return default
+
+            if expires_at is not None and expires_at < time.monotonic():
+                del self._entries[key]
+                self.misses += 1
+                return default
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        if not self.max_size:
+            return
+
+        expires_at = None if self.ttl is None else time.monotonic() + self.ttl
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def get_stats(self):
+        """
+        Returns cache statistics
+
+        :return: Size, hits, misses and evictions
+        :rtype: dict
+        """
+        return {
+            'size': len(self._entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
@@ -80,7 +80,9 @@ if (!window.Store) {
 
 
 window.WAPI = {
-    lastRead: {}
+    lastRead: {},
+    // State that has to survive a new injection of this script in the same page (indexes, listeners...)
+    _persistent: (window.WAPI && window.WAPI._persistent) || {}
 };
 
 
@@ -109,6 +111,250 @@ window.WAPI.GetWap = function(){
 };
 
 
+/**
+ * Creates an index of the models of a Store collection by serialized ID
+ *
+ * The index is kept up to date through the add, remove and reset events of the collection.
+ * IDs missing from the index are looked up with the collection's own get() and indexed.
+ *
+ * @param collection Store collection
+ * @param getModels Function returning the models of the collection
+ * @returns {{get: function(string), size: function()}}
+ * @private
+ */
+window.WAPI._createModelIndex = function (collection, getModels) {
+    const index = new Map();
+
+    const add = (model) => {
+        if (model && model.id) {
+            index.set(model.id._serialized, model);
+        }
+    };
+    const remove = (model) => {
+        if (model && model.id) {
+            index.delete(model.id._serialized);
+        }
+    };
+    const rebuild = () => {
+        index.clear();
+        getModels().forEach(add);
+    };
+
+    rebuild();
+    if (collection && typeof collection.on === 'function') {
+        collection.on('add', add);
+        collection.on('remove', remove);
+        collection.on('reset', rebuild);
+    }
+
+    return {
+        get: function (id) {
+            let found = index.get(id);
+            if (found === undefined && collection && typeof collection.get === 'function') {
+                try {
+                    found = collection.get(id) || undefined;
+                } catch (err) {
+                    found = undefined;
+                }
+                add(found);
+            }
+            return found;
+        },
+        size: () => index.size
+    };
+};
+
+/**
+ * Gets the index of a Store collection, creating it on first use
+ *
+ * @param name Name of the collection in Store
+ * @param getModels Optional function returning the models of the collection
+ * @returns {{get: function(string), size: function()}}
+ * @private
+ */
+window.WAPI._getModelIndex = function (name, getModels) {
+    const indexes = window.WAPI._persistent.indexes || (window.WAPI._persistent.indexes = {});
+    if (indexes[name] === undefined) {
+        const collection = window.Store[name];
+        indexes[name] = window.WAPI._createModelIndex(
+            collection, getModels || (() => collection.models)
+        );
+    }
+    return indexes[name];
+};
+
+/**
+ * Creates a bounded queue of page events that Python drains with a long poll
+ *
+ * When the queue is full the oldest events are dropped and counted.
+ *
+ * @param maxSize Maximum number of buffered events
+ * @private
+ */
+window.WAPI._createEventQueue = function (maxSize) {
+    return {
+        items: [],
+        maxSize: maxSize,
+        dropped: 0,
+        waiters: [],
+
+        push: function (item) {
+            this.items.push(item);
+            if (this.items.length > this.maxSize) {
+                this.dropped += this.items.length - this.maxSize;
+                this.items.splice(0, this.items.length - this.maxSize);
+            }
+            const waiters = this.waiters;
+            this.waiters = [];
+            waiters.forEach((wake) => wake());
+        },
+
+        drain: function (maxCount) {
+            const dropped = this.dropped;
+            this.dropped = 0;
+            return {
+                items: this.items.splice(0, maxCount || this.items.length),
+                dropped: dropped
+            };
+        },
+
+        clear: function () {
+            this.items = [];
+            this.dropped = 0;
+        },
+
+        /**
+         * Resolves as soon as there are events in the queue or after timeoutMs
+         */
+        wait: function (timeoutMs) {
+            if (this.items.length > 0) {
+                return Promise.resolve();
+            }
+            return new Promise((resolve) => {
+                const wake = () => {
+                    clearTimeout(timer);
+                    resolve();
+                };
+                const timer = setTimeout(() => {
+                    this.waiters = this.waiters.filter((waiter) => waiter !== wake);
+                    resolve();
+                }, timeoutMs);
+                this.waiters.push(wake);
+            });
+        }
+    };
+};
+
+/**
+ * Creates a change tracker for a Store collection
+ *
+ * Every add, change or remove of a model gets a new sequence number, so the models changed since a given
+ * sequence number can be listed without walking the whole collection.
+ *
+ * @param collection Store collection
+ * @param getModels Function returning the models of the collection
+ * @private
+ */
+window.WAPI._createChangeTracker = function (collection, getModels) {
+    const tracker = {
+        // Identifies this tracker, cursors from another page load are not valid
+        epoch: Date.now().toString(36) + Math.random().toString(36).slice(2, 8),
+        seq: 0,
+        // id -> {seq, model}, model is null when it was removed
+        latest: new Map(),
+        // [seq, id] in increasing seq order, compacted when it gets too long
+        log: [],
+
+        touch: function (model, removed) {
+            if (!model || !model.id) {
+                return;
+            }
+            const id = model.id._serialized;
+            this.seq += 1;
+            this.latest.set(id, {seq: this.seq, model: removed ? null : model});
+            this.log.push([this.seq, id]);
+
+            if (this.log.length > 2 * this.latest.size + 100) {
+                this.log = Array.from(this.latest.entries())
+                    .map(([id, change]) => [change.seq, id])
+                    .sort((a, b) => a[0] - b[0]);
+            }
+        },
+
+        /**
+         * Lists models changed and IDs removed after seq
+         */
+        since: function (seq) {
+            const changed = [];
+            const removed = [];
+            for (let i = this.log.length - 1; i >= 0 && this.log[i][0] > seq; i--) {
+                const [changeSeq, id] = this.log[i];
+                const change = this.latest.get(id);
+                if (change.seq !== changeSeq) {
+                    // Superseded by a later change
+                    continue;
+                }
+                if (change.model === null) {
+                    removed.push(id);
+                } else {
+                    changed.push(change.model);
+                }
+            }
+            return {changed: changed.reverse(), removed: removed.reverse()};
+        }
+    };
+
+    collection.on('add', (model) => tracker.touch(model, false));
+    collection.on('change', (model) => tracker.touch(model, false));
+    collection.on('remove', (model) => tracker.touch(model, true));
+    collection.on('reset', () => getModels().forEach((model) => tracker.touch(model, false)));
+
+    return tracker;
+};
+
+/**
+ * Lists the models of a Store collection changed since a cursor
+ *
+ * @param name Name of the collection in Store
+ * @param cursor Cursor returned by a previous call, or null to get every model
+ * @param snapshot When the cursor is unknown, whether to return every model or only a new cursor
+ * @param serialize Function serializing a model
+ * @returns {{cursor: string, full: boolean, changed: Array, removed: Array}}
+ * @private
+ */
+window.WAPI._getDelta = function (name, cursor, snapshot, serialize) {
+    const trackers = window.WAPI._persistent.trackers || (window.WAPI._persistent.trackers = {});
+    const collection = window.Store[name];
+    if (trackers[name] === undefined) {
+        trackers[name] = window.WAPI._createChangeTracker(collection, () => collection.models);
+    }
+    const tracker = trackers[name];
+
+    let changes;
+    let full = false;
+    const parts = typeof cursor === 'string' ? cursor.split(':') : [];
+    if (parts.length === 2 && parts[0] === tracker.epoch) {
+        changes = tracker.since(parseInt(parts[1], 10));
+    } else {
+        // Unknown or outdated cursor
+        full = true;
+        changes = {changed: snapshot ? collection.models.slice() : [], removed: []};
+    }
+
+    return {
+        cursor: tracker.epoch + ':' + tracker.seq,
+        full: full,
+        changed: changes.changed.map(serialize),
+        removed: changes.removed
+    };
+};
+
+window.WAPI._getChatModel = (id) => window.WAPI._getModelIndex("Chat", window.WAPI.getChatModels).get(id);
+
+window.WAPI._getContactModel = (id) => window.WAPI._getModelIndex("Contact").get(id);
+
+window.WAPI._getGroupMetadataModel = (id) => window.WAPI._getModelIndex("GroupMetadata").get(id);
+
 window.WAPI._serializeRawObj = (obj) => {
     if (obj) {
         return obj.toJSON();
@@ -116,19 +362,76 @@ window.WAPI._serializeRawObj = (obj) => {
     return {}
 };
 
+/**
+ * Serialization profiles, from the lightest to the most complete
+ *
+ * minimal: only the fields the python objects are built from, related chats and contacts are referenced by ID
+ * standard: full raw object, with the sender contact reduced to its names and without copies of the chat
+ * full: full raw object with every related object fully serialized
+ */
+window.WAPI.PROFILE_MINIMAL = "minimal";
+window.WAPI.PROFILE_STANDARD = "standard";
+window.WAPI.PROFILE_FULL = "full";
+
+/**
+ * Summarizes the participants of a group chat, so group objects can be described without fetching them
+ *
+ * @returns {{participantCount: (number|null), adminIds: Array}} participantCount is null while the participants are
+ *          not loaded, groups always have at least one participant
+ * @private
+ */
+window.WAPI._serializeGroupMembers = (obj) => {
+    const participants = obj.groupMetadata ? obj.groupMetadata.participants : null;
+    const models = participants ? participants.models || participants : [];
+    if (models.length === 0) {
+        return {participantCount: null, adminIds: []};
+    }
+
+    return {
+        participantCount: models.length,
+        adminIds: models.filter((participant) => participant.isAdmin).map((admin) => admin.id._serialized)
+    };
+};
+
 /**
  * Serializes a chat object
  *
  * @param obj Raw Chat object
+ * @param profile Serialization profile, full by default
  * @returns {{}}
  */
-
-window.WAPI._serializeChatObj = (obj) => {
+window.WAPI._serializeChatObj = (obj, profile) => {
     if (obj == null) {
         return null;
     }
 
-    return Object.assign(window.WAPI._serializeRawObj(obj), {
+    const members = obj.isGroup ? window.WAPI._serializeGroupMembers(obj) : {};
+
+    if (profile === WAPI.PROFILE_MINIMAL) {
+        return Object.assign({
+            id: obj.id._serialized,
+            name: obj.name,
+            kind: obj.kind,
+            isGroup: obj.isGroup,
+            t: obj.t,
+            unreadCount: obj.unreadCount,
+            archive: obj.archive,
+            pin: obj.pin
+        }, members);
+    }
+
+    if (profile === WAPI.PROFILE_STANDARD) {
+        return Object.assign(window.WAPI._serializeRawObj(obj), members, {
+            kind: obj.kind,
+            isGroup: obj.isGroup,
+            contact: obj['contact']? window.WAPI._serializeContactObj(obj['contact'], profile): null,
+            groupMetadata: obj["groupMetadata"]? window.WAPI._serializeRawObj(obj["groupMetadata"]): null,
+            presence: null,
+            msgs: null
+        });
+    }
+
+    return Object.assign(window.WAPI._serializeRawObj(obj), members, {
         kind: obj.kind,
         isGroup: obj.isGroup,
         contact: obj['contact']? window.WAPI._serializeContactObj(obj['contact']): null,
@@ -138,11 +441,23 @@ window.WAPI._serializeChatObj = (obj) => {
     });
 };
 
-window.WAPI._serializeContactObj = (obj) => {
+window.WAPI._serializeContactObj = (obj, profile) => {
     if (obj == null) {
         return null;
     }
 
+    if (profile === WAPI.PROFILE_MINIMAL || profile === WAPI.PROFILE_STANDARD) {
+        return {
+            id: obj.id._serialized,
+            name: obj.name,
+            shortName: obj.shortName,
+            pushname: obj.pushname,
+            formattedName: obj.formattedName,
+            isMe: obj.isMe,
+            isMyContact: obj.isMyContact
+        };
+    }
+
     return Object.assign(window.WAPI._serializeRawObj(obj), {
         formattedName: obj.formattedName,
         isHighLevelVerified: obj.__x_isHighLevelVerified,
@@ -174,7 +489,7 @@ window.WAPI._serializeQuotedMessage = (obj) => {
     }
 };
 
-window.WAPI._serializeMessageObj = (obj) => {
+window.WAPI._serializeMessageObj = (obj, profile) => {
     if (obj == null) {
         return null;
     }
@@ -183,6 +498,73 @@ window.WAPI._serializeMessageObj = (obj) => {
         return null;
     }
 
+    if (profile === WAPI.PROFILE_MINIMAL) {
+        const message = {
+            id: obj.id._serialized,
+            wsp_mid: obj.id.id,
+            sender: null,
+            senderId: obj["senderObj"]? obj["senderObj"].id._serialized: null,
+            timestamp: obj["t"],
+            content: obj["body"],
+            text: "caption" in obj?obj["caption"]: obj["body"],
+            ack: obj.ack,
+            isGroupMsg: obj.isGroupMsg,
+            isLink: obj.isLink,
+            isMMS: obj.isMMS,
+            isMedia: obj.isMedia,
+            isNotification: obj.isNotification,
+            isPSA: obj.isPSA,
+            type: obj.type,
+            subtype: obj.subtype,
+            chatId: obj.id.remote,
+            quotedMsgObj: WAPI._serializeQuotedMessage(obj),
+            lat: obj.lat,
+            lng: obj.lng,
+            recipients: obj.recipients ? obj.recipients.map((recipient) => recipient._serialized || recipient) : null
+        };
+        if (obj.isMedia || obj.isMMS) {
+            Object.assign(message, {
+                size: obj.size,
+                mimetype: obj.mimetype,
+                mediaKey: obj.mediaKey,
+                clientUrl: obj.clientUrl,
+                filehash: obj.filehash,
+                encFilehash: obj.encFilehash
+            });
+        }
+        if (obj.type === "multi_vcard") {
+            message.vcardList = obj.vcardList;
+        }
+        // Python reads some of these keys unconditionally
+        Object.keys(message).forEach((key) => {
+            if (message[key] === undefined) {
+                message[key] = null;
+            }
+        });
+        return message;
+    }
+
+    if (profile === WAPI.PROFILE_STANDARD) {
+        return Object.assign(window.WAPI._serializeRawObj(obj), {
+            id: obj.id._serialized,
+            wsp_mid: obj.id.id,
+            sender: obj["senderObj"]?WAPI._serializeContactObj(obj["senderObj"], profile): null,
+            timestamp: obj["t"],
+            content: obj["body"],
+            text: "caption" in obj?obj["caption"]: obj["body"],
+            isGroupMsg: obj.isGroupMsg,
+            isLink: obj.isLink,
+            isMMS: obj.isMMS,
+            isMedia: obj.isMedia,
+            isNotification: obj.isNotification,
+            isPSA: obj.isPSA,
+            type: obj.type,
+            chat: null,
+            chatId: obj.id.remote,
+            quotedMsgObj: WAPI._serializeQuotedMessage(obj)
+        });
+    }
+
     return Object.assign(window.WAPI._serializeRawObj(obj), {
         id: obj.id._serialized,
         wsp_mid: obj.id.id,
@@ -244,9 +626,7 @@ window.WAPI.getMyContacts = function (done) {
  * @returns {T|*} Contact object
  */
 window.WAPI.getContact = function (id, done) {
-    const found = Store.Contact.models.find(
-        (contact) => contact.id._serialized === id
-    );
+    const found = window.WAPI._getContactModel(id);
 
     if (done !== undefined) {
         done(window.WAPI._serializeContactObj(found));
@@ -255,6 +635,22 @@ window.WAPI.getContact = function (id, done) {
     }
 };
 
+/**
+ * Fetches several contact objects from store by ID
+ *
+ * @param ids IDs of the contacts
+ * @param done Optional callback function for async execution
+ * @returns {Array} Contact objects in the same order as the IDs, null for the contacts not found
+ */
+window.WAPI.getContactsByIds = function (ids, done) {
+    const contacts = ids.map((id) => window.WAPI._serializeContactObj(window.WAPI._getContactModel(id)));
+
+    if (done !== undefined) {
+        done(contacts);
+    }
+    return contacts;
+};
+
 /**
  * Fetches all chat objects from store
  *
@@ -289,6 +685,40 @@ window.WAPI.getAllChatIds = function (done) {
     }
 };
 
+/**
+ * Fetches chats added, changed or removed since a cursor
+ *
+ * @param cursor Cursor returned by a previous call, or null to get all chats
+ * @param snapshot When the cursor is unknown, whether to return all chats or only a new cursor
+ * @param done Optional callback function for async execution
+ * @returns {{cursor: string, full: boolean, changed: Array, removed: Array}}
+ */
+window.WAPI.getChatsDelta = function (cursor, snapshot, done) {
+    const delta = window.WAPI._getDelta("Chat", cursor, snapshot, (chat) => WAPI._serializeChatObj(chat));
+
+    if (done !== undefined) {
+        done(delta);
+    }
+    return delta;
+};
+
+/**
+ * Fetches contacts added, changed or removed since a cursor
+ *
+ * @param cursor Cursor returned by a previous call, or null to get all contacts
+ * @param snapshot When the cursor is unknown, whether to return all contacts or only a new cursor
+ * @param done Optional callback function for async execution
+ * @returns {{cursor: string, full: boolean, changed: Array, removed: Array}}
+ */
+window.WAPI.getContactsDelta = function (cursor, snapshot, done) {
+    const delta = window.WAPI._getDelta("Contact", cursor, snapshot, (contact) => WAPI._serializeContactObj(contact));
+
+    if (done !== undefined) {
+        done(delta);
+    }
+    return delta;
+};
+
 /**
  * Fetches all groups objects from store
  *
@@ -313,9 +743,7 @@ window.WAPI.getAllGroups = function (done) {
  * @returns {T|*} Chat object
  */
 window.WAPI.getChat = function (id, done) {
-    const found = window.WAPI.getChatModels().find(
-        (chat) => chat.id._serialized === id
-    );
+    const found = window.WAPI._getChatModel(id);
     if (done !== undefined) {
         done(found);
     } else {
@@ -338,6 +766,25 @@ window.WAPI.getChatById = function (id, done) {
     }
 };
 
+/**
+ * Fetches several chat objects from store by ID
+ *
+ * @param ids IDs of the chats
+ * @param done Optional callback function for async execution
+ * @returns {Array} Chat objects in the same order as the IDs, null for the chats not found
+ */
+window.WAPI.getChatsByIds = function (ids, done) {
+    const chats = ids.map((id) => {
+        const found = window.WAPI._getChatModel(id);
+        return found ? WAPI._serializeChatObj(found) : null;
+    });
+
+    if (done !== undefined) {
+        done(chats);
+    }
+    return chats;
+};
+
 window.WAPI.existsChatId = function(id, done){
     let found = window.WAPI.getChat(id);
     if (found) {
@@ -362,9 +809,7 @@ window.WAPI.existsChatId = function(id, done){
  * @returns None
  */
 window.WAPI.loadEarlierMessages = function (id, done) {
-    const found = window.WAPI.getChatModels().find(
-        (chat) => chat.id._serialized === id
-    );
+    const found = window.WAPI.getChat(id);
     if (done !== undefined) {
         found.loadEarlierMsgs().then(function(){done()});
     } else {
@@ -381,17 +826,15 @@ window.WAPI.loadEarlierMessages = function (id, done) {
  */
 
 window.WAPI.loadAllEarlierMessages = function (id, done) {
-    const found = window.WAPI.getChatModels().find(
-        (chat) => chat.id._serialized === id
-    );
-    x = function(){
+    const found = window.WAPI.getChat(id);
+    const loadNext = function(){
         if (!found.msgs.msgLoadState.__x_noEarlierMsgs){
-            found.loadEarlierMsgs().then(x);
+            found.loadEarlierMsgs().then(loadNext);
         } else if (done) {
             done();
         }
     };
-    x();
+    loadNext();
 };
 
 window.WAPI.asyncLoadAllEarlierMessages = function (id, done) {
@@ -400,9 +843,7 @@ window.WAPI.asyncLoadAllEarlierMessages = function (id, done) {
 };
 
 window.WAPI.areAllMessagesLoaded = function (id, done) {
-    const found = window.WAPI.getChatModels().find(
-        (chat) => chat.id._serialized === id
-    );
+    const found = window.WAPI.getChat(id);
     if (!found.msgs.msgLoadState.__x_noEarlierMsgs) {
         if (done) {
             done(false);
@@ -417,52 +858,146 @@ window.WAPI.areAllMessagesLoaded = function (id, done) {
     }
 };
 
+/**
+ * Loads earlier messages of a chat until a message older than lastMessage is loaded
+ *
+ * @param chat Raw Chat object
+ * @param lastMessage UTC timestamp of last message to be loaded
+ * @returns {Promise.<string>} Yields "reached" when lastMessage was reached, "exhausted" when the chat has no
+ *          earlier messages, "empty" when no message is loaded in the chat or "stalled" when loads stop
+ *          bringing messages
+ * @private
+ */
+window.WAPI._loadChatTillDate = async function (chat, lastMessage) {
+    let stalls = 0;
+
+    while (true) {
+        const models = chat.msgs.models;
+        if (models.length == null || models.length === 0) {
+            return "empty";
+        }
+        if (models[0].t <= lastMessage) {
+            return "reached";
+        }
+        if (chat.msgs.msgLoadState.__x_noEarlierMsgs) {
+            return "exhausted";
+        }
+
+        const oldest = models[0];
+        await chat.loadEarlierMsgs();
+        if (chat.msgs.models[0] === oldest) {
+            stalls += 1;
+            if (stalls >= 3) {
+                return "stalled";
+            }
+        } else {
+            stalls = 0;
+        }
+    }
+};
+
+/**
+ * Runs an async worker over items with at most concurrency workers running at the same time
+ *
+ * @param items Items to process
+ * @param concurrency Maximum number of items processed at the same time
+ * @param worker Async function called with each item
+ * @returns {Promise.<Array>} Yields the result of the worker for each item, in order
+ * @private
+ */
+window.WAPI._runWithConcurrency = async function (items, concurrency, worker) {
+    const results = new Array(items.length);
+    let next = 0;
+
+    const run = async () => {
+        while (next < items.length) {
+            const index = next++;
+            results[index] = await worker(items[index]);
+        }
+    };
+
+    const runners = [];
+    for (let i = 0; i < Math.min(Math.max(concurrency, 1), items.length); i++) {
+        runners.push(run());
+    }
+    await Promise.all(runners);
+    return results;
+};
+
 /**
  * Load more messages in chat object from store by ID till a particular date
  *
  * @param id ID of chat
  * @param lastMessage UTC timestamp of last message to be loaded
  * @param done Optional callback function for async execution
- * @returns None
+ * @returns None, or {error} if the chat doesn't exist or the messages couldn't be loaded
  */
 
 window.WAPI.loadEarlierMessagesTillDate = function (id, lastMessage, done) {
-    const found = window.WAPI.getChatModels().find(
-        (chat) => chat.id._serialized === id
-    );
-    x = function(){
-        const models = found.msgs.models;
-        if(models.length == null || models.length === 0){
-            done()
-        }
-        else if(models[0].t>lastMessage){
-            found.loadEarlierMsgs().then(x);
-        }else {
+    const found = window.WAPI.getChat(id);
+    const loaded = found === undefined
+        ? Promise.reject(new Error("Chat " + id + " not found"))
+        : window.WAPI._loadChatTillDate(found, lastMessage);
+    loaded.then(() => {
+        if (done !== undefined) {
             done();
         }
-    };
-    x();
+    }).catch((err) => {
+        if (done !== undefined) {
+            done({error: String(err)});
+        }
+    });
+};
+
+/**
+ * Load more messages in several chats till a particular date, loading at most concurrency chats at a time
+ *
+ * @param ids IDs of the chats
+ * @param lastMessage UTC timestamp of last message to be loaded
+ * @param concurrency Maximum number of chats loading at the same time
+ * @param done Optional callback function for async execution
+ * @returns {Promise.<Array>} Yields {id, status, oldest} for each chat, in order.
+ *          status is one of the _loadChatTillDate results, "not_found" or "error"
+ */
+window.WAPI.loadEarlierMessagesTillDateChats = async function (ids, lastMessage, concurrency, done) {
+    const output = await window.WAPI._runWithConcurrency(ids, concurrency, async (id) => {
+        let chat;
+        let status;
+        try {
+            chat = window.WAPI.getChat(id);
+            if (chat === undefined) {
+                return {id: id, status: "not_found", oldest: null};
+            }
+            status = await window.WAPI._loadChatTillDate(chat, lastMessage);
+        } catch (err) {
+            status = "error";
+        }
+        const oldest = chat !== undefined ? chat.msgs.models[0] : undefined;
+        return {id: id, status: status, oldest: oldest !== undefined ? oldest.t : null};
+    });
+
+    if (done !== undefined) {
+        done(output);
+    }
+    return output;
 };
 
 /**
  * Load more messages in all chats from store till a particular date
  * @param lastMessage
+ * @param concurrency Optional maximum number of chats loading at the same time
  * @param done
+ * @returns {Promise.<Array>} Yields {id, status, oldest} for each chat
  */
-window.WAPI.loadEarlierMessagesTillDateAllChats = function (lastMessage, done) {
-    const chats = window.WAPI.getChatModels();
-
-    for (let chat in chats) {
-        if (isNaN(chat)) {
-            continue;
-        }
-        const currentChat = chats[chat];
-        const id = currentChat.id._serialized;
-        window.WAPI.loadEarlierMessagesTillDate(
-            id, lastMessage, () => {}
-        );
+window.WAPI.loadEarlierMessagesTillDateAllChats = function (lastMessage, concurrency, done) {
+    if (typeof concurrency === 'function') {
+        // Called as (lastMessage, done)
+        done = concurrency;
+        concurrency = 1;
     }
-    done();
+    const ids = window.WAPI.getChatModels().map((chat) => chat.id._serialized);
+
+    return window.WAPI.loadEarlierMessagesTillDateChats(ids, lastMessage, concurrency, done);
 };
 
 
@@ -492,9 +1027,7 @@ window.WAPI.getAllGroupMetadata = function (done) {
  * @returns {T|*} Group metadata object
  */
 window.WAPI.getGroupMetadata = async function (id, done) {
-    let output = Store.GroupMetadata.models.find(
-        (groupData) => groupData.id._serialized === id
-    );
+    let output = window.WAPI._getGroupMetadataModel(id);
 
     if (output !== undefined) {
         output = output.toJSON()
@@ -548,6 +1081,100 @@ window.WAPI.getGroupAdmins = async function (id, done) {
     return output;
 };
 
+/**
+ * Lists the participant IDs of a group metadata model
+ *
+ * @private
+ */
+window.WAPI._getParticipantIds = function (metadata) {
+    const participants = metadata.participants;
+    if (!participants) {
+        return [];
+    }
+    return (participants.models || participants).map((participant) => participant.id._serialized);
+};
+
+/**
+ * Gets the member -> groups index of Store.GroupMetadata, creating it on first use
+ *
+ * The index follows groups being added or removed and participants joining or leaving, so common groups of a
+ * contact are found without walking every group.
+ *
+ * @returns {{groupsOf: function(string): Array}}
+ * @private
+ */
+window.WAPI._getGroupMembership = function () {
+    const state = window.WAPI._persistent;
+    if (state.groupMembership) {
+        return state.groupMembership;
+    }
+
+    // member id -> Set of group ids, and group id -> Array of member ids to undo an entry
+    const groupsByMember = new Map();
+    const membersByGroup = new Map();
+    const watched = new WeakSet();
+
+    const unindex = (groupId) => {
+        (membersByGroup.get(groupId) || []).forEach((memberId) => {
+            const groups = groupsByMember.get(memberId);
+            groups.delete(groupId);
+            if (groups.size === 0) {
+                groupsByMember.delete(memberId);
+            }
+        });
+        membersByGroup.delete(groupId);
+    };
+
+    const index = (metadata) => {
+        if (!metadata || !metadata.id) {
+            return;
+        }
+        const groupId = metadata.id._serialized;
+        unindex(groupId);
+
+        const memberIds = window.WAPI._getParticipantIds(metadata);
+        memberIds.forEach((memberId) => {
+            let groups = groupsByMember.get(memberId);
+            if (groups === undefined) {
+                groupsByMember.set(memberId, groups = new Set());
+            }
+            groups.add(groupId);
+        });
+        membersByGroup.set(groupId, memberIds);
+
+        const participants = metadata.participants;
+        if (participants && typeof participants.on === 'function' && !watched.has(participants)) {
+            watched.add(participants);
+            const update = () => {
+                // The group may have been removed, or the collection replaced by a newer one since
+                if (membersByGroup.has(groupId) && metadata.participants === participants) {
+                    index(metadata);
+                }
+            };
+            participants.on('add', update);
+            participants.on('remove', update);
+            participants.on('reset', update);
+        }
+    };
+
+    const rebuild = () => {
+        groupsByMember.clear();
+        membersByGroup.clear();
+        Store.GroupMetadata.models.forEach(index);
+    };
+
+    rebuild();
+    Store.GroupMetadata.on('add', index);
+    Store.GroupMetadata.on('change', index);
+    Store.GroupMetadata.on('remove', (metadata) => metadata && metadata.id && unindex(metadata.id._serialized));
+    Store.GroupMetadata.on('reset', rebuild);
+
+    state.groupMembership = {
+        groupsOf: (memberId) => Array.from(groupsByMember.get(memberId) || [])
+    };
+    return state.groupMembership;
+};
+
 /**
  * Gets object representing the logged in user
  *
@@ -566,20 +1193,20 @@ window.WAPI.getMe = function (done) {
     return rawMe.toJSON();
 };
 
-window.WAPI.processMessageObj = function (messageObj, includeMe, includeNotifications) {
+window.WAPI.processMessageObj = function (messageObj, includeMe, includeNotifications, profile) {
     if (messageObj.isNotification) {
         if(includeNotifications)
-            return WAPI._serializeMessageObj(messageObj);
+            return WAPI._serializeMessageObj(messageObj, profile);
         else return;
         // System message
         // (i.e. "Messages you send to this chat and calls are now secured with end-to-end encryption...")
     } else if (messageObj.id.fromMe === false || includeMe) {
-        return WAPI._serializeMessageObj(messageObj);
+        return WAPI._serializeMessageObj(messageObj, profile);
     }
     return;
 };
 
-window.WAPI.getAllMessagesInChat = function (id, includeMe, includeNotifications, done) {
+window.WAPI.getAllMessagesInChat = function (id, includeMe, includeNotifications, profile, done) {
     const chat = WAPI.getChat(id);
     let output = [];
     const messages = chat.msgs.models;
@@ -589,7 +1216,7 @@ window.WAPI.getAllMessagesInChat = function (id, includeMe, includeNotifications
         }
         const messageObj = messages[i];
 
-        let message = WAPI.processMessageObj(messageObj, includeMe, includeNotifications)
+        let message = WAPI.processMessageObj(messageObj, includeMe, includeNotifications, profile)
         if (message)output.push(message);
     }
     if (done !== undefined) {
@@ -599,24 +1226,116 @@ window.WAPI.getAllMessagesInChat = function (id, includeMe, includeNotifications
     }
 };
 
-window.WAPI.getAllMessageIdsInChat = function (id, includeMe, includeNotifications, done) {
-    const chat = WAPI.getChat(id);
-    let output = [];
-    const messages = chat.msgs.models;
-    for (const i in messages) {
-        if ((i === "remove")
-            || (!includeMe && messages[i].isMe)
-            || (!includeNotifications && messages[i].isNotification)) {
-            continue;
-        }
-        output.push(messages[i].id._serialized);
-    }
-    if (done !== undefined) {
-        done(output);
-    } else {
-        return output;
+/**
+ * Finds where a page of messages starts
+ *
+ * @param models Messages of a chat, oldest first
+ * @param cursor {index, id, t} returned by getMessagesPage, {id} to start after a message,
+ *               {t} to start after a timestamp, or null to start from the oldest message
+ * @returns {number} Index of the first message of the page, or -1 if only the cursor id is known and it is not loaded
+ * @private
+ */
+window.WAPI._findPageStart = function (models, cursor) {
+    if (cursor == null) {
+        return 0;
     }
-};
+
+    if (cursor.id != null) {
+        // Fast path: nothing was loaded before the cursor since the previous page
+        const previous = models[cursor.index - 1];
+        if (previous !== undefined && previous.id._serialized === cursor.id) {
+            return cursor.index;
+        }
+        for (let i = models.length - 1; i >= 0; i--) {
+            if (models[i].id._serialized === cursor.id) {
+                return i + 1;
+            }
+        }
+    }
+
+    if (cursor.t != null) {
+        // Messages are sorted by timestamp
+        let low = 0;
+        let high = models.length;
+        while (low < high) {
+            const middle = (low + high) >> 1;
+            if (models[middle].t <= cursor.t) {
+                low = middle + 1;
+            } else {
+                high = middle;
+            }
+        }
+        return low;
+    }
+
+    return cursor.id != null ? -1 : 0;
+};
+
+/**
+ * Fetches a page of the loaded messages of a chat, oldest first
+ *
+ * @param id ID of chat
+ * @param cursor Where the page starts, see _findPageStart
+ * @param pageSize Maximum number of messages in the page
+ * @param includeMe Include user's messages
+ * @param includeNotifications Include events happening on chat
+ * @param profile Serialization profile of the messages
+ * @param done Optional callback function for async execution
+ * @returns {{messages: Array, cursor: Object, hasMore: boolean}|boolean} Page, or false if the chat doesn't exist.
+ *          The cursor is null and the page empty if the cursor message is not loaded
+ */
+window.WAPI.getMessagesPage = function (id, cursor, pageSize, includeMe, includeNotifications, profile, done) {
+    const chat = WAPI.getChat(id);
+    let output = false;
+
+    if (chat !== undefined) {
+        const models = chat.msgs.models;
+        const messages = [];
+        let i = window.WAPI._findPageStart(models, cursor);
+
+        if (i === -1) {
+            output = {messages: messages, cursor: null, hasMore: false};
+        } else {
+            for (; i < models.length && messages.length < pageSize; i++) {
+                const message = WAPI.processMessageObj(models[i], includeMe, includeNotifications, profile);
+                if (message) {
+                    messages.push(message);
+                }
+            }
+
+            const last = models[i - 1];
+            output = {
+                messages: messages,
+                cursor: last !== undefined ? {index: i, id: last.id._serialized, t: last.t} : cursor,
+                hasMore: i < models.length
+            };
+        }
+    }
+
+    if (done !== undefined) {
+        done(output);
+    }
+    return output;
+};
+
+window.WAPI.getAllMessageIdsInChat = function (id, includeMe, includeNotifications, done) {
+    const chat = WAPI.getChat(id);
+    let output = [];
+    const messages = chat.msgs.models;
+    for (const i in messages) {
+        if ((i === "remove")
+            || (!includeMe && messages[i].isMe)
+            || (!includeNotifications && messages[i].isNotification)) {
+            continue;
+        }
+        output.push(messages[i].id._serialized);
+    }
+    if (done !== undefined) {
+        done(output);
+    } else {
+        return output;
+    }
+};
 
 window.WAPI.getMessageById = function (id, done) {
     try {
@@ -651,32 +1370,137 @@ window.WAPI.forwardMessage = function(idChat, idMessage, waitCheck, done){
     }
 };
 
-window.WAPI._waitForPublication = function (id, message, done) {
-    function sleep(ms) {
-        return new Promise(resolve => setTimeout(resolve, ms));
+// Maximum time to wait for a sent message to show up in Store.Msg
+window.WAPI._SEND_CONFIRM_TIMEOUT = 10000;
+
+/**
+ * Returns the messages being sent, by chat ID, in sending order
+ *
+ * The first time, a Store.Msg listener is added that hands each message the user sends to the first pending send of
+ * its chat that it matches.
+ *
+ * @private
+ */
+window.WAPI._getPendingSends = function () {
+    const state = window.WAPI._persistent;
+
+    if (state.pendingSends === undefined) {
+        state.pendingSends = {};
+        window.Store.Msg.on('add', (msg) => {
+            if (!msg.id || !msg.id.fromMe) {
+                return;
+            }
+            const pendingSends = window.WAPI._persistent.pendingSends;
+            const chatId = msg.id.remote._serialized || msg.id.remote;
+            const pending = pendingSends[chatId];
+            const send = pending && pending.find((send) => send.matches(msg));
+            if (send !== undefined) {
+                send.resolve(msg);
+            }
+        });
     }
+    return state.pendingSends;
+};
 
-    let trials = 0;
+/**
+ * Waits for a message the user is about to send
+ *
+ * Must be called before sending, the message can be added to Store.Msg before the send promise resolves.
+ * Identical messages sent to the same chat are matched in sending order.
+ *
+ * @param chatId ID of the chat
+ * @param matches Function returning true for the expected message model
+ * @returns {{promise: Promise, cancel: Function}} promise yields the message model, or null if it didn't show up
+ *     in time or cancel was called
+ * @private
+ */
+window.WAPI._expectSentMessage = function (chatId, matches) {
+    const pendingSends = window.WAPI._getPendingSends();
+    const pending = pendingSends[chatId] || (pendingSends[chatId] = []);
+    const send = {matches: matches};
+
+    send.promise = new Promise((resolve) => {
+        const timer = setTimeout(() => send.resolve(null), window.WAPI._SEND_CONFIRM_TIMEOUT);
+        send.resolve = (msg) => {
+            clearTimeout(timer);
+            const index = pending.indexOf(send);
+            if (index !== -1) {
+                pending.splice(index, 1);
+            }
+            if (!pending.length && pendingSends[chatId] === pending) {
+                delete pendingSends[chatId];
+            }
+            resolve(msg);
+        };
+    });
+    pending.push(send);
 
-    function check() {
-        let chat = window.WAPI.getChat(id);
-        for (let i=chat.msgs.models.length - 1; i >= 0; i--) {
-            let msg = chat.msgs.models[i];
+    return {promise: send.promise, cancel: () => send.resolve(null)};
+};
 
-            if (!msg.senderObj.isMe || msg.body != message) {
-                continue;
+/**
+ * Sends a text message to a chat
+ *
+ * @param chat Chat model
+ * @param message Text of the message
+ * @returns {Promise} Yields the message model, or null if it could not be found
+ * @private
+ */
+window.WAPI._sendTextMessage = function (chat, message) {
+    const sent = window.WAPI._expectSentMessage(chat.id._serialized, (msg) => msg.body === message);
+    return chat.sendMessage(message).then(() => sent.promise, (error) => {
+        sent.cancel();
+        throw error;
+    });
+};
+
+/**
+ * Waits until a message reaches an ack level
+ *
+ * @param msg Message model
+ * @param ackLevel Minimum ack (1: sent, 2: received, 3: read)
+ * @param timeoutMs Maximum time to wait
+ * @returns {Promise} Yields the message model, whatever its ack is after timeoutMs
+ * @private
+ */
+window.WAPI._waitForAck = function (msg, ackLevel, timeoutMs) {
+    if (msg.ack >= ackLevel) {
+        return Promise.resolve(msg);
+    }
+
+    return new Promise((resolve) => {
+        const finish = () => {
+            clearTimeout(timer);
+            msg.off('change:ack', onChange);
+            resolve(msg);
+        };
+        const onChange = () => {
+            if (msg.ack >= ackLevel) {
+                finish();
             }
-            done(WAPI._serializeMessageObj(msg));
-            return true;
-        }
-        trials += 1;
-        if (trials > 30) {
-            done(true);
-            return;
-        }
-        sleep(100).then(check);
+        };
+        const timer = setTimeout(finish, timeoutMs);
+        msg.on('change:ack', onChange);
+    });
+};
+
+/**
+ * Waits until a message reaches an ack level
+ *
+ * @param messageId ID of the message
+ * @param ackLevel Minimum ack (1: sent, 2: received, 3: read)
+ * @param timeoutMs Maximum time to wait
+ * @param done Callback function for async execution
+ * @returns {Promise} Yields the serialized message whatever its ack is after timeoutMs, false if it is not found
+ */
+window.WAPI.waitForAck = function (messageId, ackLevel, timeoutMs, done) {
+    const msg = window.Store.Msg.get(messageId);
+    if (!msg) {
+        done(false);
+        return Promise.resolve();
     }
-    check();
+
+    return window.WAPI._waitForAck(msg, ackLevel, timeoutMs).then((msg) => done(WAPI._serializeMessageObj(msg)));
 };
 
 window.WAPI.sendMessageToID = function (id, message, done) {
@@ -685,9 +1509,9 @@ window.WAPI.sendMessageToID = function (id, message, done) {
         // create new chat
         return Store.Chat.find(idUser).then((chat) => {
             if (done !== undefined) {
-                chat.sendMessage(message).then(function () {
-                    window.WAPI._waitForPublication(id, message, done);
-                });
+                window.WAPI._sendTextMessage(chat, message).then((msg) => {
+                    done(msg ? WAPI._serializeMessageObj(msg) : true);
+                }, () => done(false));
                 return true;
             } else {
                 chat.sendMessage(message);
@@ -718,46 +1542,34 @@ window.WAPI.sendMessageToID = function (id, message, done) {
 };
 
 window.WAPI.sendMessage = function (id, message, done) {
-    const Chats = window.WAPI.getChatModels();
+    const chat = window.WAPI.getChat(id);
 
-    for (const chat in Chats) {
-        if (isNaN(chat)) {
-            continue;
+    if (chat === undefined) {
+        if (done !== undefined) {
+            done(false);
         }
+        return false;
+    }
 
-        let temp = {};
-        temp.name = Chats[chat].__x__formattedTitle;
-        temp.id = Chats[chat].__x_id._serialized;
-        if (temp.id === id) {
-            if (done !== undefined) {
-                Chats[chat].sendMessage(message).then(function () {
-                    window.WAPI._waitForPublication(id, message, done);
-                });
-                return true;
-            } else {
-                Chats[chat].sendMessage(message);
-                return true;
-            }
-        }
+    if (done !== undefined) {
+        window.WAPI._sendTextMessage(chat, message).then((msg) => {
+            done(msg ? WAPI._serializeMessageObj(msg) : true);
+        }, () => done(false));
+    } else {
+        chat.sendMessage(message);
     }
+    return true;
 };
 
 window.WAPI.sendMessageAsyncAux = async function (id, message) {
-    const Chats = window.WAPI.getChatModels();
+    const chat = window.WAPI.getChat(id);
 
-    for (const chat in Chats) {
-        if (isNaN(chat)) {
-            continue;
-        }
-
-        let temp = {};
-        temp.name = Chats[chat].__x__formattedTitle;
-        temp.id = Chats[chat].__x_id._serialized;
-        if (temp.id === id) {
-            Chats[chat].sendMessage(message);
-            return true;
-        }
+    if (chat === undefined) {
+        return false;
     }
+
+    chat.sendMessage(message);
+    return true;
 };
 
 window.WAPI.sendMessageAsync = function (id, message, done) {
@@ -767,27 +1579,17 @@ window.WAPI.sendMessageAsync = function (id, message, done) {
 };
 
 window.WAPI.sendSeen = function (id, done) {
-    const Chats = window.WAPI.getChatModels();
+    const chat = window.WAPI.getChat(id);
 
-    for (const chat in Chats) {
-        if (isNaN(chat)) {
-            continue;
-        }
-
-        let temp = {};
-        temp.name = Chats[chat].__x__formattedTitle;
-        temp.id = Chats[chat].__x_id._serialized;
-        if (temp.id === id) {
-            if (done !== undefined) {
-                Chats[chat].sendSeen(false).then(function () {
-                    done(true);
-                });
-                return true;
-            } else {
-                Chats[chat].sendSeen(false);
-                return true;
-            }
+    if (chat !== undefined) {
+        if (done !== undefined) {
+            chat.sendSeen(false).then(function () {
+                done(true);
+            });
+        } else {
+            chat.sendSeen(false);
         }
+        return true;
     }
     if (done !== undefined) {
         done();
@@ -798,28 +1600,281 @@ window.WAPI.sendSeen = function (id, done) {
 };
 
 window.WAPI.sendMedia = function (mediaBase64, chat_id, filename, caption, done) {
-    let idUser = new window.Store.UserConstructor(chat_id, {intentionallyUsePrivateConstructor: true});
-    // create new chat
-    return Store.Chat.find(idUser).then((chat) => {
-        let mediaBlob;
-        try {
-            mediaBlob = window.WAPI.base64MediaToFile(mediaBase64, filename);
-        }
-        catch (e) {
+    return window.WAPI.dataUrlToFile(mediaBase64, filename)
+        .then((file) => window.WAPI._findChat(chat_id).then((chat) => window.WAPI._sendMediaFile(file, chat, caption)))
+        .then(() => {
+            if (done !== undefined) done(true);
+        })
+        .catch(() => {
             if (done !== undefined) done(false);
-            return;
+        });
+};
+
+/**
+ * Finds a chat, creating it if it is not in Store.Chat
+ *
+ * @param id ID of the chat
+ * @returns {Promise} Yields the chat model
+ * @private
+ */
+window.WAPI._findChat = function (id) {
+    const chat = window.WAPI.getChat(id);
+    if (chat !== undefined) {
+        return Promise.resolve(chat);
+    }
+    return Store.Chat.find(new window.Store.UserConstructor(id, {intentionallyUsePrivateConstructor: true}));
+};
+
+/**
+ * Sends a File to a chat
+ *
+ * @param file File to send
+ * @param chat Chat model
+ * @param caption Caption of the media
+ * @returns {Promise} Yields the message model once the media is sent, or null if it could not be found
+ * @private
+ */
+window.WAPI._sendMediaFile = function (file, chat, caption) {
+    let mc = new Store.MediaCollection();
+    return mc.processFiles([file], chat, 1).then(() => {
+        let media = mc.models[0];
+        const sent = window.WAPI._expectSentMessage(chat.id._serialized, (msg) => msg.type !== 'chat');
+        media.sendToChat(chat, {caption: caption});
+        return sent.promise;
+    });
+};
+
+// Age in milliseconds after which createFileInput removes an input that was not consumed
+window.WAPI._FILE_INPUT_TIMEOUT = 10 * 60 * 1000;
+
+/**
+ * Adds a hidden file input to the page
+ *
+ * WebDriver can set the file of the input from a local path, so the file doesn't go through the script arguments.
+ * Each input is removed by the call that consumes it. Inputs abandoned by failed uploads are removed once they are
+ * older than _FILE_INPUT_TIMEOUT, so uploads running at the same time don't remove each other's inputs.
+ *
+ * @param done Optional callback function for async execution
+ * @returns {string} ID of the input
+ */
+window.WAPI.createFileInput = function (done) {
+    const now = Date.now();
+    document.querySelectorAll('input.wapi-upload').forEach((input) => {
+        if (now - Number(input.dataset.created) > window.WAPI._FILE_INPUT_TIMEOUT) {
+            input.remove();
         }
-        let mc = new Store.MediaCollection();
-        mc.processFiles([mediaBlob], chat, 1).then(() => {
-            let media = mc.models[0];
-            media.sendToChat(chat, {caption: caption});
+    });
+
+    const input = document.createElement('input');
+    input.type = 'file';
+    input.className = 'wapi-upload';
+    input.dataset.created = String(now);
+    input.id = 'wapi-upload-' + Date.now() + '-' + Math.random().toString(36).slice(2);
+    // Transparent instead of hidden, some WebDriver implementations refuse to type in hidden inputs
+    input.style.cssText = 'position: fixed; top: 0; left: 0; width: 1px; height: 1px; opacity: 0;';
+    document.body.appendChild(input);
+
+    if (done !== undefined) done(input.id);
+    return input.id;
+};
+
+/**
+ * Sends the file selected in an input created by createFileInput, and removes the input
+ *
+ * @param inputId ID of the input
+ * @param chatId ID of the chat, created if it doesn't exist
+ * @param caption Caption of the media
+ * @param done Optional callback function for async execution
+ */
+window.WAPI.sendMediaFromInput = function (inputId, chatId, caption, done) {
+    const input = document.getElementById(inputId);
+    if (!input || !input.files.length) {
+        if (input) input.remove();
+        if (done !== undefined) done(false);
+        return false;
+    }
+
+    const file = input.files[0];
+    input.remove();
+    return window.WAPI._findChat(chatId)
+        .then((chat) => window.WAPI._sendMediaFile(file, chat, caption))
+        .then(() => {
             if (done !== undefined) done(true);
-        }).catch((err) => {
+        })
+        .catch(() => {
             if (done !== undefined) done(false);
         });
+};
+
+/**
+ * Keeps the file of an input created by createFileInput, to be sent by submitSendJobs, and removes the input
+ *
+ * @param inputId ID of the input
+ * @param done Optional callback function for async execution
+ * @returns {string|boolean} ID of the file, false if the input has no file
+ */
+window.WAPI.registerFileInput = function (inputId, done) {
+    const uploads = window.WAPI._persistent.uploads || (window.WAPI._persistent.uploads = {});
+    const input = document.getElementById(inputId);
+    let fileId = false;
+
+    if (input && input.files.length) {
+        fileId = 'file-' + Date.now() + '-' + Math.random().toString(36).slice(2);
+        uploads[fileId] = input.files[0];
+    }
+    if (input) {
+        input.remove();
+    }
+
+    if (done !== undefined) done(fileId);
+    return fileId;
+};
+
+/**
+ * Forgets files kept by registerFileInput
+ *
+ * @param fileIds IDs of the files
+ * @param done Optional callback function for async execution
+ */
+window.WAPI.releaseUploadedFiles = function (fileIds, done) {
+    const uploads = window.WAPI._persistent.uploads || {};
+    fileIds.forEach((fileId) => delete uploads[fileId]);
+
+    if (done !== undefined) done(true);
+    return true;
+};
+
+/**
+ * Runs one job of submitSendJobs
+ *
+ * @returns {Promise} Yields {id, ack} of the sent message. id is null if the message could not be found
+ * @private
+ */
+window.WAPI._runSendJob = function (job) {
+    return window.WAPI._findChat(job.chatId).then((chat) => {
+        if (job.fileId) {
+            const file = (window.WAPI._persistent.uploads || {})[job.fileId];
+            if (file === undefined) {
+                throw new Error('Unknown file ' + job.fileId);
+            }
+            return window.WAPI._sendMediaFile(file, chat, job.caption);
+        }
+        return window.WAPI._sendTextMessage(chat, job.text);
+    }).then((msg) => ({
+        id: msg ? msg.id._serialized : null,
+        ack: msg ? msg.ack : null
+    }));
+};
+
+/**
+ * Queues messages to be sent in the page
+ *
+ * Jobs are started at most ratePerSecond per second, with at most concurrency of them running at the same time.
+ * Chats that are not in Store.Chat are created. Results are fetched with waitSendResults.
+ *
+ * @param jobs List of {chatId, text} or {chatId, fileId, caption}, fileId as returned by registerFileInput
+ * @param ratePerSecond Maximum number of jobs started per second, null for no limit
+ * @param concurrency Maximum number of jobs running at the same time, at least 1
+ * @param done Optional callback function for async execution
+ * @returns {string} ID of the batch of jobs
+ */
+window.WAPI.submitSendJobs = function (jobs, ratePerSecond, concurrency, done) {
+    const bulks = window.WAPI._persistent.sendBulks || (window.WAPI._persistent.sendBulks = {});
+    const bulkId = 'bulk-' + Date.now() + '-' + Math.random().toString(36).slice(2);
+    const interval = ratePerSecond > 0 ? 1000 / ratePerSecond : 0;
+    // With no running job nothing would ever be reported
+    concurrency = Math.max(Math.floor(concurrency) || 1, 1);
+    const bulk = {
+        total: jobs.length,
+        reported: 0,
+        cancelled: false,
+        results: window.WAPI._createEventQueue(Math.max(jobs.length, 1))
+    };
+    bulks[bulkId] = bulk;
+
+    let next = 0;
+    let active = 0;
+    let lastStart = -Infinity;
+    let timer = null;
+
+    function pump() {
+        while (!bulk.cancelled && active < concurrency && next < jobs.length) {
+            const wait = lastStart + interval - Date.now();
+            if (wait > 0) {
+                if (timer === null) {
+                    timer = setTimeout(() => {
+                        timer = null;
+                        pump();
+                    }, wait);
+                }
+                return;
+            }
+
+            const index = next++;
+            lastStart = Date.now();
+            active++;
+            window.WAPI._runSendJob(jobs[index])
+                .then((sent) => Object.assign({index: index, error: null}, sent),
+                      (error) => ({index: index, id: null, ack: null, error: String(error)}))
+                .then((result) => {
+                    active--;
+                    bulk.results.push(result);
+                    pump();
+                });
+        }
+    }
+    pump();
+
+    if (done !== undefined) done(bulkId);
+    return bulkId;
+};
+
+/**
+ * Waits for results of jobs queued by submitSendJobs and drains them
+ *
+ * @param bulkId ID returned by submitSendJobs
+ * @param timeoutMs Maximum time to wait for a result
+ * @param maxCount Maximum number of results to return
+ * @param done Callback function for async execution
+ * @returns {Promise} Yields {found, results, remaining}. found is false if the batch is unknown (i.e. the page was
+ *     reloaded) and remaining is the number of results not returned yet
+ */
+window.WAPI.waitSendResults = function (bulkId, timeoutMs, maxCount, done) {
+    const bulks = window.WAPI._persistent.sendBulks || {};
+    const bulk = bulks[bulkId];
+
+    if (bulk === undefined) {
+        done({found: false, results: [], remaining: 0});
+        return Promise.resolve();
+    }
+
+    return bulk.results.wait(timeoutMs).then(() => {
+        const results = bulk.results.drain(maxCount).items;
+        bulk.reported += results.length;
+        if (bulk.reported >= bulk.total) {
+            delete bulks[bulkId];
+        }
+        done({found: true, results: results, remaining: bulk.total - bulk.reported});
     });
 };
 
+/**
+ * Stops starting jobs queued by submitSendJobs and discards their results
+ *
+ * @param bulkId ID returned by submitSendJobs
+ * @param done Optional callback function for async execution
+ */
+window.WAPI.cancelSendJobs = function (bulkId, done) {
+    const bulks = window.WAPI._persistent.sendBulks || {};
+    if (bulks[bulkId] !== undefined) {
+        bulks[bulkId].cancelled = true;
+        delete bulks[bulkId];
+    }
+
+    if (done !== undefined) done(true);
+    return true;
+};
+
 window.WAPI.sendMediaAsync = function (
     mediaBase64, chat_id, filename, caption, url_fallback, done
 ) {
@@ -836,16 +1891,10 @@ window.WAPI.sendMediaAsyncAux = async function (
     let idUser = new window.Store.UserConstructor(chat_id, {intentionallyUsePrivateConstructor: true});
     // create new chat
     return Store.Chat.find(idUser).then((chat) => {
-        let mediaBlob;
-        try {
-            mediaBlob = window.WAPI.base64MediaToFile(mediaBase64, filename);
-        }
-        catch (e) {
-            window.WAPI.sendMessageAsyncAux(chat_id, url_fallback);
-            return;
-        }
-        let mc = new Store.MediaCollection();
-        mc.processFiles([mediaBlob], chat, 1).then(() => {
+        return window.WAPI.dataUrlToFile(mediaBase64, filename).then((mediaBlob) => {
+            let mc = new Store.MediaCollection();
+            return mc.processFiles([mediaBlob], chat, 1).then(() => mc);
+        }).then((mc) => {
             let media = mc.models[0];
             media.sendToChat(chat, {caption: caption});
         }).catch((err) => {
@@ -854,13 +1903,19 @@ window.WAPI.sendMediaAsyncAux = async function (
     });
 };
 
-window.WAPI.base64MediaToFile = function (b64Data, filename) {
-    let arr = b64Data.split(','), mime = arr[0].match(/:(.*?);/)[1],
-        bstr = atob(arr[1]), n = bstr.length, u8arr = new Uint8Array(n);
-    while (n--) {
-        u8arr[n] = bstr.charCodeAt(n);
-    }
-    return new File([u8arr], filename, {type: mime});
+/**
+ * Builds a File from a base64 data URL
+ *
+ * The browser decodes the data natively, instead of copying it byte by byte.
+ *
+ * @param dataUrl Data URL with the content of the file
+ * @param filename Name of the file
+ * @returns {Promise<File>}
+ */
+window.WAPI.dataUrlToFile = function (dataUrl, filename) {
+    return fetch(dataUrl)
+        .then((response) => response.blob())
+        .then((blob) => new File([blob], filename, {type: blob.type}));
 };
 
 function isChatMessage(message) {
@@ -880,11 +1935,13 @@ function isChatMessage(message) {
  * Method to get all the visible messages on the account.
  * @param includeMe
  * @param includeNotifications
+ * @param profile Serialization profile of chats and messages
  * @param done
  * @returns {Array}
  */
 window.WAPI.getAllLatestMessages = function(includeMe,
                                             includeNotifications,
+                                            profile,
                                             done) {
     const chats = window.WAPI.getChatModels();
     let output = [];
@@ -894,19 +1951,18 @@ window.WAPI.getAllLatestMessages = function(includeMe,
         }
 
         let messageGroupObj = chats[chat];
-        let messageGroup = WAPI._serializeChatObj(messageGroupObj);
-        messageGroup.messages = [];
-
         const messages = messageGroupObj.msgs.models;
 
         // Get all messages availables to then be processed and filter the undef
-        messageGroup.messages = messages.map(
+        const serializedMessages = messages.map(
             (messageObj) => WAPI.processMessageObj(
-                messageObj, includeMe,  includeNotifications
+                messageObj, includeMe,  includeNotifications, profile
             )
         ).filter(msg => msg? true : false);
 
-        if (messageGroup.messages.length > 0) {
+        if (serializedMessages.length > 0) {
+            let messageGroup = WAPI._serializeChatObj(messageGroupObj, profile);
+            messageGroup.messages = serializedMessages;
             output.push(messageGroup);
         }
     }
@@ -917,7 +1973,197 @@ window.WAPI.getAllLatestMessages = function(includeMe,
 
 };
 
-window.WAPI.getUnreadMessages = function (includeMe, includeNotifications, done) {
+/**
+ * Starts buffering new incoming messages in the page
+ *
+ * Messages are queued as they are added to Store.Msg and serialized when they are drained with waitNewMessages.
+ * Calling it again only updates the options.
+ *
+ * @param includeMe Include user's messages
+ * @param includeNotifications Include events happening on chat
+ * @param maxQueueSize Maximum number of buffered messages, older messages are dropped when it is reached
+ * @param done Optional callback function for async execution
+ */
+window.WAPI.startNewMessagesListener = function (includeMe, includeNotifications, maxQueueSize, done) {
+    const state = window.WAPI._persistent;
+
+    if (state.newMessages === undefined) {
+        state.newMessages = window.WAPI._createEventQueue(maxQueueSize);
+        window.Store.Msg.on('add', (messageObj) => {
+            const options = window.WAPI._persistent.newMessagesOptions;
+            if (!options || !messageObj.__x_isNewMsg) {
+                return;
+            }
+            if (messageObj.isNotification ? !options.includeNotifications
+                    : (messageObj.id.fromMe && !options.includeMe)) {
+                return;
+            }
+            window.WAPI._persistent.newMessages.push(messageObj);
+        });
+    }
+    state.newMessages.maxSize = maxQueueSize;
+    state.newMessagesOptions = {includeMe: includeMe, includeNotifications: includeNotifications};
+
+    if (done !== undefined) {
+        done(true);
+    }
+    return true;
+};
+
+/**
+ * Stops buffering new incoming messages and discards the buffered ones
+ *
+ * @param done Optional callback function for async execution
+ */
+window.WAPI.stopNewMessagesListener = function (done) {
+    const state = window.WAPI._persistent;
+
+    state.newMessagesOptions = null;
+    if (state.newMessages !== undefined) {
+        state.newMessages.clear();
+    }
+
+    if (done !== undefined) {
+        done(true);
+    }
+    return true;
+};
+
+/**
+ * Waits for new messages buffered by startNewMessagesListener and drains them
+ *
+ * @param timeoutMs Maximum time to wait for a message
+ * @param maxCount Maximum number of messages to return
+ * @param profile Serialization profile of the messages
+ * @param done Callback function for async execution
+ * @returns {Promise} Yields {subscribed, messages, dropped}
+ */
+window.WAPI.waitNewMessages = function (timeoutMs, maxCount, profile, done) {
+    const state = window.WAPI._persistent;
+
+    if (state.newMessages === undefined || !state.newMessagesOptions) {
+        // Not listening, usually because the page was reloaded
+        done({subscribed: false, messages: [], dropped: 0});
+        return Promise.resolve();
+    }
+
+    return state.newMessages.wait(timeoutMs).then(() => {
+        const drained = state.newMessages.drain(maxCount);
+        done({
+            subscribed: true,
+            messages: drained.items
+                .map((messageObj) => WAPI._serializeMessageObj(messageObj, profile))
+                .filter((message) => message),
+            dropped: drained.dropped
+        });
+    });
+};
+
+/**
+ * Starts queueing ack changes of messages in the page
+ *
+ * Changes of a message that are still queued are merged, so the queue holds at most one change per message with
+ * its latest ack. Calling it again only updates the options.
+ *
+ * @param onlyMine Only track messages sent by the user
+ * @param maxQueueSize Maximum number of queued changes, older changes are dropped when it is reached
+ * @param done Optional callback function for async execution
+ */
+window.WAPI.startAckListener = function (onlyMine, maxQueueSize, done) {
+    const state = window.WAPI._persistent;
+
+    if (state.ackChanges === undefined) {
+        state.ackChanges = window.WAPI._createEventQueue(maxQueueSize);
+        // Message ID -> its change, while it is in the queue
+        state.ackChangesById = new Map();
+        window.Store.Msg.on('change:ack', (msg) => {
+            const state = window.WAPI._persistent;
+            if (!state.ackOptions || !msg.id || (state.ackOptions.onlyMine && !msg.id.fromMe)) {
+                return;
+            }
+
+            const id = msg.id._serialized;
+            const queued = state.ackChangesById.get(id);
+            if (queued !== undefined) {
+                queued.ack = msg.ack;
+                queued.t = Date.now() / 1000;
+                return;
+            }
+
+            const change = {
+                id: id,
+                chatId: msg.id.remote._serialized || msg.id.remote,
+                ack: msg.ack,
+                t: Date.now() / 1000
+            };
+            const dropped = state.ackChanges.dropped;
+            state.ackChanges.push(change);
+            if (state.ackChanges.dropped !== dropped) {
+                // The queue overflowed, the dropped changes can't be merged anymore
+                state.ackChangesById = new Map(state.ackChanges.items.map((item) => [item.id, item]));
+            } else {
+                state.ackChangesById.set(id, change);
+            }
+        });
+    }
+    state.ackChanges.maxSize = maxQueueSize;
+    state.ackOptions = {onlyMine: onlyMine};
+
+    if (done !== undefined) {
+        done(true);
+    }
+    return true;
+};
+
+/**
+ * Stops queueing ack changes and discards the queued ones
+ *
+ * @param done Optional callback function for async execution
+ */
+window.WAPI.stopAckListener = function (done) {
+    const state = window.WAPI._persistent;
+
+    state.ackOptions = null;
+    if (state.ackChanges !== undefined) {
+        state.ackChanges.clear();
+        state.ackChangesById.clear();
+    }
+
+    if (done !== undefined) {
+        done(true);
+    }
+    return true;
+};
+
+/**
+ * Waits for ack changes queued by startAckListener and drains them
+ *
+ * @param timeoutMs Maximum time to wait for a change
+ * @param maxCount Maximum number of changes to return
+ * @param done Callback function for async execution
+ * @returns {Promise} Yields {subscribed, changes, dropped}, changes being {id, chatId, ack, t} in arrival order
+ */
+window.WAPI.waitAckChanges = function (timeoutMs, maxCount, done) {
+    const state = window.WAPI._persistent;
+
+    if (state.ackChanges === undefined || !state.ackOptions) {
+        // Not listening, usually because the page was reloaded
+        done({subscribed: false, changes: [], dropped: 0});
+        return Promise.resolve();
+    }
+
+    return state.ackChanges.wait(timeoutMs).then(() => {
+        const drained = state.ackChanges.drain(maxCount);
+        drained.items.forEach((change) => {
+            if (state.ackChangesById.get(change.id) === change) {
+                state.ackChangesById.delete(change.id);
+            }
+        });
+        done({subscribed: true, changes: drained.items, dropped: drained.dropped});
+    });
+};
+
+window.WAPI.getUnreadMessages = function (includeMe, includeNotifications, profile, done) {
     const chats = window.WAPI.getChatModels();
     let output = [];
     for (let chat in chats) {
@@ -927,7 +2173,7 @@ window.WAPI.getUnreadMessages = function (includeMe, includeNotifications, done)
 
         let messageGroupObj = chats[chat];
         let messageGroup = WAPI.getChatUnreadMessages(
-            messageGroupObj, includeMe, includeNotifications
+            messageGroupObj, includeMe, includeNotifications, profile
         );
         if (messageGroup != null){
             output.push(messageGroup);
@@ -939,9 +2185,8 @@ window.WAPI.getUnreadMessages = function (includeMe, includeNotifications, done)
     return output;
 };
 
-window.WAPI.getChatUnreadMessages = function (chat, includeMe, includeNotifications) {
-    let messageGroup = WAPI._serializeChatObj(chat);
-    messageGroup.messages = [];
+window.WAPI.getChatUnreadMessages = function (chat, includeMe, includeNotifications, profile) {
+    let unreadMessages = [];
 
     const messages = chat.msgs.models;
     for (let i = messages.length - 1; i >= 0; i--) {
@@ -950,28 +2195,31 @@ window.WAPI.getChatUnreadMessages = function (chat, includeMe, includeNotificati
             if(messageObj.__x_isSentByMe && !includeMe) {
                 break;
             }
-            let message = WAPI.processMessageObj(messageObj, includeMe,  includeNotifications);
+            let message = WAPI.processMessageObj(messageObj, includeMe,  includeNotifications, profile);
             if(message){
                 messageObj.__x_isNewMsg = false;
                 messageObj.__x_MustSent = false;
-                messageGroup.messages.unshift(message);
+                unreadMessages.unshift(message);
             }
         } else {
             break;
         }
     }
 
-    if (messageGroup.messages.length > 0) {
+    if (unreadMessages.length > 0) {
+        // The chat is only serialized when it has unread messages
+        let messageGroup = WAPI._serializeChatObj(chat, profile);
+        messageGroup.messages = unreadMessages;
         return messageGroup;
     }
     return null;
 };
 
-window.WAPI.getUnreadMessagesUsingChatId = function(chat_id, includeMe, includeNotifications, done){
+window.WAPI.getUnreadMessagesUsingChatId = function(chat_id, includeMe, includeNotifications, profile, done){
     let output = [];
     let chat = window.WAPI.getChat(chat_id, undefined);
     if (chat) {
-        let messageGroup = window.WAPI.getChatUnreadMessages(chat, includeMe, includeNotifications);
+        let messageGroup = window.WAPI.getChatUnreadMessages(chat, includeMe, includeNotifications, profile);
         if (messageGroup != null){
             output.push(messageGroup);
         }
@@ -1021,25 +2269,47 @@ window.WAPI.getGroupOwnerID = async function (id, done) {
     return output;
 };
 
+/**
+ * Lists the group chat IDs a contact is a participant of, skipping groups without a chat
+ *
+ * @private
+ */
+window.WAPI._getCommonGroupIds = function (id) {
+    return window.WAPI._getGroupMembership().groupsOf(id)
+        .filter((groupId) => window.WAPI._getChatModel(groupId) !== undefined);
+};
+
 window.WAPI.getCommonGroups = async function (id, done) {
-    let output = [];
+    const output = window.WAPI._getCommonGroupIds(id)
+        .map((groupId) => WAPI._serializeChatObj(window.WAPI._getChatModel(groupId)));
 
-    let groups = window.WAPI.getAllGroups();
+    if (done !== undefined) {
+        done(output);
+    }
+    return output;
+};
 
-    for (let groupIndex=0; groupIndex < groups.length; groupIndex++) {
-        try {
-            participants = await window.WAPI.getGroupParticipantIDs(
-                groups[groupIndex].id._serialized
-            );
-            if (participants.filter((participant) => participant == id).length) {
-                output.push(groups[groupIndex]);
+/**
+ * Fetches the groups in common with several contacts
+ *
+ * Each group is serialized once, however many of the contacts are in it.
+ *
+ * @param ids IDs of the contacts
+ * @param done Optional callback function for async execution
+ * @returns {{groups: Object, members: Object}} Groups by ID, and IDs of the common groups by contact ID
+ */
+window.WAPI.getCommonGroupsMany = function (ids, done) {
+    const output = {groups: {}, members: {}};
+
+    ids.forEach((id) => {
+        const groupIds = window.WAPI._getCommonGroupIds(id);
+        groupIds.forEach((groupId) => {
+            if (output.groups[groupId] === undefined) {
+                output.groups[groupId] = WAPI._serializeChatObj(window.WAPI._getChatModel(groupId));
             }
-        } catch(err) {
-            console.log("Error in group:");
-            console.log(groups[groupIndex]);
-            console.log(err);
-        }
-    }
+        });
+        output.members[id] = groupIds;
+    });
 
     if (done !== undefined) {
         done(output);
@@ -1064,9 +2334,7 @@ window.WAPI.leaveGroup = function (groupId, done) {
 };
 
 window.WAPI.deleteConversation = function (chatId, done) {
-    let conversation = window.WAPI.getChatModels().find(
-        (chat) => chat.id._serialized === chatId
-    );
+    let conversation = window.WAPI.getChat(chatId);
     if (conversation == null) {
         if (done != null) {
             done(false);
@@ -1112,6 +2380,93 @@ window.WAPI.downloadFile = function (url, done) {
     xhr.send(null);
 };
 
+/**
+ * Downloads a file into the page so that it can be read in chunks with readDownloadChunk
+ *
+ * The file is kept as binary data until releaseDownload is called.
+ *
+ * @param url URL of the file
+ * @param done Callback function for async execution
+ * @returns None Yields {handle, size}, or false if the download failed
+ */
+window.WAPI.startDownload = function (url, done) {
+    let xhr = new XMLHttpRequest();
+    const state = window.WAPI._persistent;
+
+    xhr.onload = function () {
+        if (xhr.status == 200) {
+            state.downloads = state.downloads || {};
+            state.lastDownload = (state.lastDownload || 0) + 1;
+            const handle = state.lastDownload;
+            state.downloads[handle] = new Uint8Array(xhr.response);
+            done({handle: handle, size: state.downloads[handle].length});
+        } else {
+            console.error(xhr.statusText);
+            done(false);
+        }
+    };
+    xhr.onerror = function () {
+        done(false);
+    };
+    xhr.open("GET", url, true);
+    xhr.responseType = 'arraybuffer';
+    xhr.send(null);
+};
+
+/**
+ * Encodes bytes as base64 without building a string per byte
+ *
+ * @param bytes Uint8Array
+ * @returns {string}
+ * @private
+ */
+window.WAPI._bytesToBase64 = function (bytes) {
+    const parts = [];
+    for (let i = 0; i < bytes.length; i += 0x8000) {
+        parts.push(String.fromCharCode.apply(null, bytes.subarray(i, i + 0x8000)));
+    }
+    return btoa(parts.join(''));
+};
+
+/**
+ * Reads a chunk of a file downloaded with startDownload
+ *
+ * @param handle Handle returned by startDownload
+ * @param offset Position of the chunk
+ * @param length Length of the chunk
+ * @param done Optional callback function for async execution
+ * @returns {string|boolean} Base64 encoded chunk, or false for an unknown handle
+ */
+window.WAPI.readDownloadChunk = function (handle, offset, length, done) {
+    const downloads = window.WAPI._persistent.downloads || {};
+    let output = false;
+
+    if (downloads[handle] !== undefined) {
+        output = window.WAPI._bytesToBase64(downloads[handle].subarray(offset, offset + length));
+    }
+
+    if (done !== undefined) {
+        done(output);
+    }
+    return output;
+};
+
+/**
+ * Frees a file downloaded with startDownload
+ *
+ * @param handle Handle returned by startDownload
+ * @param done Optional callback function for async execution
+ */
+window.WAPI.releaseDownload = function (handle, done) {
+    const downloads = window.WAPI._persistent.downloads || {};
+    delete downloads[handle];
+
+    if (done !== undefined) {
+        done(true);
+    }
+    return true;
+};
+
 window.WAPI.getStatus = function(done){
     let bad_status = 'API-ERROR';
     try {
@@ -1137,6 +2492,123 @@ window.WAPI.isLoggedIn = function (done) {
     return isLogged;
 };
 
+/**
+ * Calls a WAPI function with a done callback
+ *
+ * @param name Function name
+ * @param args Arguments, without the callback
+ * @returns {Promise} Resolves with {result: ...} when the function calls back, or {error: ...} if it fails
+ */
+window.WAPI._invoke = function (name, args) {
+    return new Promise((resolve) => {
+        try {
+            const returned = window.WAPI[name].apply(
+                window.WAPI, args.concat([(result) => resolve({result: result})])
+            );
+            if (returned && typeof returned.catch === 'function') {
+                returned.catch((err) => resolve({error: String(err)}));
+            }
+        } catch (err) {
+            resolve({error: String(err)});
+        }
+    });
+};
+
+/**
+ * Runs several WAPI functions in a single call
+ *
+ * @param calls List of [function name, arguments] pairs
+ * @param done Optional callback function for async execution
+ * @returns {Promise.<Array>} Yields a {result: ...} or {error: ...} object for each call, in order
+ */
+window.WAPI.callBatch = function (calls, done) {
+    const pending = calls.map(([name, args]) => window.WAPI._invoke(name, args));
+
+    return Promise.all(pending).then((results) => {
+        if (done !== undefined) {
+            done(results);
+        }
+        return results;
+    });
+};
+
+window.WAPI._getRpc = function () {
+    const state = window.WAPI._persistent;
+    if (!state.rpc) {
+        state.rpc = {running: new Set(), results: window.WAPI._createEventQueue(Infinity)};
+    }
+    return state.rpc;
+};
+
+/**
+ * Starts calls without waiting for them to finish
+ *
+ * Results are collected with waitCallResults, so several calls run at the same time in the page while the driver
+ * only runs short scripts.
+ *
+ * @param calls List of [callId, function name, arguments]
+ * @param done Optional callback function for async execution
+ * @returns {Array} Ids of the started calls
+ */
+window.WAPI.startCalls = function (calls, done) {
+    const rpc = window.WAPI._getRpc();
+
+    calls.forEach(([callId, name, args]) => {
+        rpc.running.add(callId);
+        window.WAPI._invoke(name, args).then((outcome) => {
+            // Cancelled calls are discarded
+            if (rpc.running.delete(callId)) {
+                outcome.callId = callId;
+                rpc.results.push(outcome);
+            }
+        });
+    });
+
+    const started = calls.map(([callId]) => callId);
+    if (done !== undefined) {
+        done(started);
+    }
+    return started;
+};
+
+/**
+ * Waits for results of the calls started with startCalls
+ *
+ * @param timeoutMs Maximum time to wait for a result
+ * @param done Optional callback function for async execution
+ * @returns {Promise} Resolves with {results: [{callId, result or error}], running: [callId]}
+ */
+window.WAPI.waitCallResults = function (timeoutMs, done) {
+    const rpc = window.WAPI._getRpc();
+
+    return rpc.results.wait(timeoutMs).then(() => {
+        const response = {
+            results: rpc.results.drain().items,
+            running: Array.from(rpc.running)
+        };
+        if (done !== undefined) {
+            done(response);
+        }
+        return response;
+    });
+};
+
+/**
+ * Discards calls started with startCalls. The calls keep running, but their results are dropped
+ *
+ * @param callIds Ids of the calls
+ * @param done Optional callback function for async execution
+ */
+window.WAPI.cancelCalls = function (callIds, done) {
+    const rpc = window.WAPI._getRpc();
+    callIds.forEach((callId) => rpc.running.delete(callId));
+
+    if (done !== undefined) {
+        done(true);
+    }
+    return true;
+};
+
 Store.ChatClass.default.prototype.sendMessage = function (e) {
     return Store.SendTextMsgToChat(this,e);
 };
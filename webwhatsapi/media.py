@@ -0,0 +1,273 @@
+"""
+Helpers to download and decrypt media files
+
+Media files are encrypted with AES-CBC, using keys derived from the message media key, and followed by the first 10
+bytes of an HMAC-SHA256 of the IV and the encrypted data.
+"""
+
+import binascii
+import hashlib
+import hmac
+import os
+from base64 import b64decode
+from functools import lru_cache
+from threading import BoundedSemaphore
+
+import urllib3
+from axolotl.kdf.hkdfv3 import HKDFv3
+from axolotl.util.byteutil import ByteUtil
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import padding
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from six import string_types
+
+from .objects.message import MediaMessage
+
+# Size of the chunks media files are downloaded and decrypted in
+CHUNK_SIZE = 1024 * 1024
+
+
+class MediaError(Exception):
+    pass
+
+
+class MediaIntegrityError(MediaError):
+    """
+    Raised when a decrypted media file doesn't match its MAC or hashes
+    """
+    pass
+
+
+class MediaFetchError(MediaError):
+    """
+    Raised when a media file can't be downloaded directly from its URL
+    """
+    pass
+
+
+class MediaFetcher(object):
+    """
+    Downloads media files directly from their URLs, reusing keep-alive connections between downloads
+
+    At most max_connections downloads run at the same time, further downloads wait for a free connection
+    """
+
+    def __init__(self, max_connections=8, timeout=60, retries=2):
+        """
+        Constructor
+
+        :param max_connections: Maximum number of concurrent downloads
+        :type max_connections: int
+        :param timeout: Connect and read timeout, in seconds
+        :param retries: Retries on connection errors
+        :type retries: int
+        """
+        self._semaphore = BoundedSemaphore(max_connections)
+        self._pool = urllib3.PoolManager(maxsize=max_connections, block=True,
+                                         timeout=urllib3.Timeout(connect=timeout, read=timeout),
+                                         retries=urllib3.Retry(total=retries, redirect=5, raise_on_status=False))
+
+    def iter_chunks(self, url, chunk_size=CHUNK_SIZE):
+        """
+        Downloads a file and yields it in chunks
+
+        :param url: URL of the file
+        :param chunk_size: Size of the chunks
+        :type chunk_size: int
+        :return: Chunks of the file
+        :rtype: Iterator[bytes]
+        :raises MediaFetchError: If the file could not be downloaded
+        """
+        with self._semaphore:
+            try:
+                resp = self._pool.request('GET', url, preload_content=False)
+            except urllib3.exceptions.HTTPError as e:
+                raise MediaFetchError("Could not download {0} ({1})".format(url, e))
+
+            try:
+                if resp.status >= 400:
+                    raise MediaFetchError("Could not download {0} (HTTP {1})".format(url, resp.status))
+
+                for chunk in resp.stream(chunk_size):
+                    yield chunk
+            except urllib3.exceptions.HTTPError as e:
+                raise MediaFetchError("Could not download {0} ({1})".format(url, e))
+            finally:
+                resp.release_conn()
+
+    def fetch(self, url):
+        """
+        Downloads a file
+
+        :param url: URL of the file
+        :return: Content of the file
+        :rtype: bytes
+        :raises MediaFetchError: If the file could not be downloaded
+        """
+        return b''.join(self.iter_chunks(url))
+
+    def close(self):
+        self._pool.clear()
+
+
+@lru_cache(maxsize=256)
+def derive_media_keys(media_key, media_type):
+    """
+    Derives the keys a media file is encrypted with
+
+    :param media_key: Base64 media key of the message
+    :type media_key: str
+    :param media_type: Media type of the message (image, video, ...)
+    :type media_type: str
+    :return: IV, cipher key and MAC key
+    :rtype: tuple
+    """
+    derivative = HKDFv3().deriveSecrets(b64decode(media_key),
+                                        binascii.unhexlify(MediaMessage.crypt_keys[media_type]),
+                                        112)
+    return tuple(ByteUtil.split(derivative, 16, 32, 32))
+
+
+class MediaDownload(object):
+    """
+    Outcome of one of the downloads of a bulk media download
+    """
+
+    def __init__(self, message, result=None, error=None):
+        """
+        Constructor
+
+        :param message: Media message
+        :type message: MediaMessage
+        :param result: Value returned by download_media for the message
+        :param error: Exception raised by download_media for the message, None if it succeeded
+        :type error: Exception
+        """
+        self.message = message
+        self.result = result
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __repr__(self):
+        return "<MediaDownload {0} ({1})>".format(self.message.id, "ok" if self.ok else self.error)
+
+
+class MediaDecryptor(object):
+    """
+    Decrypts a media file incrementally, as its chunks arrive
+
+    The MAC and the hashes of the file are computed on the same pass and checked by finalize()
+    """
+
+    MAC_LENGTH = 10
+
+    def __init__(self, media_key, media_type, filehash=None, enc_filehash=None):
+        """
+        Constructor
+
+        :param media_key: Base64 media key of the message
+        :type media_key: str
+        :param media_type: Media type of the message (image, video, ...)
+        :type media_type: str
+        :param filehash: Base64 SHA-256 of the decrypted file. Not checked if None
+        :type filehash: str
+        :param enc_filehash: Base64 SHA-256 of the encrypted file. Not checked if None
+        :type enc_filehash: str
+        """
+        iv, cipher_key, mac_key = derive_media_keys(media_key, media_type)
+
+        self._decryptor = Cipher(algorithms.AES(cipher_key), modes.CBC(iv), backend=default_backend()).decryptor()
+        self._unpadder = padding.PKCS7(algorithms.AES.block_size).unpadder()
+        self._mac = hmac.new(mac_key, iv, hashlib.sha256)
+        self._filehash = filehash and b64decode(filehash)
+        self._hash = hashlib.sha256() if filehash else None
+        self._enc_filehash = enc_filehash and b64decode(enc_filehash)
+        self._enc_hash = hashlib.sha256() if enc_filehash else None
+        # Last bytes received, they are the MAC if no more data comes
+        self._tail = b''
+
+    def _decrypted(self, data):
+        if self._hash is not None:
+            self._hash.update(data)
+        return data
+
+    def update(self, data):
+        """
+        Decrypts the next chunk of the encrypted file
+
+        :param data: Encrypted bytes
+        :return: Decrypted bytes available so far
+        :rtype: bytes
+        """
+        if self._enc_hash is not None:
+            self._enc_hash.update(data)
+
+        data = self._tail + data
+        self._tail = data[-self.MAC_LENGTH:]
+        encrypted = data[:-self.MAC_LENGTH]
+        self._mac.update(encrypted)
+        return self._decrypted(self._unpadder.update(self._decryptor.update(encrypted)))
+
+    def finalize(self):
+        """
+        Ends the decryption and checks the integrity of the file
+
+        :return: Last decrypted bytes
+        :rtype: bytes
+        :raises MediaIntegrityError: If the MAC, the padding or a hash of the file doesn't match
+        """
+        if self._enc_hash is not None and self._enc_hash.digest() != self._enc_filehash:
+            raise MediaIntegrityError("Encrypted file hash mismatch")
+
+        if len(self._tail) < self.MAC_LENGTH or \
+                not hmac.compare_digest(self._mac.digest()[:self.MAC_LENGTH], self._tail):
+            raise MediaIntegrityError("MAC mismatch, the file is corrupted or truncated")
+
+        try:
+            data = self._unpadder.update(self._decryptor.finalize()) + self._unpadder.finalize()
+        except ValueError as e:
+            raise MediaIntegrityError("Invalid encrypted data ({0})".format(e))
+        data = self._decrypted(data)
+
+        if self._hash is not None and self._hash.digest() != self._filehash:
+            raise MediaIntegrityError("File hash mismatch")
+
+        return data
+
+
+def write_decrypted(chunks, decryptor, sink):
+    """
+    Decrypts chunks of an encrypted file and writes them to sink as they arrive
+
+    :param chunks: Iterable of encrypted chunks
+    :param decryptor: Decryptor for the file
+    :type decryptor: MediaDecryptor
+    :param sink: Path of the output file, or file-like object opened in binary mode
+    :return: Number of decrypted bytes written
+    :rtype: int
+    :raises MediaIntegrityError: If the file doesn't match its MAC or hashes
+    """
+    if isinstance(sink, string_types):
+        try:
+            with open(sink, 'wb') as f:
+                return write_decrypted(chunks, decryptor, f)
+        except Exception:
+            # Don't leave a partial or corrupted file behind
+            try:
+                os.remove(sink)
+            except OSError:
+                pass
+            raise
+
+    written = 0
+    for chunk in chunks:
+        data = decryptor.update(chunk)
+        sink.write(data)
+        written += len(data)
+
+    data = decryptor.finalize()
+    sink.write(data)
+    return written + len(data)
@@ -0,0 +1,234 @@
+import binascii
+import mmap
+import os
+import re
+import shutil
+import tempfile
+from base64 import b64decode
+from collections import OrderedDict
+from threading import Lock
+
+
+class MediaStore(object):
+    """
+    Content addressed on-disk store for decrypted media files
+
+    Files are keyed by the filehash and type of their message, so media that is forwarded or sent several times
+    (stickers, for instance) is downloaded and decrypted once. Files are evicted least recently used first when the
+    store grows over max_size.
+
+    The store only manages the files it created: a directory is recognized as a store by its marker file, and only
+    <media type>/<hex filehash> files in it are store entries. Any other file is left alone.
+    """
+
+    MARKER = '.webwhatsapi-media-store'
+    _TEMP_PREFIX = '.webwhatsapi-tmp-'
+    _ENTRY_NAME = re.compile(r'^[0-9a-f]{64}$')
+
+    def __init__(self, path=None, max_size=1024 * 1024 * 1024):
+        """
+        Constructor
+
+        :param path: Directory of the store, either a store or a new or empty directory. Defaults to
+                     webwhatsapi-media in the temporary directory
+        :type path: str
+        :param max_size: Maximum size of the stored files, in bytes
+        :type max_size: int
+        """
+        self.path = path or os.path.join(tempfile.gettempdir(), 'webwhatsapi-media')
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = Lock()
+        # File path -> size, least recently used first
+        self._entries = OrderedDict()
+        self._size = 0
+        self._load()
+
+    def _load(self):
+        marker = os.path.join(self.path, self.MARKER)
+        if not os.path.exists(marker):
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            elif os.listdir(self.path):
+                # Evicting would delete files the store doesn't own
+                raise ValueError("{0} is not empty and is not a media store".format(self.path))
+            open(marker, 'a').close()
+            return
+
+        files = []
+        for media_type in os.listdir(self.path):
+            directory = os.path.join(self.path, media_type)
+            if not os.path.isdir(directory):
+                continue
+            for name in os.listdir(directory):
+                file_path = os.path.join(directory, name)
+                if name.startswith(self._TEMP_PREFIX):
+                    # Leftover of an interrupted write
+                    os.remove(file_path)
+                elif self._ENTRY_NAME.match(name) and os.path.isfile(file_path):
+                    stat = os.stat(file_path)
+                    files.append((stat.st_mtime, file_path, stat.st_size))
+
+        for _, file_path, size in sorted(files):
+            self._entries[file_path] = size
+            self._size += size
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        with self._lock:
+            return self.key_path(*key) in self._entries
+
+    def key_path(self, filehash, media_type):
+        """
+        Returns the path a file is stored at
+
+        :param filehash: Base64 SHA-256 of the decrypted file
+        :type filehash: str
+        :param media_type: Media type of the message (image, video, ...)
+        :type media_type: str
+        """
+        return os.path.join(self.path, media_type, binascii.hexlify(b64decode(filehash)).decode('ascii'))
+
+    def get(self, filehash, media_type):
+        """
+        Returns the path of a stored file
+
+        :return: Path of the file, or None if it is not in the store
+        :rtype: str
+        """
+        file_path = self.key_path(filehash, media_type)
+        with self._lock:
+            if file_path not in self._entries:
+                self.misses += 1
+                return None
+
+            if not os.path.exists(file_path):
+                # Removed from outside
+                self._size -= self._entries.pop(file_path)
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(file_path)
+            self.hits += 1
+
+        # The modification time keeps the LRU order between runs
+        os.utime(file_path, None)
+        return file_path
+
+    def put(self, filehash, media_type, write):
+        """
+        Adds a file to the store
+
+        The file is written to a temporary file that is moved into place once complete, so a failed write never leaves
+        a partial file in the store.
+
+        :param filehash: Base64 SHA-256 of the decrypted file
+        :type filehash: str
+        :param media_type: Media type of the message (image, video, ...)
+        :type media_type: str
+        :param write: Function that receives a file object opened in binary mode and writes the file content to it
+        :return: Path of the stored file
+        :rtype: str
+        """
+        file_path = self.key_path(filehash, media_type)
+        directory = os.path.dirname(file_path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        fd, temp_path = tempfile.mkstemp(prefix=self._TEMP_PREFIX, dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                write(f)
+            os.replace(temp_path, file_path)
+        except Exception:
+            os.remove(temp_path)
+            raise
+
+        size = os.path.getsize(file_path)
+        with self._lock:
+            self._size += size - self._entries.pop(file_path, 0)
+            self._entries[file_path] = size
+            self._evict()
+
+        return file_path
+
+    def _evict(self):
+        # The file just added is kept even if it is bigger than max_size on its own
+        while self._size > self.max_size and len(self._entries) > 1:
+            file_path, size = self._entries.popitem(last=False)
+            self._size -= size
+            self.evictions += 1
+            try:
+                os.remove(file_path)
+            except OSError:
+                pass
+
+    def open(self, filehash, media_type):
+        """
+        Maps a stored file in memory
+
+        :return: Read only memory map of the file (bytes if the file is empty), or None if it is not in the store
+        :rtype: mmap.mmap
+        """
+        f = self._open_entry(filehash, media_type)
+        if f is None:
+            return None
+
+        with f:
+            if not os.fstat(f.fileno()).st_size:
+                # Empty files can't be mapped
+                return b''
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def copy(self, filehash, media_type, destination):
+        """
+        Copies a stored file
+
+        The copy is never a link to the store, so writing to it can't change the stored file.
+
+        :param destination: Path of the copy
+        :type destination: str
+        :return: destination, or None if the file is not in the store
+        """
+        source = self._open_entry(filehash, media_type)
+        if source is None:
+            return None
+
+        with source, open(destination, 'wb') as f:
+            shutil.copyfileobj(source, f)
+        return destination
+
+    def _open_entry(self, filehash, media_type):
+        file_path = self.get(filehash, media_type)
+        if file_path is None:
+            return None
+
+        try:
+            return open(file_path, 'rb')
+        except OSError:
+            # Evicted by another thread since get. Once open, the file stays readable even if it is evicted
+            return None
+
+    def clear(self):
+        with self._lock:
+            for file_path in self._entries:
+                try:
+                    os.remove(file_path)
+                except OSError:
+                    pass
+            self._entries.clear()
+            self._size = 0
+
+    def get_stats(self):
+        return {
+            'files': len(self._entries),
+            'size': self._size,
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
@@ -1,5 +1,6 @@
 from .whatsapp_object import WhatsappObjectWithId, driver_needed
 from ..helper import safe_str
+from ..wapi_js_wrapper import JsException
 import time
 from datetime import datetime
 
@@ -47,11 +48,14 @@ class Chat(WhatsappObjectWithId):
         :type last: datetime
         :return: Nothing
         :rtype: None
+        :raises JsException: If the chat doesn't exist or the messages couldn't be loaded
         """
         timestamp = time.mktime(last.timetuple())
-        self.driver.wapi_functions.loadEarlierMessagesTillDate(
+        result = self.driver.wapi_functions.loadEarlierMessagesTillDate(
             self.get_id(), timestamp
         )
+        if result is not None and result.get('error') is not None:
+            raise JsException("Error in function loadEarlierMessagesTillDate ({0}).".format(result['error']))
 
 
 class UserChat(Chat):
@@ -80,10 +84,33 @@ class BroadcastChat(Chat):
 class GroupChat(Chat):
     def __init__(self, js_obj, driver=None):
         super(GroupChat, self).__init__(js_obj, driver)
+        # Taken from the group metadata when the chat was fetched, see refresh_participants. None while the
+        # participants are not loaded in the page
+        self.participant_count = js_obj.get("participantCount")
+        self.admin_ids = js_obj.get("adminIds") or []
 
     @driver_needed
     def get_participants_ids(self):
-        return self.driver.wapi_functions.getGroupParticipantIDs(self.get_id())
+        participant_ids = self.driver.wapi_functions.getGroupParticipantIDs(self.get_id())
+        self.participant_count = len(participant_ids) or None
+        return participant_ids
+
+    @driver_needed
+    def refresh_participants(self):
+        """
+        Updates participant_count and admin_ids from the browser in a single round trip
+
+        :return: IDs of the participants
+        :rtype: list[str]
+        """
+        with self.driver.wapi_functions.batch() as batch:
+            participants = batch.getGroupParticipantIDs(self.get_id())
+            admins = batch.getGroupAdmins(self.get_id())
+
+        participant_ids = participants.result()
+        self.participant_count = len(participant_ids) or None
+        self.admin_ids = admins.result()
+        return participant_ids
 
     @driver_needed
     def get_participants(self):
@@ -98,4 +125,4 @@ class GroupChat(Chat):
         return "<Group chat - {name}: {id}, {participants} participants>".format(
             name=safe_name,
             id=self.get_id(),
-            participants=len(self.get_participants_ids()))
+            participants="unknown" if self.participant_count is None else self.participant_count)
@@ -0,0 +1,29 @@
+class Delta(object):
+    """
+    Changes of a collection (chats or contacts) since a cursor
+    """
+
+    def __init__(self, cursor, changed, removed_ids, full):
+        """
+        Constructor
+
+        :param cursor: Cursor to pass on the next call to get the following changes
+        :type cursor: str
+        :param changed: Objects added or changed since the previous cursor
+        :type changed: list
+        :param removed_ids: IDs of the objects removed since the previous cursor
+        :type removed_ids: list[str]
+        :param full: True if the previous cursor was unknown or outdated (i.e. the page was reloaded),
+            in which case changed holds the whole collection and the local copy should be replaced
+        :type full: bool
+        """
+        self.cursor = cursor
+        self.changed = changed
+        self.removed_ids = removed_ids
+        self.full = full
+
+    def __repr__(self):
+        return "<Delta - {changed} changed, {removed} removed{full}>".format(
+            changed=len(self.changed),
+            removed=len(self.removed_ids),
+            full=" (full)" if self.full else "")
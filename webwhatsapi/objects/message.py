@@ -2,6 +2,7 @@ import json
 import mimetypes
 import logging
 from base64 import b64decode
+from collections import OrderedDict
 from datetime import datetime
 
 import os
@@ -10,33 +11,44 @@ from enum import Enum
 from webwhatsapi.helper import safe_str
 from webwhatsapi.objects.contact import Contact
 from webwhatsapi.objects.whatsapp_object import WhatsappObject
+from webwhatsapi.wapi_js_wrapper import JsException
 
 
 logger = logging.getLogger("driver-wapi")
 
 
-def getContacts(x, driver):
-    try:
-        contact = driver.get_contact_from_id(x)
-        return contact
-    except:
-        return x
-
-
-def factory_message(js_obj, driver):
+def _message_class(js_obj):
     if js_obj.get("lat") and js_obj.get("lng"):
-        return GeoMessage(js_obj, driver)
+        return GeoMessage
 
     if js_obj.get("isMedia") or js_obj.get("isMMS"):
-        return MediaMessage(js_obj, driver)
+        return MediaMessage
 
     if js_obj.get("isNotification"):
-        return NotificationMessage(js_obj, driver)
+        return NotificationMessage
 
     if js_obj.get("type") in ["vcard", "multi_vcard"]:
-        return VCardMessage(js_obj, driver)
+        return VCardMessage
+
+    return Message
+
+
+def factory_message(js_obj, driver):
+    return factory_messages([js_obj], driver)[0]
+
+
+def factory_messages(js_objs, driver):
+    """
+    Creates the objects of several messages, fetching the recipients of all their notifications in a single browser
+    round trip
 
-    return Message(js_obj, driver)
+    :param js_objs: Raw JS message objs
+    :type js_objs: list[dict]
+    :rtype: list[Message]
+    """
+    messages = [_message_class(js_obj)(js_obj, driver) for js_obj in js_objs]
+    NotificationMessage.resolve_recipients(messages, driver)
+    return messages
 
 
 class Message(WhatsappObject):
@@ -58,6 +70,9 @@ class Message(WhatsappObject):
 
         if js_obj["sender"]:
             self.sender = Contact(js_obj["sender"], driver)
+        elif js_obj.get("senderId"):
+            # Minimal serialization profile only sends the sender ID
+            self.sender = Contact({"id": js_obj["senderId"], "name": None}, driver)
 
         try:
             status = MessageStatus(js_obj.get('ack', 0))
@@ -110,16 +125,38 @@ class MediaMessage(Message):
 
         self.media_key = self._js_obj.get('mediaKey')
         self.client_url = self._js_obj.get('clientUrl')
+        self.filehash = self._js_obj.get('filehash')
+        self.enc_filehash = self._js_obj.get('encFilehash')
 
         extension = mimetypes.guess_extension(self.mime)
         try:
-            self.filename = ''.join([self._js_obj["filehash"], extension])
-        except (KeyError, TypeError):
+            # Base64 hashes can contain slashes
+            self.filename = ''.join([self._js_obj["filehash"].replace('/', '_'), extension])
+        except (KeyError, TypeError, AttributeError):
             self.filename = ''.join([str(id(self)), extension or ''])
 
     def save_media(self, path):
-        with open(os.path.join(path, self.filename), "wb") as output:
+        """
+        Saves the media of the message in a directory
+
+        If the driver has a media store, the decrypted file is copied from it, downloading it first if
+        needed. Otherwise the preview sent with the message is saved.
+
+        :param path: Directory to save the file in
+        :type path: str
+        :return: Path of the saved file
+        :rtype: str
+        """
+        destination = os.path.join(path, self.filename)
+        driver = self.driver
+        if driver is not None and driver._can_store_media(self):
+            driver.get_media_path(self)
+            if driver.media_store.copy(self.filehash, self.type, destination):
+                return destination
+
+        with open(destination, "wb") as output:
             output.write(b64decode(self.content))
+        return destination
 
     def __repr__(self):
         return "<MediaMessage - {type} from {sender} at {timestamp} ({filename})>".format(
@@ -194,7 +231,36 @@ class NotificationMessage(Message):
         self.type = js_obj["type"]
         self.subtype = js_obj["subtype"]
         if js_obj["recipients"]:
-            self.recipients = [getContacts(x, driver) for x in js_obj["recipients"]]
+            # Recipients may come as serialized IDs or as ID objects
+            # Replaced with contacts by resolve_recipients
+            self.recipients = [recipient.get('_serialized') if isinstance(recipient, dict) else recipient
+                               for recipient in js_obj["recipients"]]
+
+    @staticmethod
+    def resolve_recipients(messages, driver):
+        """
+        Replaces the recipient IDs of notification messages with contacts, in a single browser round trip
+
+        Recipients that can't be resolved are kept as IDs.
+
+        :param messages: Messages, the ones that are not notifications are skipped
+        :type messages: list[Message]
+        """
+        messages = [message for message in messages
+                    if isinstance(message, NotificationMessage) and getattr(message, 'recipients', None)]
+        if driver is None or not messages:
+            return
+
+        recipient_ids = list(OrderedDict.fromkeys(recipient for message in messages
+                                                  for recipient in message.recipients))
+        try:
+            contacts = dict(zip(recipient_ids, driver.get_contacts_by_ids(recipient_ids)))
+        except JsException:
+            logger.exception("Could not fetch recipients of messages %s", ", ".join(message.id for message in messages))
+            return
+
+        for message in messages:
+            message.recipients = [contacts[recipient] or recipient for recipient in message.recipients]
 
     def __repr__(self):
         readable = {
@@ -251,3 +317,31 @@ class MessageStatus(Enum):
     RECEIVED = 2
     READ = 3
     VOICE_MESSAGE_RECEIVED = 4
+
+
+class MessageStatusChange(object):
+    """
+    Change of the status (ack) of a message
+    """
+
+    def __init__(self, js_obj):
+        """
+        Constructor
+
+        :param js_obj: Change, as returned by WAPI.waitAckChanges
+        :type js_obj: dict
+        """
+        self.message_id = js_obj['id']
+        self.chat_id = js_obj['chatId']
+        try:
+            self.status = MessageStatus(js_obj['ack'])
+        except ValueError as e:
+            logger.error(str(e), exc_info=True)
+            self.status = MessageStatus.ERROR
+        self.timestamp = datetime.fromtimestamp(js_obj['t'])
+
+    def __repr__(self):
+        return "<MessageStatusChange - {id} {status} at {timestamp}>".format(
+            id=self.message_id,
+            status=self.status.name,
+            timestamp=self.timestamp)
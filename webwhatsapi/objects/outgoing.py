@@ -0,0 +1,59 @@
+import os
+
+
+class MediaFile(object):
+    """
+    File to send with WhatsAPIDriver.send_bulk
+    """
+
+    def __init__(self, path, caption=None):
+        """
+        Constructor
+
+        :param path: Path of the file
+        :type path: str
+        :param caption: Caption of the media
+        :type caption: str
+        """
+        self.path = os.path.abspath(path)
+        self.caption = caption
+
+    def __repr__(self):
+        return "<MediaFile {0}>".format(self.path)
+
+
+class SendResult(object):
+    """
+    Outcome of one of the messages sent by WhatsAPIDriver.send_bulk
+    """
+
+    def __init__(self, index, chat_id, message_id=None, ack=None, error=None):
+        """
+        Constructor
+
+        :param index: Position of the message in the jobs passed to send_bulk
+        :type index: int
+        :param chat_id: ID of the chat the message was sent to
+        :type chat_id: str
+        :param message_id: ID of the sent message, None if it failed or could not be found after sending
+        :type message_id: str
+        :param ack: Status of the message when it was sent, None if unknown
+        :type ack: MessageStatus
+        :param error: Error message if the message could not be sent
+        :type error: str
+        """
+        self.index = index
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.ack = ack
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __repr__(self):
+        return "<SendResult - {index} to {chat_id} ({status})>".format(
+            index=self.index,
+            chat_id=self.chat_id,
+            status=self.ack.name if self.ok and self.ack is not None else self.error or "sent")
@@ -0,0 +1,465 @@
+"""
+Pool of WhatsAPIDriver instances, one per account
+"""
+
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from threading import BoundedSemaphore, Event, Lock, RLock, Thread
+
+from . import WhatsAPIException
+
+
+class SessionNotFoundError(WhatsAPIException):
+    pass
+
+
+class SessionUnavailableError(WhatsAPIException):
+    pass
+
+
+class SessionState(object):
+    Stopped = 'Stopped'
+    Starting = 'Starting'
+    NotLoggedIn = 'NotLoggedIn'
+    Running = 'Running'
+    Unhealthy = 'Unhealthy'
+    Failed = 'Failed'
+
+
+class PoolSession(object):
+    """
+    Driver of an account in a DriverPool, with its state and counters
+    """
+
+    def __init__(self, account):
+        self.account = account
+        self.driver = None
+        self.state = SessionState.Stopped
+        self.starts = 0
+        self.restarts = 0
+        # Seconds the last start took
+        self.start_duration = None
+        self.calls = 0
+        self.errors = 0
+        # Consecutive failed health checks
+        self.failures = 0
+        self.last_check = None
+        self.last_error = None
+        # Serializes calls, health checks and restarts of the session
+        self.lock = RLock()
+        # Guards state and failures, which a health check updates without the session when it is busy. Only held
+        # for the update, never while taking another lock
+        self.state_lock = Lock()
+
+    def __repr__(self):
+        return "<PoolSession {0} ({1})>".format(self.account, self.state)
+
+
+class DriverPool(object):
+    """
+    Starts, monitors and restarts one WhatsAPIDriver per account
+
+    Drivers are created by a factory, so the pool can run any driver configuration (or a fake one in tests)::
+
+        pool = DriverPool(lambda account: WhatsAPIDriver(profile=profiles[account], username=account))
+        pool.start_all(profiles.keys())
+        pool.start_supervisor()
+
+        pool.call('shop-1', 'chat_send_message', chat_id, "Hello")
+    """
+
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, factory, max_concurrent_starts=2, health_check_interval=60, max_failures=3, logger=None,
+                 start_timeout=180, check_timeout=30, max_concurrent_checks=8):
+        """
+        Constructor
+
+        :param factory: Callable receiving an account name and returning a connected driver
+        :type factory: callable
+        :param max_concurrent_starts: Maximum number of browsers starting at the same time
+        :type max_concurrent_starts: int
+        :param health_check_interval: Seconds between health checks of the supervisor
+        :type health_check_interval: float
+        :param max_failures: Consecutive failed health checks before a session is restarted
+        :type max_failures: int
+        :param start_timeout: Seconds a driver has to start before the start is considered failed
+        :type start_timeout: float
+        :param check_timeout: Seconds a health check waits for a busy session before counting as failed
+        :type check_timeout: float
+        :param max_concurrent_checks: Maximum number of sessions checked at the same time
+        :type max_concurrent_checks: int
+        """
+        self.factory = factory
+        self.max_concurrent_starts = max_concurrent_starts
+        self.health_check_interval = health_check_interval
+        self.max_failures = max_failures
+        self.start_timeout = start_timeout
+        self.check_timeout = check_timeout
+        self.max_concurrent_checks = max_concurrent_checks
+        self.logger = logger or self.logger
+        self._sessions = {}
+        self._lock = Lock()
+        self._start_semaphore = BoundedSemaphore(max_concurrent_starts)
+        self._supervisor = None
+        self._stop = Event()
+        # Runs the health probes, so a hung browser only times out its own check
+        self._probe_executor = ThreadPoolExecutor(max_workers=max_concurrent_checks)
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def __contains__(self, account):
+        return account in self._sessions
+
+    def __iter__(self):
+        return iter(list(self._sessions))
+
+    def get_session(self, account):
+        """
+        :raises SessionNotFoundError: If the account is not in the pool
+        :rtype: PoolSession
+        """
+        try:
+            return self._sessions[account]
+        except KeyError:
+            raise SessionNotFoundError("Account {0} is not in the pool".format(account))
+
+    def add(self, account, start=True):
+        """
+        Adds an account to the pool
+
+        :param account: Account name, passed to the factory
+        :param start: Start its driver now
+        :type start: bool
+        :rtype: PoolSession
+        """
+        with self._lock:
+            if account in self._sessions:
+                raise WhatsAPIException("Account {0} is already in the pool".format(account))
+            session = self._sessions[account] = PoolSession(account)
+
+        if start:
+            self.start(account)
+        return session
+
+    def remove(self, account):
+        """
+        Stops the driver of an account and removes the account from the pool
+        """
+        self.stop(account)
+        with self._lock:
+            self._sessions.pop(account, None)
+
+    def start(self, account):
+        """
+        Starts the driver of an account, waiting if max_concurrent_starts browsers are already starting
+
+        The factory runs without holding the session, so calls and checks of the account fail fast instead of
+        waiting for a slow browser launch. A start taking longer than start_timeout fails, and the driver is quit if
+        it comes up later.
+
+        :return: True if the driver started
+        :rtype: bool
+        """
+        session = self.get_session(account)
+
+        with session.lock:
+            if session.driver is not None:
+                return True
+            if session.state == SessionState.Starting:
+                # Started from another thread
+                return False
+            with session.state_lock:
+                session.state = SessionState.Starting
+
+        with self._start_semaphore:
+            started_at = time.monotonic()
+            executor = ThreadPoolExecutor(max_workers=1)
+            future = executor.submit(self.factory, account)
+            executor.shutdown(wait=False)
+            try:
+                driver = future.result(self.start_timeout)
+            except Exception as e:
+                if isinstance(e, TimeoutError):
+                    e = SessionUnavailableError(
+                        "Session {0} did not start in {1}s".format(account, self.start_timeout))
+                    future.add_done_callback(self._quit_late_driver)
+                self.logger.error("Could not start session %s: %s", account, e)
+                with session.lock, session.state_lock:
+                    session.state = SessionState.Failed
+                    session.last_error = e
+                return False
+
+        with session.lock:
+            if session.state != SessionState.Starting:
+                # Stopped while starting
+                self._quit_late_driver(future)
+                return False
+            session.driver = driver
+            session.starts += 1
+            session.start_duration = time.monotonic() - started_at
+            with session.state_lock:
+                session.failures = 0
+                session.state = SessionState.NotLoggedIn
+        self.logger.info("Started session %s in %.1fs", account, session.start_duration)
+        return True
+
+    def _quit_late_driver(self, future):
+        if future.exception() is None:
+            try:
+                future.result().quit()
+            except Exception:
+                self.logger.exception("Error quitting a driver that started too late")
+
+    def start_all(self, accounts=None):
+        """
+        Adds accounts that are not in the pool and starts every driver that is not running
+
+        Drivers start in parallel, at most max_concurrent_starts at the same time.
+
+        :param accounts: Accounts to start. None starts every account in the pool
+        :return: Accounts that failed to start
+        :rtype: list
+        """
+        if accounts is None:
+            accounts = list(self._sessions)
+        else:
+            accounts = list(accounts)
+            for account in accounts:
+                if account not in self._sessions:
+                    self.add(account, start=False)
+
+        if not accounts:
+            return []
+
+        with ThreadPoolExecutor(max_workers=self.max_concurrent_starts) as executor:
+            started = list(executor.map(self.start, accounts))
+
+        return [account for account, ok in zip(accounts, started) if not ok]
+
+    def stop(self, account, timeout=None):
+        """
+        Quits the driver of an account, keeping the account in the pool
+
+        :param timeout: Seconds to wait for a running call to finish. The driver is quit anyway after that, which
+                        makes a hung call fail. None waits as long as needed
+        :type timeout: float
+        """
+        session = self.get_session(account)
+
+        locked = session.lock.acquire(timeout=-1 if timeout is None else timeout)
+        if not locked:
+            self.logger.warning("Session %s is busy, quitting it anyway", account)
+        try:
+            driver, session.driver = session.driver, None
+            with session.state_lock:
+                session.state = SessionState.Stopped
+        finally:
+            if locked:
+                session.lock.release()
+
+        if driver is not None:
+            try:
+                driver.quit()
+            except Exception:
+                self.logger.exception("Error quitting session %s", account)
+
+    def restart(self, account):
+        """
+        Quits and starts again the driver of an account
+
+        A running call gets check_timeout seconds to finish before the driver is quit.
+
+        :return: True if the driver started
+        :rtype: bool
+        """
+        session = self.get_session(account)
+
+        self.logger.warning("Restarting session %s", account)
+        self.stop(account, timeout=self.check_timeout)
+        session.restarts += 1
+        return self.start(account)
+
+    @staticmethod
+    def _probe(driver):
+        """
+        :return: None if not logged in, else whether the connection is running
+        """
+        if not driver.is_logged_in():
+            return None
+        return driver.get_connection_status() == 'RUNNING'
+
+    def check(self, account):
+        """
+        Checks the health of the driver of an account and updates its state
+
+        A session is healthy when it is logged in and its connection status is RUNNING. Sessions waiting for a QR code
+        scan are not considered failed. A session busy with a call, or not answering the probe, for longer than
+        check_timeout fails the check. After max_failures consecutive failed checks the session is restarted, and
+        sessions that failed to start are started again.
+
+        :return: State of the session after the check
+        :rtype: str
+        """
+        session = self.get_session(account)
+
+        if not session.lock.acquire(timeout=self.check_timeout):
+            session.last_error = SessionUnavailableError("Session {0} is busy".format(account))
+        else:
+            try:
+                if session.driver is None:
+                    if session.state != SessionState.Failed:
+                        return session.state
+                    failed_start = True
+                else:
+                    failed_start = False
+                    state = self._check_driver(session)
+                    if state is not None:
+                        return state
+            finally:
+                session.lock.release()
+
+            # Starts run without holding the session
+            if failed_start:
+                self.start(account)
+                return session.state
+
+        with session.state_lock:
+            session.failures += 1
+            session.state = SessionState.Unhealthy
+            failures = session.failures
+        if failures >= self.max_failures:
+            self.restart(account)
+        return session.state
+
+    def _check_driver(self, session):
+        """
+        Probes the driver of a session, with the session held
+
+        :return: New state if the session is healthy or waiting for login, None if the check failed
+        """
+        session.last_check = time.time()
+        try:
+            logged_in = self._probe_executor.submit(self._probe, session.driver).result(self.check_timeout)
+        except TimeoutError:
+            session.last_error = SessionUnavailableError("Session {0} did not answer".format(session.account))
+            return None
+        except Exception as e:
+            session.last_error = e
+            return None
+
+        if logged_in is False:
+            return None
+
+        with session.state_lock:
+            session.state = SessionState.NotLoggedIn if logged_in is None else SessionState.Running
+            session.failures = 0
+            return session.state
+
+    def check_all(self):
+        """
+        Checks every session, at most max_concurrent_checks at the same time
+
+        :return: State of each session, by account
+        :rtype: dict
+        """
+        accounts = list(self)
+        if not accounts:
+            return {}
+
+        with ThreadPoolExecutor(max_workers=self.max_concurrent_checks) as executor:
+            return dict(zip(accounts, executor.map(self.check, accounts)))
+
+    def start_supervisor(self):
+        """
+        Starts a background thread that checks every session each health_check_interval seconds
+        """
+        if self._supervisor is not None and self._supervisor.is_alive():
+            return
+
+        self._stop.clear()
+        self._supervisor = Thread(target=self._supervise, name='DriverPool supervisor', daemon=True)
+        self._supervisor.start()
+
+    def stop_supervisor(self):
+        self._stop.set()
+        if self._supervisor is not None:
+            self._supervisor.join()
+            self._supervisor = None
+
+    def _supervise(self):
+        while not self._stop.wait(self.health_check_interval):
+            try:
+                self.check_all()
+            except Exception:
+                self.logger.exception("Error checking sessions")
+
+    def get(self, account):
+        """
+        Returns the driver of an account
+
+        :raises SessionUnavailableError: If the driver is not started
+        """
+        session = self.get_session(account)
+        driver = session.driver
+        if driver is None:
+            raise SessionUnavailableError("Session {0} is {1}".format(account, session.state))
+        return driver
+
+    def call(self, account, method, *args, **kwargs):
+        """
+        Calls a method of the driver of an account
+
+        Calls to the same account are serialized, calls to different accounts run in parallel.
+
+        :param account: Account name
+        :param method: Name of the WhatsAPIDriver method
+        :type method: str
+        :return: Value returned by the method
+        """
+        session = self.get_session(account)
+
+        with session.lock:
+            driver = self.get(account)
+            session.calls += 1
+            try:
+                return getattr(driver, method)(*args, **kwargs)
+            except Exception as e:
+                session.errors += 1
+                session.last_error = e
+                raise
+
+    def get_metrics(self):
+        """
+        Returns aggregate counters of the pool
+
+        :return: Number of sessions by state, totals of starts, restarts, calls and errors, and the average time a
+                 start takes in seconds
+        :rtype: dict
+        """
+        sessions = list(self._sessions.values())
+        states = {}
+        for session in sessions:
+            states[session.state] = states.get(session.state, 0) + 1
+
+        start_durations = [session.start_duration for session in sessions if session.start_duration is not None]
+        return {
+            'sessions': len(sessions),
+            'states': states,
+            'starts': sum(session.starts for session in sessions),
+            'restarts': sum(session.restarts for session in sessions),
+            'calls': sum(session.calls for session in sessions),
+            'errors': sum(session.errors for session in sessions),
+            'average_start_duration': sum(start_durations) / len(start_durations) if start_durations else None
+        }
+
+    def close(self):
+        """
+        Stops the supervisor and quits every driver
+        """
+        self.stop_supervisor()
+        for account in self:
+            self.stop(account, timeout=self.check_timeout)
+        self._probe_executor.shutdown(wait=False)
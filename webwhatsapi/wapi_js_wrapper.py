@@ -1,7 +1,11 @@
 import os
+import uuid
+from contextlib import contextmanager
+from functools import partial
+from itertools import count
+from threading import Condition, Event, RLock, Thread, current_thread, local
 
 from selenium.common.exceptions import WebDriverException
-from six import string_types
 
 
 class JsException(Exception):
@@ -9,13 +13,39 @@ class JsException(Exception):
         super(Exception, self).__init__(message)
 
 
+class JsTimeoutError(JsException):
+    pass
+
+
+class PhoneNotConnectedError(JsException):
+    pass
+
+
 class WapiJsWrapper(object):
     """
     Wraps JS functions in window.WAPI for easier use from python
+
+    wapi.js is injected once per page load. Every injection is tagged with a random id, which each call checks in the
+    page before running, so a reload (or a lost window.WAPI) is detected as part of the call itself and triggers a
+    single re-injection.
     """
 
+    # Value returned by a call when window.WAPI is missing or belongs to another injection
+    _NOT_INJECTED_KEY = '_wapiNotInjected'
+
+    _script = None
+
     def __init__(self, driver):
         self.driver = driver
+        self.injection_id = None
+        self.available_functions = None
+        self.injections = 0
+        self.calls = 0
+        self.batched_calls = 0
+        self.channel = None
+        self._functions = {}
+        self._lock = RLock()
+        self._local = local()
 
     def __getattr__(self, item):
         """
@@ -25,78 +55,442 @@ class WapiJsWrapper(object):
         :return: Callable function object
         :rtype: JsFunction
         """
-        wapi_functions = dir(self)
+        if item.startswith('_'):
+            # Dunder probes (hasattr, copy, IPython...) and private names are never looked up in the page
+            raise AttributeError(item)
+
+        if self.available_functions is None or (item not in self.available_functions and not self.is_injected()):
+            # The function table is missing or belongs to a lost injection, so it is reloaded once before giving up
+            self.inject()
 
-        if item not in wapi_functions:
+        if item not in self.available_functions:
             raise AttributeError("Function {0} doesn't exist".format(item))
 
-        return JsFunction(item, self.driver)
+        try:
+            return self._functions[item]
+        except KeyError:
+            function = self._functions[item] = JsFunction(item, self.driver, self)
+            return function
 
     def __dir__(self):
         """
-        Reloads wapi.js and returns its functions
+        Returns the functions in window.WAPI, injecting wapi.js if it was not injected yet
 
         :return: List of functions in window.WAPI
         """
-        try:
-            script_path = os.path.dirname(os.path.abspath(__file__))
-        except NameError:
-            script_path = os.getcwd()
-        with open(os.path.join(script_path, "js", "wapi.js"), "r") as script:
-            self.driver.execute_script(script.read())
+        if self.available_functions is None:
+            self.inject()
 
-        return self.driver.execute_script("return window.WAPI").keys()
+        return list(self.available_functions)
 
+    @classmethod
+    def _load_script(cls):
+        if cls._script is None:
+            try:
+                script_path = os.path.dirname(os.path.abspath(__file__))
+            except NameError:
+                script_path = os.getcwd()
+            with open(os.path.join(script_path, "js", "wapi.js"), "r") as script:
+                cls._script = script.read()
 
-class JsArg(object):
-    """
-    Represents a JS function argument
-    """
+        return cls._script
 
-    def __init__(self, obj):
+    def inject(self):
         """
-        Constructor
+        Injects wapi.js in the page and reloads the function table
+        """
+        with self._lock:
+            injection_id = uuid.uuid4().hex
+            script = "{0}\nwindow.WAPI._injectionId = arguments[0];\nreturn Object.keys(window.WAPI);".format(
+                self._load_script())
+            functions = self.driver.execute_script(script, injection_id)
+
+            self.available_functions = frozenset(functions)
+            self.injection_id = injection_id
+            self.injections += 1
+
+    def is_injected(self):
+        """
+        Checks whether the page still has the window.WAPI of the last injection
+
+        :rtype: bool
+        """
+        with self._lock:
+            return self.injection_id is not None and self.driver.execute_script(
+                "return !!window.WAPI && window.WAPI._injectionId === arguments[0];", self.injection_id) is True
+
+    def batch(self):
+        """
+        Creates a batch to run several WAPI functions in a single browser round trip
+
+        Usage::
+
+            with driver.wapi_functions.batch() as batch:
+                first = batch.getContact(first_id)
+                second = batch.getContact(second_id)
+            first.result()
+
+        :return: Batch of calls
+        :rtype: JsBatch
+        """
+        return JsBatch(self)
+
+    def enable_channel(self, poll_timeout=0.05):
+        """
+        Runs calls made from different threads concurrently in the page, see JsChannel
+
+        :param poll_timeout: Maximum time a call waits to be started while other calls are running, in seconds
+        :type poll_timeout: float
+        :rtype: JsChannel
+        """
+        with self._lock:
+            if self.channel is None:
+                self.channel = JsChannel(self, poll_timeout)
+        return self.channel
 
-        :param obj: Python object to represent
+    def close(self):
         """
-        self.obj = obj
+        Stops the channel, waiting for its dispatcher to finish the command it is running
+        """
+        channel, self.channel = self.channel, None
+        if channel is not None:
+            channel.close()
+
+    @contextmanager
+    def exclusive(self):
+        """
+        Holds the WebDriver session for the current thread, for commands that drive the browser directly
 
-    def __str__(self):
+        The channel dispatcher sends every command under the same lock, so it waits until the block exits. WAPI calls
+        made by the current thread in the block run directly instead of through the channel.
         """
-        Casts self.obj from python type to valid JS literal
+        with self._lock:
+            previous = getattr(self._local, 'exclusive', False)
+            self._local.exclusive = True
+            try:
+                yield
+            finally:
+                self._local.exclusive = previous
 
-        :return: JS literal represented in a string
+    @contextmanager
+    def call_timeout(self, timeout):
         """
-        if isinstance(self.obj, string_types):
-            return repr(str(self.obj))
+        Sets a timeout for the calls made by the current thread in the block
+
+        Only enforced when the channel is enabled, calls running longer raise JsTimeoutError
 
-        if isinstance(self.obj, bool):
-            return str(self.obj).lower()
+        :param timeout: Timeout in seconds, None for no timeout
+        :type timeout: float
+        """
+        previous = getattr(self._local, 'timeout', None)
+        self._local.timeout = timeout
+        try:
+            yield
+        finally:
+            self._local.timeout = previous
 
-        return str(self.obj)
+    def is_not_injected_result(self, result):
+        return isinstance(result, dict) and result.get(self._NOT_INJECTED_KEY) is True
+
+    def get_stats(self):
+        """
+        Returns injection and call counters
+
+        :return: Number of wapi.js injections and WAPI calls done by this wrapper
+        :rtype: dict
+        """
+        return {
+            'injections': self.injections,
+            'calls': self.calls,
+            'batched_calls': self.batched_calls
+        }
 
 
 class JsFunction(object):
     """
     Callable object represents functions in window.WAPI
+
+    Arguments are passed to the browser as WebDriver script arguments, so they are marshalled as JSON (lists and dicts
+    included) instead of being pasted into the script source, and the script text is the same for every call.
     """
 
-    def __init__(self, function_name, driver):
+    # Selenium's execute_async_script passes a callback function that should be called when the JS operation is done.
+    # It is always the last argument and is passed on to the WAPI function after the call arguments.
+    # The first argument is the injection id the call was made for.
+    _SCRIPT_TEMPLATE = (
+        "var args = Array.prototype.slice.call(arguments);"
+        "var done = args.pop();"
+        "if (!window.WAPI || window.WAPI._injectionId !== args.shift()) {{"
+        " return done({{{not_injected}: true}}); "
+        "}}"
+        "return window.WAPI.{function_name}.apply(window.WAPI, args.concat([done]));"
+    )
+
+    def __init__(self, function_name, driver, wrapper):
         self.driver = driver
         self.function_name = function_name
+        self.wrapper = wrapper
+        self.script = self._SCRIPT_TEMPLATE.format(function_name=function_name,
+                                                   not_injected=wrapper._NOT_INJECTED_KEY)
 
     def __call__(self, *args, **kwargs):
-        # Selenium's execute_async_script passes a callback function that should be called when the JS operation is done
-        # It is passed to the WAPI function using arguments[0]
-        if len(args):
-            command = "return WAPI.{0}({1}, arguments[0])"\
-                .format(self.function_name, ",".join([str(JsArg(arg)) for arg in args]))
-        else:
-            command = "return WAPI.{0}(arguments[0])".format(self.function_name)
+        channel = self.wrapper.channel
+        if channel is not None and not getattr(self.wrapper._local, 'exclusive', False):
+            return channel.call(self.function_name, args, getattr(self.wrapper._local, 'timeout', None))
+        return self.execute(*args)
 
+    def execute(self, *args):
+        """
+        Runs the function in the page and waits for its result, bypassing the channel
+        """
         try:
-            return self.driver.execute_async_script(command)
+            # WebDriver sessions can't run commands from several threads at the same time
+            with self.wrapper._lock:
+                self.wrapper.calls += 1
+                if self.wrapper.injection_id is None:
+                    self.wrapper.inject()
+
+                result = self.driver.execute_async_script(self.script, self.wrapper.injection_id, *args)
+
+                if self.wrapper.is_not_injected_result(result):
+                    # Page was reloaded since the last injection
+                    self.wrapper.inject()
+                    result = self.driver.execute_async_script(self.script, self.wrapper.injection_id, *args)
+
+                return result
         except WebDriverException as e:
             if e.msg == 'Timed out':
-                raise Exception("Phone not connected to Internet")
-            raise JsException("Error in function {0} ({1}). Command: {2}".format(self.function_name, e.msg, command))
+                raise PhoneNotConnectedError("Phone not connected to Internet")
+            raise JsException("Error in function {0} ({1}).".format(self.function_name, e.msg))
+
+
+class JsBatchCall(object):
+    """
+    Result of a call queued in a JsBatch
+    """
+
+    def __init__(self, function_name, args):
+        self.function_name = function_name
+        self.args = args
+        self.done = False
+        self._result = None
+        self._error = None
+
+    def set_outcome(self, outcome):
+        self._result = outcome.get('result', None)
+        self._error = outcome.get('error', None)
+        self.done = True
+
+    def result(self):
+        """
+        Returns the value the WAPI function passed to its callback
+
+        :raises JsException: If the function failed in the browser
+        """
+        if not self.done:
+            raise JsException("Function {0} has not been run yet".format(self.function_name))
+
+        if self._error is not None:
+            raise JsException("Error in function {0} ({1}).".format(self.function_name, self._error))
+
+        return self._result
+
+
+class JsBatch(object):
+    """
+    Queues calls to functions in window.WAPI and runs all of them in a single execute_async_script
+
+    Calls are run when the batch is used as a context manager and the block exits, or by calling execute()
+    """
+
+    def __init__(self, wrapper):
+        self.wrapper = wrapper
+        self.calls = []
+
+    def __getattr__(self, item):
+        if item.startswith('__'):
+            raise AttributeError(item)
+
+        # Raises AttributeError if the function doesn't exist
+        getattr(self.wrapper, item)
+
+        return partial(self.add, item)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.execute()
+
+    def add(self, function_name, *args):
+        """
+        Queues a call
+
+        :param function_name: Name of the function in window.WAPI
+        :return: Call result placeholder
+        :rtype: JsBatchCall
+        """
+        call = JsBatchCall(function_name, args)
+        self.calls.append(call)
+        return call
+
+    def execute(self):
+        """
+        Runs the queued calls
+
+        :return: Calls with their results, in the order they were queued
+        :rtype: list[JsBatchCall]
+        """
+        calls, self.calls = self.calls, []
+        if not calls:
+            return calls
+
+        outcomes = self.wrapper.callBatch([[call.function_name, list(call.args)] for call in calls])
+        self.wrapper.batched_calls += len(calls)
+
+        for call, outcome in zip(calls, outcomes):
+            call.set_outcome(outcome)
+
+        return calls
+
+
+class JsChannelCall(object):
+    """
+    Call waiting for its result in a JsChannel
+    """
+
+    def __init__(self, call_id, function_name, args):
+        self.call_id = call_id
+        self.function_name = function_name
+        self.args = list(args)
+        self.done = Event()
+        self.result = None
+        self.error = None
+
+    def set_outcome(self, result=None, error=None):
+        self.result = result
+        self.error = error
+        self.done.set()
+
+
+class JsChannel(object):
+    """
+    Runs WAPI calls from several threads concurrently over a single WebDriver session
+
+    WebDriver runs one command at a time, so a slow call would keep every other thread waiting. Instead, calls are
+    started in the page without waiting for them, and a dispatcher thread polls the page for the results of the
+    running calls, starting the calls queued meanwhile on each round trip.
+    """
+
+    def __init__(self, wrapper, poll_timeout=0.05):
+        """
+        Constructor
+
+        :param wrapper: Wrapper the calls are made through
+        :type wrapper: WapiJsWrapper
+        :param poll_timeout: Maximum time each poll waits for a result, in seconds. Calls queued meanwhile wait for it
+        :type poll_timeout: float
+        """
+        self.wrapper = wrapper
+        self.poll_timeout = poll_timeout
+        # The calls table of the page outlives the channel, so ids are unique to each channel
+        self._id_prefix = uuid.uuid4().hex
+        self._ids = count()
+        self._queued = []
+        self._cancelled = []
+        self._running = {}
+        self._condition = Condition()
+        self._thread = None
+        self._closed = False
+
+    def call(self, function_name, args, timeout=None):
+        """
+        Runs a WAPI function and waits for its result
+
+        :param function_name: Name of the function in window.WAPI
+        :param args: Arguments of the function
+        :param timeout: Maximum time to wait for the result, in seconds. None waits forever
+        :raises JsTimeoutError: If the call times out. It is discarded in the page
+        :raises JsException: If the function failed
+        """
+        call = JsChannelCall("{0}-{1}".format(self._id_prefix, next(self._ids)), function_name, args)
+
+        with self._condition:
+            if self._closed:
+                raise JsException("Channel is closed")
+            self._queued.append(call)
+            if self._thread is None:
+                self._thread = Thread(target=self._dispatch, name='WAPI channel', daemon=True)
+                self._thread.start()
+            self._condition.notify()
+
+        if not call.done.wait(timeout):
+            with self._condition:
+                if call in self._queued:
+                    self._queued.remove(call)
+                elif self._running.pop(call.call_id, None) is not None:
+                    self._cancelled.append(call.call_id)
+                self._condition.notify()
+            raise JsTimeoutError("Function {0} timed out".format(function_name))
+
+        if call.error is not None:
+            raise JsException("Error in function {0} ({1}).".format(function_name, call.error))
+        return call.result
+
+    def close(self):
+        """
+        Stops the dispatcher, failing the calls still waiting
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+            thread = self._thread
+
+        if thread is not None and thread is not current_thread():
+            thread.join()
+
+    def _dispatch(self):
+        while True:
+            with self._condition:
+                while not (self._queued or self._running or self._cancelled or self._closed):
+                    self._condition.wait()
+
+                if self._closed:
+                    for call in self._queued + list(self._running.values()):
+                        call.set_outcome(error="Channel closed")
+                    self._queued, self._running = [], {}
+                    self._thread = None
+                    return
+
+                started, self._queued = self._queued, []
+                cancelled, self._cancelled = self._cancelled, []
+                for call in started:
+                    self._running[call.call_id] = call
+
+            try:
+                if cancelled:
+                    self.wrapper.cancelCalls.execute(cancelled)
+                if started:
+                    self.wrapper.startCalls.execute(
+                        [[call.call_id, call.function_name, call.args] for call in started]
+                    )
+                response = self.wrapper.waitCallResults.execute(int(self.poll_timeout * 1000))
+            except Exception as e:
+                with self._condition:
+                    running, self._running = self._running, {}
+                for call in running.values():
+                    call.set_outcome(error=str(e))
+                continue
+
+            with self._condition:
+                for outcome in response['results']:
+                    call = self._running.pop(outcome['callId'], None)
+                    if call is not None:
+                        call.set_outcome(outcome.get('result'), outcome.get('error'))
+
+                # Calls the page doesn't know about were lost in a page reload
+                still_running = set(response['running'])
+                lost = [call_id for call_id in self._running if call_id not in still_running]
+                for call_id in lost:
+                    self._running.pop(call_id).set_outcome(error="Page was reloaded")